@@ -0,0 +1,168 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+from typing import Optional
+from keepoutareas import KeepoutArea
+from mppi import MPPIFilter, MPPIFilterResult
+
+
+@dataclass
+class AsyncMPPIFilterRequest:
+    """`AsyncMPPIFilterRunner`へ依頼されたMPPI介入制御器の計算を記述する．"""
+    initial_location_x: float
+    initial_location_y: float
+    initial_direction: float
+    initial_speed: float
+    nominal_command: float
+    # 依頼された時刻（`perf_counter`）
+    submitted_at: float
+    future: Future = field(default_factory=Future)
+
+
+class AsyncMPPIFilterRunner:
+    def __init__(self, mppi_filter: MPPIFilter, lookahead_steps: int = 1):
+        """
+        MPPI介入制御器をゲームループとは別のスレッドで動かす．
+        ゲームループは毎フレーム`submit`で計算を依頼し，`poll`でその時点で最新の結果を受け取る．
+        計算している間に，ゲームループは描画やCARLAとの通信を進められる．
+
+        計算は1本のスレッドで依頼された順番に行うので，`previous_optimal_command`による前回の最適入力の引き継ぎは
+        同期的に呼び出した場合と同じになる．
+        計算が追いつかない間に次の依頼が来た場合は，まだ始まっていない古い依頼を取り消して新しい依頼だけを計算する．
+
+        結果が使われるのは計算が終わった後のフレームなので，計算を始める前に，
+        依頼された状態を`VehicleModel.single_step`で先読みしておく．
+
+        Parameters
+        ----------
+        mppi_filter:MPPIFilter
+            別スレッドで動かすMPPI介入制御器．このランナーに渡した後は，直接呼び出さないこと．
+        lookahead_steps:int
+            結果が使われるまでにかかるフレーム数の見込み．
+            依頼から計算開始までに待たされたフレーム数は，これに加えて先読みする．
+        """
+        self.mppi_filter = mppi_filter
+        self.lookahead_steps = lookahead_steps
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AsyncMPPIFilterRunner")
+
+        # 依頼の受け渡しに関する状態．lockで保護する
+        self.lock = Lock()
+        self.waiting_request: Optional[AsyncMPPIFilterRequest] = None
+        self.is_working = False
+
+        # MPPI介入制御器そのものを保護する
+        self.filter_lock = Lock()
+
+        # 最新の結果に関する情報
+        self.latest_result: Optional[MPPIFilterResult] = None
+        self.latest_result_submitted_at = 0.
+        # 依頼から結果が出るまでにかかった時間
+        self.latest_latency = 0.
+        # 最新の結果を計算する際に先読みしたステップ数
+        self.latest_predicted_steps = 0
+
+    def set_keepoutareas(self, keepoutareas: list[KeepoutArea]) -> list[int]:
+        """計算中の依頼が終わるのを待ってから，立ち入り禁止領域を差し替える．"""
+        with self.filter_lock:
+            return self.mppi_filter.set_keepoutareas(keepoutareas)
+
+    def add_keepoutarea(self, keepoutarea: KeepoutArea) -> int:
+        with self.filter_lock:
+            return self.mppi_filter.add_keepoutarea(keepoutarea)
+
+    def update_keepoutarea(self, handle: int, keepoutarea: KeepoutArea):
+        with self.filter_lock:
+            self.mppi_filter.update_keepoutarea(handle, keepoutarea)
+
+    def remove_keepoutarea(self, handle: int):
+        with self.filter_lock:
+            self.mppi_filter.remove_keepoutarea(handle)
+
+    def submit(
+            self,
+            initial_location_x: float,
+            initial_location_y: float,
+            initial_direction: float,
+            initial_speed: float,
+            nominal_command: float,
+    ) -> Future:
+        """
+        MPPI介入制御器の計算を依頼する．引数は`MPPIFilter.get_filtered_command`と同じ．
+        計算結果の`MPPIFilterResult`が入る`Future`を返す．
+        後から来た依頼に取り消された場合，その`Future`はキャンセルされる．
+        """
+        request = AsyncMPPIFilterRequest(
+            initial_location_x=initial_location_x,
+            initial_location_y=initial_location_y,
+            initial_direction=initial_direction,
+            initial_speed=initial_speed,
+            nominal_command=nominal_command,
+            submitted_at=perf_counter()
+        )
+        with self.lock:
+            if self.waiting_request is not None:
+                self.waiting_request.future.cancel()
+            self.waiting_request = request
+            if not self.is_working:
+                self.is_working = True
+                self.executor.submit(self.work)
+        return request.future
+
+    def poll(self) -> Optional[MPPIFilterResult]:
+        """その時点で最新の計算結果を返す．まだ1つも結果が無ければNoneを返す．"""
+        return self.latest_result
+
+    def work(self):
+        """別スレッドで，依頼が無くなるまで計算を続ける．"""
+        while True:
+            with self.lock:
+                request = self.waiting_request
+                self.waiting_request = None
+                if request is None:
+                    self.is_working = False
+                    return
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.run(request)
+            except BaseException as e:
+                request.future.set_exception(e)
+                continue
+            request.future.set_result(result)
+
+    def run(self, request: AsyncMPPIFilterRequest) -> MPPIFilterResult:
+        with self.filter_lock:
+            vehiclemodel = self.mppi_filter.vehiclemodel
+
+            # 待たされた分と結果が使われるまでの分を先読みする．ステアリング入力はノミナル入力のまま保たれると見なす
+            waited_steps = int((perf_counter() - request.submitted_at) / vehiclemodel.frame_time)
+            predicted_steps = self.lookahead_steps + waited_steps
+            x = request.initial_location_x
+            y = request.initial_location_y
+            direction = request.initial_direction
+            vehiclemodel.set_speed(request.initial_speed)
+            for _ in range(predicted_steps):
+                x, y, direction = vehiclemodel.single_step(x, y, direction, request.nominal_command)
+
+            result = self.mppi_filter.get_filtered_command(
+                initial_location_x=x,
+                initial_location_y=y,
+                initial_direction=direction,
+                initial_speed=request.initial_speed,
+                nominal_command=request.nominal_command,
+            )
+
+        finished_at = perf_counter()
+        self.latest_result = result
+        self.latest_result_submitted_at = request.submitted_at
+        self.latest_latency = finished_at - request.submitted_at
+        self.latest_predicted_steps = predicted_steps
+        return result
+
+    def shutdown(self):
+        with self.lock:
+            if self.waiting_request is not None:
+                self.waiting_request.future.cancel()
+                self.waiting_request = None
+        self.executor.shutdown(wait=True)
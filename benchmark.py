@@ -0,0 +1,263 @@
+"""
+CARLAやPyGame，G29無しで制御系の処理時間を測るベンチマーク．
+
+    uv run benchmark.py --save Benchmarks/baseline.json
+    uv run benchmark.py --compare Benchmarks/baseline.json
+
+`MPPIFilter.get_filtered_command`（介入あり・介入なし），`VehicleModel`の軌道予測，`CircleKeepoutArea.check`について，
+サンプルサイズ，ホライズン，障害物の数を振りながら，1回あたりの処理時間のp50/p99と確保したメモリの最大量を測る．
+"""
+# 標準
+import json
+import platform
+import tracemalloc
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from itertools import product
+from pathlib import Path
+from time import perf_counter_ns
+from typing import Callable
+
+# サードパーティー
+import click
+import numpy as np
+from numpy import percentile
+
+# 自プロジェクト
+from vehiclemodel import VehicleModel, RolloutBackend, DEFAULT_FRAMETIME
+from mppi import MPPIFilter, FilteringFlow, DiagnosticsLevel
+from keepoutareas import CircleKeepoutArea
+
+# ベンチマークで車が走る速さ[m/s]
+BENCHMARK_SPEED = 12.0
+# 介入ありの場合に車の正面に置く障害物までの距離の，予測ホライズン内に進む距離に対する比
+BENCHMARK_OBSTACLE_DISTANCE_RATIO = 0.6
+BENCHMARK_OBSTACLE_RADIUS = 4.0
+
+
+def get_obstacle_distance(horizon: int) -> float:
+    """どのホライズンでも予測軌道が届くよう，車の正面に置く障害物までの距離[m]をホライズンから決める．"""
+    return BENCHMARK_OBSTACLE_DISTANCE_RATIO * horizon * BENCHMARK_SPEED * DEFAULT_FRAMETIME
+
+
+@dataclass
+class BenchmarkResult:
+    """1つのベンチマーク項目の結果を記述する．"""
+    name: str
+    p50_us: float
+    p99_us: float
+    mean_us: float
+    # 1回の呼び出しの中で確保されたメモリの最大量
+    peak_allocation_bytes: int
+
+
+def measure(name: str, func: Callable[[], object], repeats: int, warmup: int) -> BenchmarkResult:
+    """funcを繰り返し呼び出し，処理時間と確保したメモリを測る．"""
+    for _ in range(warmup):
+        func()
+
+    durations_ns = np.empty(repeats, dtype=np.int64)
+    for i in range(repeats):
+        start = perf_counter_ns()
+        func()
+        durations_ns[i] = perf_counter_ns() - start
+
+    # tracemallocは処理時間に影響するので，時間とは別に測る
+    tracemalloc.start()
+    func()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations_us = durations_ns / 1e3
+    return BenchmarkResult(
+        name=name,
+        p50_us=float(percentile(durations_us, 50)),
+        p99_us=float(percentile(durations_us, 99)),
+        mean_us=float(durations_us.mean()),
+        peak_allocation_bytes=int(peak - baseline)
+    )
+
+
+def create_keepoutareas(
+        n_obstacles: int,
+        intervention: bool,
+        horizon: int,
+        rng: np.random.Generator
+) -> list[CircleKeepoutArea]:
+    """
+    原点からx軸の正の向きに進む車に対する障害物を作る．
+    1つ目の障害物は，interventionがTrueなら車の正面の`get_obstacle_distance`の所に，Falseなら車の進路から外れた所に置く．
+    残りは周囲に散らばらせる．
+    """
+    first_y = 0. if intervention else 3 * BENCHMARK_OBSTACLE_RADIUS
+    keepoutareas = [CircleKeepoutArea(get_obstacle_distance(horizon), first_y, BENCHMARK_OBSTACLE_RADIUS)]
+    for _ in range(n_obstacles - 1):
+        x, y = rng.uniform(-200., 200., size=2)
+        if abs(y) < 2 * BENCHMARK_OBSTACLE_RADIUS and x > -2 * BENCHMARK_OBSTACLE_RADIUS:
+            y += np.sign(y + 1e-9) * 4 * BENCHMARK_OBSTACLE_RADIUS  # 車の進路は空けておく
+        keepoutareas.append(CircleKeepoutArea(x, y, BENCHMARK_OBSTACLE_RADIUS))
+    return keepoutareas
+
+
+def create_mppi_filter(
+        samplesize: int,
+        horizon: int,
+        backend: RolloutBackend,
+        preallocate: bool,
+        fused_chunk_size: int | None,
+        float32: bool,
+        arc_check: bool,
+        rng: np.random.Generator
+) -> MPPIFilter:
+    """gaming.pyと同じ設定のMPPI介入制御器を作る．"""
+    return MPPIFilter(
+        vehiclemodel=VehicleModel(rollout_backend=backend, dtype=np.float32 if float32 else np.float64),
+        samplesize=samplesize,
+        horizon=horizon,
+        command_std=0.7,
+        temperature=1.0,
+        violation_weight_decay=0.90,
+        preallocate=preallocate,
+        fused_chunk_size=fused_chunk_size,
+        diagnostics=DiagnosticsLevel.Summary,
+        use_arc_check=arc_check,
+        rng=rng
+    )
+
+
+def run_benchmarks(
+        samplesizes: list[int],
+        horizons: list[int],
+        obstacle_counts: list[int],
+        backend: RolloutBackend,
+        preallocate: bool,
+        fused_chunk_size: int | None,
+        float32: bool,
+        arc_check: bool,
+        repeats: int,
+        warmup: int,
+        seed: int
+) -> list[BenchmarkResult]:
+    rng = np.random.default_rng(seed)
+    results = []
+
+    # マイクロベンチマーク：軌道予測と立ち入り禁止領域の判定
+    for samplesize, horizon in product(samplesizes, horizons):
+        vehiclemodel = VehicleModel(rollout_backend=backend, dtype=np.float32 if float32 else np.float64)
+        vehiclemodel.set_speed(BENCHMARK_SPEED)
+        commands_list = np.clip(rng.normal(0., 0.7, size=(samplesize, horizon)), -1., 1.).astype(vehiclemodel.dtype)
+        results.append(measure(
+            f"rollout/{backend.name}/samplesize={samplesize}/horizon={horizon}",
+            lambda: vehiclemodel.predict_constant_speed_variable_command_behaviour(0., 0., 0., commands_list),
+            repeats, warmup
+        ))
+        x_history_list, y_history_list = \
+            vehiclemodel.predict_constant_speed_variable_command_behaviour(0., 0., 0., commands_list)
+        koa = CircleKeepoutArea(get_obstacle_distance(horizon), 0., BENCHMARK_OBSTACLE_RADIUS)
+        results.append(measure(
+            f"circle_check/samplesize={samplesize}/horizon={horizon}",
+            lambda: koa.check(x_history_list, y_history_list),
+            repeats, warmup
+        ))
+
+    # マクロベンチマーク：MPPI介入制御器の1回分の計算
+    for samplesize, horizon, n_obstacles, intervention in product(
+            samplesizes, horizons, obstacle_counts, (True, False)
+    ):
+        mppi_filter = create_mppi_filter(
+            samplesize, horizon, backend, preallocate, fused_chunk_size, float32, arc_check, rng
+        )
+        mppi_filter.set_keepoutareas(create_keepoutareas(n_obstacles, intervention, horizon, rng))
+        expected_flow = FilteringFlow.Intervention if intervention else FilteringFlow.NoIntervention
+        flow = mppi_filter.get_filtered_command(0., 0., 0., BENCHMARK_SPEED, 0.).flow
+        assert flow == expected_flow, f"ベンチマークの設定が想定通りのフィルタリングになっていない: {flow}"
+        results.append(measure(
+            f"mppi/{expected_flow.name}/samplesize={samplesize}/horizon={horizon}/obstacles={n_obstacles}",
+            lambda: mppi_filter.get_filtered_command(0., 0., 0., BENCHMARK_SPEED, 0.),
+            repeats, warmup
+        ))
+    return results
+
+
+def print_results(results: list[BenchmarkResult], baseline: dict[str, dict] | None):
+    header = f"{'name':<72} {'p50[us]':>10} {'p99[us]':>10} {'alloc[B]':>10}"
+    if baseline is not None:
+        header += f" {'p50 ratio':>10} {'p99 ratio':>10}"
+    print(header)
+    for result in results:
+        line = f"{result.name:<72} {result.p50_us:>10.1f} {result.p99_us:>10.1f} {result.peak_allocation_bytes:>10d}"
+        if baseline is not None:
+            if result.name in baseline:
+                base = baseline[result.name]
+                line += f" {result.p50_us / base['p50_us']:>10.2f} {result.p99_us / base['p99_us']:>10.2f}"
+            else:
+                line += f" {'-':>10} {'-':>10}"
+        print(line)
+
+
+@click.command()
+@click.option("--samplesize", "samplesizes", type=int, multiple=True, default=(256, 512, 1024), show_default=True)
+@click.option("--horizon", "horizons", type=int, multiple=True, default=(25, 50), show_default=True)
+@click.option("--obstacles", "obstacle_counts", type=int, multiple=True, default=(1, 10, 100), show_default=True)
+@click.option("--backend", type=click.Choice([b.name for b in RolloutBackend]), default=RolloutBackend.Cumsum.name,
+              show_default=True)
+@click.option("--preallocate/--no-preallocate", default=True, show_default=True)
+@click.option("--fused-chunk-size", type=int, default=None)
+@click.option("--float32", is_flag=True, default=False)
+@click.option("--arc-check/--no-arc-check", default=True, show_default=True)
+@click.option("--repeats", type=int, default=200, show_default=True)
+@click.option("--warmup", type=int, default=20, show_default=True)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--save", "save_to", type=click.Path(path_type=Path), default=None,
+              help="結果をJSONで保存する．")
+@click.option("--compare", "compare_to", type=click.Path(exists=True, path_type=Path), default=None,
+              help="以前に保存した結果と比べる．")
+def main(
+        samplesizes, horizons, obstacle_counts, backend, preallocate, fused_chunk_size, float32, arc_check,
+        repeats, warmup, seed, save_to, compare_to
+):
+    results = run_benchmarks(
+        samplesizes=list(samplesizes),
+        horizons=list(horizons),
+        obstacle_counts=list(obstacle_counts),
+        backend=RolloutBackend[backend],
+        preallocate=preallocate,
+        fused_chunk_size=fused_chunk_size,
+        float32=float32,
+        arc_check=arc_check,
+        repeats=repeats,
+        warmup=warmup,
+        seed=seed
+    )
+
+    baseline = None
+    if compare_to is not None:
+        baseline = {result["name"]: result for result in json.loads(compare_to.read_text())["results"]}
+    print_results(results, baseline)
+
+    if save_to is not None:
+        save_to.parent.mkdir(parents=True, exist_ok=True)
+        save_to.write_text(json.dumps({
+            "created_at": datetime.now().isoformat(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "settings": {
+                "backend": backend,
+                "preallocate": preallocate,
+                "fused_chunk_size": fused_chunk_size,
+                "float32": float32,
+                "arc_check": arc_check,
+                "repeats": repeats,
+                "seed": seed,
+            },
+            "results": [asdict(result) for result in results]
+        }, indent=2))
+        print("Saved Benchmark Results to", save_to)
+
+
+if __name__ == "__main__":
+    main()
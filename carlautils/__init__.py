@@ -1,5 +1,8 @@
 from .vehicle import Vehicle
 from .vehiclecamera import VehicleCamera
+from .framerecorder import FrameRecorder
+from .steppingdriver import SynchronousSteppingDriver
+from .commandbatch import CommandBatch
 from carla import Client, World, WorldSettings, BlueprintLibrary, VehicleControl
 from copy import deepcopy
 
@@ -0,0 +1,38 @@
+class CommandBatch:
+    def __init__(self, client, command_module=None):
+        """
+        1フレームの間にCARLAへ送る命令を溜めておき，`flush`で`client.apply_batch`を使って1回の通信でまとめて送る．
+        命令は`carla.command`の`ApplyVehicleControl`などで作る．
+        command_moduleを差し替えれば，CARLA無しで偽のクライアントを相手に試せる．
+
+        Parameters
+        ----------
+        client:carla.Client
+            `apply_batch`を持つクライアント．
+        command_module:
+            命令のクラスを持つモジュール．省略すると`carla.command`を使う．
+        """
+        if command_module is None:
+            from carla import command as command_module
+        self.client = client
+        self.command_module = command_module
+        self.commands: list = []
+        # これまでに送った命令の数と，通信の回数
+        self.sent_commands = 0
+        self.sent_batches = 0
+
+    def apply_vehicle_control(self, actor_id: int, control):
+        self.commands.append(self.command_module.ApplyVehicleControl(actor_id, control))
+
+    def set_vehicle_light_state(self, actor_id: int, light_state):
+        self.commands.append(self.command_module.SetVehicleLightState(actor_id, light_state))
+
+    def flush(self):
+        """溜めた命令をまとめて送る．命令が無ければ何もしない．"""
+        if not self.commands:
+            return
+        self.client.apply_batch(self.commands)
+        self.sent_commands += len(self.commands)
+        self.sent_batches += 1
+        self.commands = []
+
@@ -0,0 +1,206 @@
+from io import BytesIO
+from pathlib import Path
+from queue import Queue, Empty
+from threading import Thread, Lock
+from typing import Literal, Optional
+from numpy import ndarray, empty, copyto, save, int64, uint8
+from numpy.lib.format import open_memmap, write_array_header_1_0
+
+BackPressurePolicy = Literal["block", "drop"]
+
+
+class FrameStore:
+    def __init__(self, path: Path, capacity: int, height: int, width: int):
+        """
+        （capacity，高さ，幅，3）のRGB画像を持つ，メモリマップされた.npyファイル．
+        対応するgame_stepは，同じ名前に`.steps.npy`を付けたファイルに閉じる時に書き出す．
+        n_framesは書き込みを終えた画像の枚数で，閉じる時にファイルをその枚数まで切り詰める．
+        """
+        self.path = path
+        self.capacity = capacity
+        self.height = height
+        self.width = width
+        self.frames = open_memmap(path, mode="w+", dtype=uint8, shape=(capacity, height, width, 3))
+        self.game_steps = empty(capacity, dtype=int64)
+        self.n_frames = 0
+
+    def is_full(self) -> bool:
+        return self.n_frames == self.capacity
+
+    def close(self):
+        self.frames.flush()
+        header_size = self.frames.offset
+        del self.frames
+        if self.n_frames < self.capacity:
+            self.truncate(header_size)
+        save(self.path.with_suffix(".steps.npy"), self.game_steps[:self.n_frames])
+
+    def discard(self):
+        """1枚も書き込まなかったファイルを消す．"""
+        del self.frames
+        self.path.unlink()
+
+    def truncate(self, header_size: int):
+        """
+        ヘッダーの形を（n_frames，高さ，幅，3）に書き換え，ファイルをその大きさまで切り詰める．
+        NumPyはヘッダーの形を書き換えられるように余白を取っているので，ヘッダーの大きさは変わらない．
+        """
+        header = BytesIO()
+        write_array_header_1_0(header, {
+            "descr": "|u1",
+            "fortran_order": False,
+            "shape": (self.n_frames, self.height, self.width, 3),
+        })
+        if len(header.getvalue()) != header_size:
+            raise RuntimeError(f"Header Size Changed: {header_size} -> {len(header.getvalue())}")
+        with open(self.path, "r+b") as f:
+            f.write(header.getvalue())
+            f.truncate(header_size + self.n_frames * self.height * self.width * 3)
+
+
+class FrameRecorder:
+    def __init__(
+            self,
+            directory: Path,
+            width: int,
+            height: int,
+            store_capacity: int = 256,
+            n_writers: int = 2,
+            n_slots: int = 8,
+            policy: BackPressurePolicy = "drop"
+    ):
+        """
+        車載カメラの画像を，決まった数の書き込みスレッドでメモリマップされた.npyファイルへ書き出す．
+        ゲームループは`submit`でBGRAの画像を空いている中継用バッファへ1回複写するだけで，
+        ファイルの作成，変換，書き込みは全て書き込みスレッドが行う．
+
+        画像はstore_capacity枚ごとに`frames_XXXXXX.npy`へ，`submit`された順に並べて書き出す．
+        各画像のgame_stepは`frames_XXXXXX.steps.npy`に書き出す．
+        書き込みスレッドは，あるファイルに最初の画像を書き込む時に次のファイルを作っておき，
+        最後の画像を書き込み終えたファイルはすぐに閉じる．開いているファイルは，書き込み中のものとその次のものだけになる．
+
+        書き込みが追いつかず中継用バッファが全て使われている場合，policyが"block"ならバッファが空くまで待ち，
+        "drop"ならその画像を捨てて`dropped_frames`を増やす．
+
+        Parameters
+        ----------
+        directory:Path
+            画像を書き出すフォルダ．
+        width:int
+        height:int
+            画像の大きさ．
+        store_capacity:int
+            1つの.npyファイルに入れる画像の枚数．
+        n_writers:int
+            書き込みスレッドの数．
+        n_slots:int
+            中継用バッファの数．書き込みを待てる画像の枚数の上限になる．
+        policy:BackPressurePolicy
+            書き込みが追いつかない時の振る舞い．
+        """
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.width = width
+        self.height = height
+        self.store_capacity = store_capacity
+        self.policy = policy
+
+        self.free_slots: Queue[ndarray] = Queue()
+        for _ in range(n_slots):
+            self.free_slots.put(empty((height, width, 4), dtype=uint8))
+        # （中継用バッファ，ファイルの番号，ファイルの中での番号，game_step）
+        self.pending_frames: Queue[Optional[tuple[ndarray, int, int, int]]] = Queue()
+        self.n_submitted_frames = 0
+
+        # 開いているファイル．キーはファイルの番号
+        self.store_lock = Lock()
+        self.stores: dict[int, FrameStore] = {}
+        # 書き込みを終えた画像の数と，捨てた画像の数
+        self.counter_lock = Lock()
+        self.written_frames = 0
+        self.dropped_frames = 0
+
+        self.writers = [
+            Thread(target=self.work, name=f"FrameRecorder-{i}", daemon=True)
+            for i in range(n_writers)
+        ]
+        for writer in self.writers:
+            writer.start()
+
+    def submit(self, frame: ndarray, game_step: int) -> bool:
+        """
+        BGRAの（高さ，幅，4）の画像を書き出しに回す．この関数から戻った後は，frameを書き換えてよい．
+        画像を捨てた場合はFalseを返す．
+        """
+        try:
+            slot = self.free_slots.get(block=self.policy == "block")
+        except Empty:
+            with self.counter_lock:
+                self.dropped_frames += 1
+            return False
+        copyto(slot, frame)
+
+        number, index = divmod(self.n_submitted_frames, self.store_capacity)
+        self.n_submitted_frames += 1
+        self.pending_frames.put((slot, number, index, game_step))
+        return True
+
+    def get_store(self, number: int) -> FrameStore:
+        """number番目のファイルを返す．まだ作っていなければ作る．"""
+        with self.store_lock:
+            store = self.stores.get(number)
+            if store is None:
+                store = FrameStore(
+                    self.directory / f"frames_{number:06d}.npy",
+                    self.store_capacity, self.height, self.width
+                )
+                self.stores[number] = store
+            return store
+
+    def finish_frame(self, number: int, store: FrameStore):
+        """画像を1枚書き込み終えたことを記録し，ファイルが埋まったら閉じる．"""
+        with self.store_lock:
+            store.n_frames += 1
+            is_full = store.is_full()
+            if is_full:
+                del self.stores[number]
+        if is_full:
+            store.close()
+
+    def work(self):
+        """書き込みスレッドで，中継用バッファの画像をRGBに並べ替えてファイルへ書き込む．"""
+        while True:
+            item = self.pending_frames.get()
+            if item is None:
+                return
+            slot, number, index, game_step = item
+            try:
+                store = self.get_store(number)
+                if index == 0:
+                    self.get_store(number + 1)
+            except Exception as e:
+                print("Error Creating Frame Store:", e)
+                self.free_slots.put(slot)
+                continue
+            try:
+                copyto(store.frames[index], slot[:, :, 2::-1])
+                store.game_steps[index] = game_step
+                with self.counter_lock:
+                    self.written_frames += 1
+            except Exception as e:
+                print("Error Writing Frame:", e)
+            self.free_slots.put(slot)
+            self.finish_frame(number, store)
+
+    def close(self):
+        """書き込みを待つ画像を全て書き出し，ファイルを閉じる．先に作っておいて使わなかったファイルは消す．"""
+        for _ in self.writers:
+            self.pending_frames.put(None)
+        for writer in self.writers:
+            writer.join()
+        for store in self.stores.values():
+            if store.n_frames == 0:
+                store.discard()
+            else:
+                store.close()
+        self.stores.clear()
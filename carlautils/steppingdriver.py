@@ -0,0 +1,104 @@
+from time import perf_counter, sleep
+from typing import Callable, Optional
+
+
+class SynchronousSteppingDriver:
+    def __init__(
+            self,
+            world,
+            fixed_delta_seconds: float,
+            realtime: bool = True,
+            clock: Callable[[], float] = perf_counter,
+            sleeper: Callable[[float], None] = sleep
+    ):
+        """
+        CARLAの世界を同期モードにし，ゲームループの1周ごとに`world.tick()`で一定時間ずつ進める．
+        シミュレーションの1ステップがfixed_delta_secondsに固定されるので，内部モデルのフレーム時間と正確に揃う．
+        realtimeがTrueなら，実時間と揃うように次のステップまでの残り時間を`sleep`で待つ．待つ間にCPUを使い切らない．
+
+        worldは`get_settings`，`apply_settings`，`tick`を持っていればよく，CARLA無しで差し替えて試せる．
+        clockとsleeperも差し替えられる．
+
+        Parameters
+        ----------
+        world:carla.World
+        fixed_delta_seconds:float
+            1ステップで進めるシミュレーション時間[s]．`vehiclemodel.DEFAULT_FRAMETIME`に合わせる．
+        realtime:bool
+            実時間に合わせて待つかどうか．Falseならできるだけ速く進める．
+        clock:Callable[[],float]
+            現在時刻[s]を返す関数．
+        sleeper:Callable[[float],None]
+            与えられた秒数だけ待つ関数．
+        """
+        self.world = world
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.realtime = realtime
+        self.clock = clock
+        self.sleeper = sleeper
+
+        # 元の設定．`stop`で戻す
+        self.original_synchronous_mode: Optional[bool] = None
+        self.original_fixed_delta_seconds: Optional[float] = None
+        self.is_running = False
+
+        # 次のステップを始める時刻
+        self.next_step_at = 0.
+        self.last_step_at: Optional[float] = None
+        # 実際のステップの周波数[Hz]の指数移動平均
+        self.actual_framerate = 0.
+        # 実時間に間に合わなかったステップの数
+        self.late_steps = 0
+
+    def start(self):
+        """世界を同期モードにする．"""
+        settings = self.world.get_settings()
+        self.original_synchronous_mode = settings.synchronous_mode
+        self.original_fixed_delta_seconds = settings.fixed_delta_seconds
+        settings.synchronous_mode = True
+        settings.fixed_delta_seconds = self.fixed_delta_seconds
+        self.world.apply_settings(settings)
+        self.is_running = True
+        self.next_step_at = self.clock()
+        self.last_step_at = None
+
+    def step(self) -> int:
+        """
+        必要なら次のステップの時刻まで待ってから，世界を1ステップ進める．進めた後のフレーム番号を返す．
+        実時間に1ステップ以上遅れた場合は，遅れを取り戻そうとせずに今から数え直す．
+        """
+        if self.realtime:
+            remaining = self.next_step_at - self.clock()
+            if remaining > 0:
+                self.sleeper(remaining)
+        frame = self.world.tick()
+
+        now = self.clock()
+        self.next_step_at += self.fixed_delta_seconds
+        if now - self.next_step_at > self.fixed_delta_seconds:
+            self.late_steps += 1
+            self.next_step_at = now
+        if self.last_step_at is not None and now > self.last_step_at:
+            framerate = 1. / (now - self.last_step_at)
+            self.actual_framerate = framerate if self.actual_framerate == 0. \
+                else 0.9 * self.actual_framerate + 0.1 * framerate
+        self.last_step_at = now
+        return frame
+
+    def stop(self):
+        """世界の設定を`start`の前に戻す．"""
+        if not self.is_running:
+            return
+        settings = self.world.get_settings()
+        settings.synchronous_mode = self.original_synchronous_mode
+        settings.fixed_delta_seconds = self.original_fixed_delta_seconds
+        self.world.apply_settings(settings)
+        self.is_running = False
+
+    def __enter__(self) -> "SynchronousSteppingDriver":
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
@@ -2,6 +2,7 @@ import random
 
 import carla
 from typing import List, Literal, Optional
+from .commandbatch import CommandBatch
 
 VehicleBPID = Literal[
     'vehicle.sprinter.mercedes',
@@ -74,9 +75,40 @@ class Vehicle:
         # ライトに関する変数
         self.lights = carla.VehicleLightState.NONE
 
-    def apply_vehicle_control(self, control: carla.VehicleControl):
+        # `update_state`で更新される，最新のフレームでの車の状態
+        self.frame: Optional[int] = None
+        self.transform: carla.Transform = spawn_point
+        self.location: carla.Location = spawn_point.location
+        self.velocity = carla.Vector3D()
+        self.angular_velocity = carla.Vector3D()
+        self.acceleration = carla.Vector3D()
+
+    def update_state(self, snapshot: carla.WorldSnapshot) -> bool:
+        """
+        `world.get_snapshot`や`world.on_tick`で得た`WorldSnapshot`から車の状態を読み取って保持する．
+        `actor.get_location`などと違いCARLAとの通信が発生しないので，1フレームに何度読んでもよい．
+        スナップショットに車が無ければ何もせずFalseを返す．
+        """
+        actor_snapshot: Optional[carla.ActorSnapshot] = snapshot.find(self.actor.id)
+        if actor_snapshot is None:
+            return False
+        self.frame = snapshot.frame
+        self.transform = actor_snapshot.get_transform()
+        self.location = self.transform.location
+        self.velocity = actor_snapshot.get_velocity()
+        self.angular_velocity = actor_snapshot.get_angular_velocity()
+        self.acceleration = actor_snapshot.get_acceleration()
+        return True
+
+    def apply_vehicle_control(self, control: carla.VehicleControl, command_batch: Optional[CommandBatch] = None):
+        """
+        車に操作を与える．command_batchを与えると，その場では送らずにcommand_batchに溜める．
+        """
         # 物理入力
-        self.actor.apply_control(control)
+        if command_batch is None:
+            self.actor.apply_control(control)
+        else:
+            command_batch.apply_vehicle_control(self.actor.id, control)
 
         # ライトを更新
         next_lights = self.lights
@@ -90,7 +122,10 @@ class Vehicle:
             next_lights &= ~carla.VehicleLightState.Reverse
         if next_lights != self.lights:
             self.lights = next_lights
-            self.actor.set_light_state(carla.VehicleLightState(next_lights))
+            if command_batch is None:
+                self.actor.set_light_state(carla.VehicleLightState(next_lights))
+            else:
+                command_batch.set_vehicle_light_state(self.actor.id, carla.VehicleLightState(next_lights))
 
     def destroy(self):
         self.actor.destroy()
@@ -2,10 +2,9 @@ import carla
 from carla import Transform, Location, Rotation, AttachmentType
 import weakref
 from typing import Optional
-from numpy import frombuffer, reshape, dtype, ndarray
+from numpy import frombuffer, reshape, dtype, ndarray, empty, copyto
 from .vehicle import Vehicle
-from pathlib import Path
-import threading, pickle
+import threading
 
 uint8 = dtype("uint8")
 
@@ -33,28 +32,63 @@ class VehicleCamera:
             attach_to=vehicle.actor,
             attachment_type=AttachmentType.SpringArmGhost
         )
+        self.width = width
+        self.height = height
+
+        # CARLAから届いた画像をBGRAのまま持つ3つのバッファ．
+        # 書き込み中，最新，読み出し中のバッファを入れ替えることで，画像を1回の複写だけで受け渡し，
+        # 読み出し中のバッファがCARLAのスレッドに上書きされないようにする．
+        self.frame_buffers = [empty((height, width, 4), dtype=uint8) for _ in range(3)]
+        self.writing_index = 0
+        self.latest_index = 1
+        self.reading_index = 2
+        self.frame_lock = threading.Lock()
+        # 新しい画像が届くたびに増える．まだ届いていなければ0
+        self.frame_sequence = 0
+        self.read_frame_sequence = 0
+
         weak_self = weakref.ref(self)
-        self.image_array: Optional[ndarray] = None
         self.actor.listen(lambda image: VehicleCamera.on_image_taken(weak_self, image))
 
     @staticmethod
     def on_image_taken(weak_self, image: carla.Image):
         self: VehicleCamera = weak_self()
+        if self is None:
+            return
 
         image.convert(carla.ColorConverter.Raw)
-        x = frombuffer(image.raw_data, dtype=uint8)
-        x = reshape(x, (image.height, image.width, 4))
-        x = x[:, :, :3]
-        x = x[:, :, ::-1]
+        copyto(self.frame_buffers[self.writing_index], reshape(
+            frombuffer(image.raw_data, dtype=uint8), (image.height, image.width, 4)
+        ))
+        with self.frame_lock:
+            self.writing_index, self.latest_index = self.latest_index, self.writing_index
+            self.frame_sequence += 1
 
-        self.image_array = x
+    def get_new_frame(self) -> Optional[ndarray]:
+        """
+        前回の呼び出しの後に新しい画像が届いていれば，それをBGRAの（高さ，幅，4）の配列で返す．届いていなければNoneを返す．
+        返した配列は次にこれを呼ぶまで書き換えられないので，`pygame.image.frombuffer(frame, size, "BGRA")`で複写せずに使える．
+        """
+        with self.frame_lock:
+            if self.frame_sequence == self.read_frame_sequence:
+                return None
+            self.reading_index, self.latest_index = self.latest_index, self.reading_index
+            self.read_frame_sequence = self.frame_sequence
+        return self.frame_buffers[self.reading_index]
 
-    def take_screenshot_sync(self, save_to: Path):
-        save_to.write_bytes(pickle.dumps(self.image_array))
-        print("Saved Screenshot to", save_to.name)
+    def get_current_frame(self) -> Optional[ndarray]:
+        """最後に`get_new_frame`で読み出した画像をBGRAのまま返す．まだ読み出していなければNoneを返す．"""
+        if self.read_frame_sequence == 0:
+            return None
+        return self.frame_buffers[self.reading_index]
 
-    def take_screenshot_async(self, save_to: Path):
-        threading.Thread(target=self.take_screenshot_sync, args=(save_to,)).start()
+    @property
+    def image_array(self) -> Optional[ndarray]:
+        """最後に読み出した画像をRGBの（高さ，幅，3）の配列に複写して返す．まだ読み出していなければNoneを返す．"""
+        frame = self.get_current_frame()
+        if frame is None:
+            return None
+        return frame[:, :, 2::-1].copy()
 
     def destroy(self):
         self.actor.stop()
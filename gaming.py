@@ -1,5 +1,5 @@
 # 標準
-from time import time
+from time import time, perf_counter
 from datetime import datetime
 from pathlib import Path
 from dataclasses import dataclass, field, asdict
@@ -9,7 +9,6 @@ from copy import deepcopy
 from carla import *
 import pygame
 from pygame.surface import Surface
-from pandas import DataFrame
 from numpy import ndarray, zeros, arctan2
 from numpy import array as npa
 
@@ -20,61 +19,50 @@ from vehiclemodel import *
 from vehiclecontrollers import *
 from mppi import *
 from keepoutareas import *
+from asyncmppi import AsyncMPPIFilterRunner
+from telemetry import TelemetryRecord, TelemetryRecorder
+from profiling import StageProfiler
 
 # PyGame初期化
 pygame.init()
 screen = pygame.display.set_mode((1600, 900), pygame.HWSURFACE | pygame.DOUBLEBUF)
-clock = pygame.time.Clock()
 
 # テレメトリ
 session_id = datetime.now().strftime("%Y%m%d.%H%M%S")
 game_step = -1
-
-
-@dataclass
-class TelemetryRecord:
-    # 車
-    VehicleLocationX: float = 0.
-    VehicleLocationY: float = 0.
-    VehicleVelocityX: float = 0.
-    VehicleVelocityY: float = 0.
-    VehicleSpeed: float = 0.
-    VehicleAccelerationX: float = 0.
-    VehicleAccelerationY: float = 0.
-    VehicleDirection: float = 0.
-    # 障害物
-    ObstacleLocationX: float = 0.,
-    ObstacleLocationY: float = 0.,
-    ObstacleRadius2: float = 0.,
-    # 制御
-    ControlThrottle: float = 0.
-    ControlNominalSteer: float = 0.
-    ControlFilteredSteer: float = 0.
-    ControlBrake: float = 0.
-    # MPPI
-    MPPIFilterComputationTime: float = 0.
-    MPPIFilterFilteringFlowName: str = ""
-    MPPIOptimalSteerTrajectory: list = field(default_factory=list)
-    # ゲームシステム
-    GameTimestamp: float = 0.
-    GameActualFreshrate: float = 0.
-    GameStep: int = 0
-
-
-telemetry_history: list[TelemetryRecord] = []
 is_telemetry_recording = False
+# テレメトリの記録器．初めて記録を始めた時に作り，記録中のテレメトリを少しずつ`Records/{session_id}/`へ書き出す
+telemetry_recorder: Optional[TelemetryRecorder] = None
 # テレメトリの内容を一部表示するGUIコンポーネント
-telemetry_view = DictViewer(width=250, key_width=130, keys=["X", "Y", "Speed", "Brake", "MPPI Time"])
+telemetry_view = DictViewer(
+    width=250, key_width=130, keys=["X", "Y", "Speed", "Brake", "MPPI Time", "MPPI p50", "MPPI p99"]
+)
 
 # CARLAとの通信樹立
 client, world, world_settings, bpl = carlautils.get_ready()
 
 # CARLA内の物体の管理
 vehicle = carlautils.Vehicle(client=client, bpid="vehicle.nissan.patrol")
-vehicle_camera_view = Surface((1600, 900))
+vehicle_camera_size = (1600, 900)
 vehicle_camera = carlautils.VehicleCamera(
-    client=client, vehicle=vehicle, width=vehicle_camera_view.get_width(), height=vehicle_camera_view.get_height()
+    client=client, vehicle=vehicle, width=vehicle_camera_size[0], height=vehicle_camera_size[1]
 )
+# 車載カメラの画像の記録器．初めて画像を保存する時に作る
+frame_recorder: Optional[carlautils.FrameRecorder] = None
+# Trueの間は，届いた全ての画像を記録する
+is_frame_recording = False
+
+
+def get_frame_recorder() -> carlautils.FrameRecorder:
+    global frame_recorder
+    if frame_recorder is None:
+        frame_recorder = carlautils.FrameRecorder(
+            directory=Path(f"Records/{session_id}.frames"),
+            width=vehicle_camera.width,
+            height=vehicle_camera.height
+        )
+    return frame_recorder
+
 
 # G29：G29筐体をお持ちでない方はコメントアウト
 import LogitechSteeringWheelPy as lsw
@@ -93,29 +81,42 @@ nominal_controller = G29Controller(g29=g29)
 # nominal_control.steer = 0.0
 # nominal_controller = ConstantVehicleController(vehicle_control=nominal_control)
 
+# MPPI介入制御器の処理段階ごとの処理時間．測らない場合はNoneにする
+mppi_profiler = StageProfiler()
 # MPPI介入制御器
 mppi_filter = MPPIFilter(
-    vehiclemodel=VehicleModel(),
+    vehiclemodel=VehicleModel(rollout_backend=RolloutBackend.Cumsum),
     samplesize=512,
     horizon=50,
     command_std=0.7,
     temperature=1.0,
-    violation_weight_decay=0.90
+    violation_weight_decay=0.90,
+    preallocate=True,
+    diagnostics=DiagnosticsLevel.Summary,
+    use_arc_check=True,
+    profiler=mppi_profiler
 )
+# MPPI介入制御器をゲームループとは別のスレッドで動かすかどうか．
+# Trueにすると，MPPIの計算と描画やCARLAとの通信が並行する代わりに，前のフレームで依頼した計算結果を使うことになる．
+use_async_mppi = False
+mppi_runner = AsyncMPPIFilterRunner(mppi_filter) if use_async_mppi else None
 
 # ステアリング入力についてのGUI
 command_view = IntervenableScalarView(width=200, min_value=-1.0, max_value=1.0)
 
 # 障害物：障害物は好きな場所に配置できる
 obstacle_actor: Optional[Actor] = None
+# 障害物は物理演算で動くので，動く立ち入り禁止領域として毎フレーム位置と速度を更新する
+obstacle_keepoutareas: Optional[MovingCircleKeepoutAreas] = None
+obstacle_keepoutareas_handle: Optional[int] = None
 
 
 def spawn_obstacle():
-    global obstacle_actor, obstacle_x, obstacle_y
+    global obstacle_actor, obstacle_keepoutareas, obstacle_keepoutareas_handle
     if obstacle_actor:
         obstacle_actor.destroy()
     # 障害物の位置決め
-    transform: Transform = vehicle.actor.get_transform()
+    transform = Transform(vehicle.transform.location, vehicle.transform.rotation)  # 複製してから動かす
     forward: Vector3D = transform.get_forward_vector()  # 車の向き
     forward_x_std = forward.x
     forward_y_std = forward.y
@@ -132,30 +133,43 @@ def spawn_obstacle():
     except:
         print("Error Spawning Obstacle")
     # MPPI介入制御器に反映する
-    mppi_filter.set_keepoutareas([
-        CircleKeepoutArea(
-            transform.location.x,
-            transform.location.y,
-            4
-        )
-    ])
+    obstacle_keepoutareas = MovingCircleKeepoutAreas(
+        x=[transform.location.x],
+        y=[transform.location.y],
+        radius=[4]
+    )
+    # 2回目以降は同じハンドルの立ち入り禁止領域を差し替える
+    target = mppi_runner if mppi_runner is not None else mppi_filter
+    if obstacle_keepoutareas_handle is None:
+        obstacle_keepoutareas_handle = target.add_keepoutarea(obstacle_keepoutareas)
+    else:
+        target.update_keepoutarea(obstacle_keepoutareas_handle, obstacle_keepoutareas)
+
 
+# CARLAの世界を同期モードにし，内部モデルと同じフレーム時間で1周ごとに進める．次の周までは眠って待つ
+stepping_driver = carlautils.SynchronousSteppingDriver(world, fixed_delta_seconds=DEFAULT_FRAMETIME)
+stepping_driver.start()
+# CARLAへ送る命令を1フレーム分まとめる
+command_batch = carlautils.CommandBatch(client)
 
 gaming = True
 while gaming:
-    clock.tick_busy_loop(25)  # 25 Hzで動作させる
+    stepping_driver.step()  # 25 Hzで動作させる
+    # 今のフレームの全ての物の状態を1つのスナップショットからまとめて読み取る
+    snapshot = world.get_snapshot()
+    vehicle.update_state(snapshot)
 
     # テレメトリ
     game_step += 1
     T = TelemetryRecord()
     ## ゲーム環境に関して
     T.GameTimestamp = time()
-    T.GameActualFreshrate = clock.get_fps()
+    T.GameActualFreshrate = stepping_driver.actual_framerate
     T.GameStep = game_step
     ## 車について
-    location: Location = vehicle.actor.get_location()
-    velocity: Vector3D = vehicle.actor.get_velocity()
-    acceleration: Vector3D = vehicle.actor.get_acceleration()
+    location: Location = vehicle.location
+    velocity: Vector3D = vehicle.velocity
+    acceleration: Vector3D = vehicle.acceleration
     T.VehicleLocationX = location.x
     T.VehicleLocationY = location.y
     T.VehicleVelocityX = velocity.x
@@ -165,12 +179,23 @@ while gaming:
     T.VehicleAccelerationY = acceleration.y
     T.VehicleDirection = arctan2(velocity.y, velocity.x)
     ## 障害物について
-    if mppi_filter.keepoutareas:
-        # 当ゲームに限り，障害物は1つだけで，それは`CircleKeepoutArea`である．
-        koa: CircleKeepoutArea = mppi_filter.keepoutareas[0]
-        T.ObstacleLocationX = koa.x
-        T.ObstacleLocationY = koa.y
-        T.ObstacleRadius2 = koa.radius_2
+    if obstacle_keepoutareas is not None:
+        # 当ゲームに限り，障害物は1つだけである．
+        obstacle_snapshot = snapshot.find(obstacle_actor.id) if obstacle_actor is not None else None
+        if obstacle_snapshot is not None:
+            obstacle_location: Location = obstacle_snapshot.get_transform().location
+            obstacle_velocity: Vector3D = obstacle_snapshot.get_velocity()
+            obstacle_keepoutareas.set_states(
+                x=[obstacle_location.x],
+                y=[obstacle_location.y],
+                velocity_x=[obstacle_velocity.x],
+                velocity_y=[obstacle_velocity.y]
+            )
+        T.ObstacleLocationX = float(obstacle_keepoutareas.x[0])
+        T.ObstacleLocationY = float(obstacle_keepoutareas.y[0])
+        T.ObstacleRadius2 = float(obstacle_keepoutareas.radius_2[0])
+        T.ObstacleVelocityX = float(obstacle_keepoutareas.velocity_x[0])
+        T.ObstacleVelocityY = float(obstacle_keepoutareas.velocity_y[0])
 
     # G29筐体からの信号を読み取る：G29筐体をお持ちでない方はコメントアウト
     lsw.update()
@@ -180,15 +205,30 @@ while gaming:
     nominal_controller.tick()
     nominal_control = nominal_controller.get_vehicle_control()
     nominal_steer = nominal_control.steer
-    start = time()
-    mppi_result = mppi_filter.get_filtered_command(
-        initial_location_x=T.VehicleLocationX,
-        initial_location_y=T.VehicleLocationY,
-        initial_direction=T.VehicleDirection,
-        initial_speed=T.VehicleSpeed,
-        nominal_command=nominal_steer,
-    )
-    end = time()
+    if mppi_runner is not None:
+        # 今回の状態での計算を依頼し，その時点で最新の結果を使う
+        mppi_runner.submit(
+            initial_location_x=T.VehicleLocationX,
+            initial_location_y=T.VehicleLocationY,
+            initial_direction=T.VehicleDirection,
+            initial_speed=T.VehicleSpeed,
+            nominal_command=nominal_steer,
+        )
+        mppi_result = mppi_runner.poll()
+        if mppi_result is None:
+            mppi_result = MPPIFilterResult(filtered_command=nominal_steer, flow=FilteringFlow.NoKeepoutArea)
+        mppi_computation_time = mppi_runner.latest_latency
+    else:
+        start = perf_counter()
+        mppi_result = mppi_filter.get_filtered_command(
+            initial_location_x=T.VehicleLocationX,
+            initial_location_y=T.VehicleLocationY,
+            initial_direction=T.VehicleDirection,
+            initial_speed=T.VehicleSpeed,
+            nominal_command=nominal_steer,
+        )
+        end = perf_counter()
+        mppi_computation_time = end - start
     filtered_steer = mppi_result.filtered_command
     filtered_control = carlautils.copy_vehicle_control(nominal_control)
     filtered_control.steer = filtered_steer
@@ -197,64 +237,103 @@ while gaming:
     T.ControlBrake = nominal_control.brake
     T.ControlNominalSteer = nominal_steer
     T.ControlFilteredSteer = filtered_steer
-    T.MPPIFilterComputationTime = end - start  # MPPI介入制御の動作時間（多分すごい早いはず）
+    T.MPPIFilterComputationTime = mppi_computation_time  # MPPI介入制御の動作時間（多分すごい早いはず）
     T.MPPIFilterFilteringFlowName = mppi_result.flow.name
-    if mppi_result.commands_list is not None:
-        T.MPPIOptimalSteerTrajectory = \
-            sum(mppi_result.commands_list.T * mppi_result.sample_weights, axis=1).tolist()
+    if mppi_result.flow == FilteringFlow.Intervention:
+        T.MPPIEffectiveSampleSize = mppi_result.effective_sample_size
+        T.MPPIOptimalSteerTrajectory = mppi_result.optimal_command_trajectory
+    if mppi_result.min_clearance is not None:
+        T.MPPIMinClearance = mppi_result.min_clearance
+    if mppi_profiler is not None:
+        T.MPPITotalTimeP50 = mppi_profiler.get_percentile("total", 50)
+        T.MPPITotalTimeP99 = mppi_profiler.get_percentile("total", 99)
+        T.MPPINominalTimeP50 = mppi_profiler.get_percentile("nominal", 50)
+        T.MPPINominalTimeP99 = mppi_profiler.get_percentile("nominal", 99)
+        T.MPPIRolloutTimeP50 = mppi_profiler.get_percentile("rollout", 50)
+        T.MPPIRolloutTimeP99 = mppi_profiler.get_percentile("rollout", 99)
+        T.MPPIKeepoutTimeP50 = mppi_profiler.get_percentile("keepout", 50)
+        T.MPPIKeepoutTimeP99 = mppi_profiler.get_percentile("keepout", 99)
     ## GUIへの反映
     if mppi_result.flow == FilteringFlow.Intervention:
-        command_view.set_intervening(
+        command_view_dirty_rects = command_view.set_intervening(
             nominal_value=nominal_steer,
             intervening_value=filtered_steer
         )
     else:
-        command_view.set_nominal(nominal_steer)
-    ## 車へ入力
-    vehicle.apply_vehicle_control(filtered_control)
+        command_view_dirty_rects = command_view.set_nominal(nominal_steer)
+    ## 車へ入力：このフレームの命令はまとめて1回で送る
+    vehicle.apply_vehicle_control(filtered_control, command_batch=command_batch)
+    command_batch.flush()
 
     # G29の三角ボタンを押したら障害物が現れる
     if g29.is_released(g29.Button.Triangle):
         spawn_obstacle()
 
     # GUI
-    telemetry_view.set_values([
+    telemetry_view_dirty_rects = telemetry_view.set_values([
         f"{T.VehicleLocationX:.04f}",
         f"{T.VehicleLocationY:.04f}",
         f"{T.VehicleSpeed:.04f}",
         f"{T.ControlBrake:.04f}",
-        f"{T.MPPIFilterComputationTime:.04f}"
+        f"{T.MPPIFilterComputationTime:.04f}",
+        f"{T.MPPITotalTimeP50:.04f}",
+        f"{T.MPPITotalTimeP99:.04f}"
     ])
-    # 画面描画
-    screen.fill((0, 0, 0))
-    if vehicle_camera.image_array is not None:
-        surface = pygame.surfarray.make_surface(vehicle_camera.image_array.swapaxes(0, 1))
-        vehicle_camera_view.blit(surface, (0, 0))
-    screen.blit(vehicle_camera_view, (0, 0))
-    screen.blit(command_view.surface, (1300, 500))
-    screen.blit(telemetry_view.surface, (200, 500))
-    pygame.display.flip()
+    # 画面描画：新しい車載カメラの画像が届いた時は全体を，それ以外はGUIの変わった所だけを描き直す
+    camera_frame = vehicle_camera.get_new_frame()
+    if camera_frame is not None:
+        # BGRAのバッファを複写せずにSurfaceとして包んで描き写す
+        screen.blit(pygame.image.frombuffer(camera_frame, vehicle_camera_size, "BGRA"), (0, 0))
+        screen.blit(command_view.surface, (1300, 500))
+        screen.blit(telemetry_view.surface, (200, 500))
+        pygame.display.flip()
+        if is_frame_recording:
+            get_frame_recorder().submit(camera_frame, game_step)
+    else:
+        pygame.display.update(
+            blit_dirty(screen, command_view.surface, (1300, 500), command_view_dirty_rects)
+            + blit_dirty(screen, telemetry_view.surface, (200, 500), telemetry_view_dirty_rects)
+        )
 
     # G29の丸ボタンを押したらテレメトリを記録・保存するようにする
     if g29.is_triggered(g29.Button.Circle):
         is_telemetry_recording = not is_telemetry_recording
         print("Recording Telemetry:", is_telemetry_recording)
+        if is_telemetry_recording and telemetry_recorder is None:
+            telemetry_recorder = TelemetryRecorder(
+                directory=Path(f"Records/{session_id}"),
+                trajectory_width=mppi_filter.horizon
+            )
 
     # テレメトリを記録する
     if is_telemetry_recording:
-        telemetry_history.append(T)
+        telemetry_recorder.append(T)
 
     for event in pygame.event.get():
         if event.type == pygame.KEYUP:
             # スペースキーを押したら車カメラを保存する
             if event.key == pygame.K_SPACE:
-                vehicle_camera.take_screenshot_async(save_to=Path(f"Records/{session_id}.{game_step}.pkl"))
+                camera_frame = vehicle_camera.get_current_frame()
+                if camera_frame is not None and not is_frame_recording:
+                    get_frame_recorder().submit(camera_frame, game_step)
+            # Rキーを押したら車カメラの連続記録を切り替える
+            if event.key == pygame.K_r:
+                is_frame_recording = not is_frame_recording
+                print("Recording Camera Frames:", is_frame_recording)
         if event.type == pygame.QUIT:# 終了確認
             gaming = False
 
+# MPPI介入制御器のスレッドを止める
+if mppi_runner is not None:
+    mppi_runner.shutdown()
+# CARLAの世界を非同期モードに戻す
+stepping_driver.stop()
 # CARLAの世界から物を消す
 vehicle.destroy()
 vehicle_camera.destroy()
+if frame_recorder is not None:
+    frame_recorder.close()
+    print("Camera Frames Written:", frame_recorder.written_frames, "Dropped:", frame_recorder.dropped_frames)
 if obstacle_actor is not None:
     obstacle_actor.destroy()
 # G29筐体との通信を遮断する
@@ -262,9 +341,14 @@ lsw.shutdown()
 # PyGameを終了する
 pygame.quit()
 
+# MPPI介入制御器の処理段階ごとの処理時間を表示する
+if mppi_profiler is not None:
+    for stage, summary in mppi_profiler.get_summary().items():
+        print(f"MPPI {stage:<10} p50: {summary['p50'] * 1e3:.3f} ms, p99: {summary['p99'] * 1e3:.3f} ms")
+
 # テレメトリを保存する
-if telemetry_history:
-    df = DataFrame(telemetry_history)
-    df.to_csv(Path(f"Records/{session_id}.csv"))
+if telemetry_recorder is not None:
+    telemetry_recorder.close()
+    telemetry_recorder.export_csv(Path(f"Records/{session_id}.csv"))
 
 exit(0)
\ No newline at end of file
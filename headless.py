@@ -0,0 +1,338 @@
+"""
+CARLAやPyGame，G29無しで，MPPI介入制御器を多数のシナリオで試す．
+
+    uv run headless.py --scenarios 1000
+    uv run headless.py --scenarios 1000 --noise-std 0.02 --mismatch 0.1 --save Records/headless.json
+
+CARLAの代わりに`VehicleModel`を制御対象（プラント）にし，G29の代わりに`ScriptedVehicleController`で運転する．
+制御の流れはgaming.pyと同じで，ノミナル入力をMPPI介入制御器に通してからプラントへ与える．
+プラントには，内部モデルとの食い違い（ホイールベースのずれ）とノイズを与えられる．
+シナリオはプロセスプールで並列に実行し，結果をまとめて表示する．
+"""
+# 標準
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict, field
+from math import sin, pi
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+
+# サードパーティー
+import click
+import numpy as np
+from numpy import percentile
+
+# 自プロジェクト
+from vehiclemodel import VehicleModel, RolloutBackend, DEFAULT_FRAMETIME, DEFAULT_WHEELBASE
+from vehiclecontrollers import ScriptedVehicleController
+from mppi import MPPIFilter, FilteringFlow, DiagnosticsLevel
+from keepoutareas import MovingCircleKeepoutAreas, CircleKeepoutArea
+
+
+@dataclass
+class SteerScript:
+    """時刻tにおけるステアリング入力をoffset + amplitude * sin(2π frequency t)とする運転．"""
+    offset: float = 0.
+    amplitude: float = 0.
+    frequency: float = 0.
+
+    def __call__(self, t: float) -> float:
+        return self.offset + self.amplitude * sin(2 * pi * self.frequency * t)
+
+
+@dataclass
+class SteerTrace:
+    """記録したステアリング入力を，frame_timeごとに順に再生する運転．記録が尽きたら最後の値を保つ．"""
+    steers: list[float]
+    frame_time: float = DEFAULT_FRAMETIME
+
+    def __call__(self, t: float) -> float:
+        return self.steers[min(max(round(t / self.frame_time), 0), len(self.steers) - 1)]
+
+
+@dataclass
+class Scenario:
+    """1回のシミュレーションの条件を記述する．プロセス間で受け渡せるよう，値だけを持つ．"""
+    name: str
+    seed: int
+    speed: float
+    steps: int
+    steer_script: SteerScript | SteerTrace
+    # 障害物ごとの(x, y, 半径, x方向の速度, y方向の速度)
+    obstacles: list[tuple[float, float, float, float, float]] = field(default_factory=list)
+    # プラントのホイールベースを内部モデルの(1 + mismatch)倍にする
+    mismatch: float = 0.
+    # プラントのステアリング入力と向きに加える正規分布ノイズの標準偏差
+    noise_std: float = 0.
+    # 車の初期状態．速度はspeedで一定
+    initial_x: float = 0.
+    initial_y: float = 0.
+    initial_direction: float = 0.
+    # MPPI介入制御器の設定
+    samplesize: int = 512
+    horizon: int = 50
+    command_std: float = 0.7
+    temperature: float = 1.0
+    violation_weight_decay: float = 0.90
+
+
+@dataclass
+class ScenarioResult:
+    """1回のシミュレーションの結果を記述する．"""
+    name: str
+    seed: int
+    collided: bool
+    # プラントの位置から障害物の縁までの最小の距離[m]
+    min_clearance: float
+    intervention_ratio: float
+    # ノミナル入力とフィルタされた入力の差の絶対値の平均
+    mean_steer_deviation: float
+    computation_time_p50: float
+    computation_time_p99: float
+    wall_time: float
+    # ステップごとの処理時間[s]．シナリオをまたいで分布をまとめるのに使う．JSONには保存しない
+    computation_times: Optional[np.ndarray] = None
+
+
+def create_mppi_filter(
+        samplesize: int,
+        horizon: int,
+        rng: np.random.Generator,
+        command_std: float = 0.7,
+        temperature: float = 1.0,
+        violation_weight_decay: float = 0.90
+) -> MPPIFilter:
+    """gaming.pyと同じ設定のMPPI介入制御器を作る．"""
+    return MPPIFilter(
+        vehiclemodel=VehicleModel(rollout_backend=RolloutBackend.Cumsum),
+        samplesize=samplesize,
+        horizon=horizon,
+        command_std=command_std,
+        temperature=temperature,
+        violation_weight_decay=violation_weight_decay,
+        preallocate=True,
+        diagnostics=DiagnosticsLevel.Nothing,
+        use_arc_check=True,
+        rng=rng
+    )
+
+
+# 時間を測り始める前に，MPPI介入制御器を空で呼んでおく回数
+WARMUP_STEPS = 5
+
+
+def warm_up(mppi_filter: MPPIFilter, speed: float):
+    """
+    作ったばかりのMPPI介入制御器の最初の数回の呼び出しは，配列への初めての書き込みなどで遅いので，
+    時間を測る前に車の正面に仮の立ち入り禁止領域を置き，介入する経路を数回通しておく．
+    ステアリング入力候補を与えるので乱数は使わず，シナリオの結果は変わらない．
+    """
+    reach = speed * mppi_filter.horizon * mppi_filter.vehiclemodel.frame_time
+    handle = mppi_filter.add_keepoutarea(CircleKeepoutArea(0.5 * reach, 0., 2.))
+    commands_list = np.zeros((mppi_filter.samplesize, mppi_filter.horizon), dtype=mppi_filter.dtype)
+    for _ in range(WARMUP_STEPS):
+        mppi_filter.get_filtered_command(0., 0., 0., speed, 0., commands_list=commands_list)
+    mppi_filter.remove_keepoutarea(handle)
+    mppi_filter.previous_optimal_command = 0.
+
+
+def run_scenario(scenario: Scenario) -> ScenarioResult:
+    """シナリオを1つ，実時間を待たずに最後まで実行する．"""
+    started_at = perf_counter()
+    rng = np.random.default_rng(scenario.seed)
+    mppi_filter = create_mppi_filter(
+        scenario.samplesize, scenario.horizon, rng,
+        scenario.command_std, scenario.temperature, scenario.violation_weight_decay
+    )
+    nominal_controller = ScriptedVehicleController(
+        steer_script=scenario.steer_script, throttle=0.3, frame_time=DEFAULT_FRAMETIME
+    )
+    plant = VehicleModel(wheelbase=DEFAULT_WHEELBASE * (1. + scenario.mismatch))
+    plant.set_speed(scenario.speed)
+
+    obstacles = np.array(scenario.obstacles, dtype=float).reshape(-1, 5)
+    obstacle_x = obstacles[:, 0].copy()
+    obstacle_y = obstacles[:, 1].copy()
+    obstacle_radius = obstacles[:, 2]
+    obstacle_velocity_x = obstacles[:, 3]
+    obstacle_velocity_y = obstacles[:, 4]
+    keepoutareas = MovingCircleKeepoutAreas(obstacle_x, obstacle_y, obstacle_radius)
+    warm_up(mppi_filter, scenario.speed)
+    if obstacles.shape[0] > 0:
+        mppi_filter.set_keepoutareas([keepoutareas])
+
+    x, y, direction = scenario.initial_x, scenario.initial_y, scenario.initial_direction
+    min_clearance = np.inf
+    n_interventions = 0
+    steer_deviation = 0.
+    computation_times = np.empty(scenario.steps)
+    for step in range(scenario.steps):
+        keepoutareas.set_states(obstacle_x, obstacle_y, obstacle_velocity_x, obstacle_velocity_y)
+
+        # 制御入力を作る
+        nominal_controller.tick()
+        nominal_steer = nominal_controller.get_vehicle_control().steer
+        start = perf_counter()
+        mppi_result = mppi_filter.get_filtered_command(
+            initial_location_x=x,
+            initial_location_y=y,
+            initial_direction=direction,
+            initial_speed=scenario.speed,
+            nominal_command=nominal_steer,
+        )
+        computation_times[step] = perf_counter() - start
+        filtered_steer = mppi_result.filtered_command
+        n_interventions += mppi_result.flow == FilteringFlow.Intervention
+        steer_deviation += abs(filtered_steer - nominal_steer)
+
+        # プラントを進める
+        applied_steer = filtered_steer
+        if scenario.noise_std > 0:
+            applied_steer += rng.normal(0., scenario.noise_std)
+        x, y, direction = plant.single_step(x, y, direction, applied_steer)
+        if scenario.noise_std > 0:
+            direction += rng.normal(0., scenario.noise_std * plant.speed_vts_div_wheelbase)
+        obstacle_x = obstacle_x + obstacle_velocity_x * DEFAULT_FRAMETIME
+        obstacle_y = obstacle_y + obstacle_velocity_y * DEFAULT_FRAMETIME
+
+        if obstacles.shape[0] > 0:
+            clearance = float((np.hypot(obstacle_x - x, obstacle_y - y) - obstacle_radius).min())
+            min_clearance = min(min_clearance, clearance)
+
+    return ScenarioResult(
+        name=scenario.name,
+        seed=scenario.seed,
+        collided=bool(min_clearance <= 0),
+        min_clearance=float(min_clearance),
+        intervention_ratio=n_interventions / scenario.steps,
+        mean_steer_deviation=steer_deviation / scenario.steps,
+        computation_time_p50=float(percentile(computation_times, 50)),
+        computation_time_p99=float(percentile(computation_times, 99)),
+        computation_times=computation_times,
+        wall_time=perf_counter() - started_at
+    )
+
+
+def generate_scenarios(
+        n_scenarios: int,
+        seed: int,
+        steps: int,
+        mismatch: float,
+        noise_std: float,
+        samplesize: int,
+        horizon: int
+) -> list[Scenario]:
+    """
+    原点からx軸の正の向きに走り出す車の前に障害物を置いたシナリオを作る．
+    障害物の3割ほどは車の進路を横切るように動く．運転は直進，蛇行，片寄りのいずれか．
+    """
+    rng = np.random.default_rng(seed)
+    scenarios = []
+    for i in range(n_scenarios):
+        speed = rng.uniform(8., 16.)
+        distance = rng.uniform(20., 40.)
+        radius = rng.uniform(2., 4.)
+        if rng.uniform() < 0.3:
+            # 車が着く頃に進路を横切る
+            velocity_y = rng.choice([-1., 1.]) * rng.uniform(2., 5.)
+            obstacle = (distance, -velocity_y * distance / speed, radius, 0., velocity_y)
+        else:
+            obstacle = (distance, rng.normal(0., 1.5), radius, 0., 0.)
+        kind = rng.choice(["straight", "weave", "drift"])
+        if kind == "weave":
+            steer_script = SteerScript(amplitude=rng.uniform(0.05, 0.3), frequency=rng.uniform(0.2, 1.))
+        elif kind == "drift":
+            steer_script = SteerScript(offset=rng.normal(0., 0.05))
+        else:
+            steer_script = SteerScript()
+        scenarios.append(Scenario(
+            name=f"{i:05d}/{kind}",
+            seed=int(rng.integers(2 ** 31)),
+            speed=speed,
+            steps=steps,
+            steer_script=steer_script,
+            obstacles=[obstacle],
+            mismatch=mismatch,
+            noise_std=noise_std,
+            samplesize=samplesize,
+            horizon=horizon
+        ))
+    return scenarios
+
+
+def run_scenarios(scenarios: list[Scenario], workers: int) -> list[ScenarioResult]:
+    """シナリオをプロセスプールで並列に実行する．workersが1ならこのプロセスで順に実行する．"""
+    if workers <= 1:
+        return [run_scenario(scenario) for scenario in scenarios]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_scenario, scenarios, chunksize=max(1, len(scenarios) // (workers * 4))))
+
+
+def summarize_results(results: list[ScenarioResult]) -> dict[str, float]:
+    min_clearances = np.array([result.min_clearance for result in results])
+    computation_times = np.concatenate([result.computation_times for result in results])
+    return {
+        "scenarios": len(results),
+        "collision_rate": float(np.mean([result.collided for result in results])),
+        "min_clearance_p1": float(percentile(min_clearances, 1)),
+        "min_clearance_p50": float(percentile(min_clearances, 50)),
+        "intervention_ratio_mean": float(np.mean([result.intervention_ratio for result in results])),
+        "steer_deviation_mean": float(np.mean([result.mean_steer_deviation for result in results])),
+        # 全シナリオの全ステップの処理時間をまとめたパーセンタイル
+        "computation_time_p50": float(percentile(computation_times, 50)),
+        "computation_time_p99": float(percentile(computation_times, 99)),
+    }
+
+
+def get_result_dict(result: ScenarioResult) -> dict:
+    """JSONに保存するため，ステップごとの処理時間を除いた辞書にする．"""
+    result_dict = asdict(result)
+    del result_dict["computation_times"]
+    return result_dict
+
+
+@click.command()
+@click.option("--scenarios", "n_scenarios", type=int, default=200, show_default=True)
+@click.option("--workers", type=int, default=os.cpu_count(), show_default=True)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--steps", type=int, default=150, show_default=True, help="1シナリオのステップ数．")
+@click.option("--mismatch", type=float, default=0., show_default=True, help="プラントのホイールベースのずれの割合．")
+@click.option("--noise-std", type=float, default=0., show_default=True, help="プラントに加えるノイズの標準偏差．")
+@click.option("--samplesize", type=int, default=512, show_default=True)
+@click.option("--horizon", type=int, default=50, show_default=True)
+@click.option("--save", "save_to", type=click.Path(path_type=Path), default=None,
+              help="まとめた結果とシナリオごとの結果をJSONで保存する．")
+def main(n_scenarios, workers, seed, steps, mismatch, noise_std, samplesize, horizon, save_to):
+    scenarios = generate_scenarios(n_scenarios, seed, steps, mismatch, noise_std, samplesize, horizon)
+    start = perf_counter()
+    results = run_scenarios(scenarios, workers)
+    elapsed = perf_counter() - start
+    summary = summarize_results(results)
+
+    for key, value in summary.items():
+        print(f"{key:<28} {value:.6g}")
+    simulated_time = n_scenarios * steps * DEFAULT_FRAMETIME
+    print(f"{'realtime_factor':<28} {simulated_time / elapsed:.6g}")
+
+    if save_to is not None:
+        save_to.parent.mkdir(parents=True, exist_ok=True)
+        save_to.write_text(json.dumps({
+            "settings": {
+                "scenarios": n_scenarios,
+                "seed": seed,
+                "steps": steps,
+                "mismatch": mismatch,
+                "noise_std": noise_std,
+                "samplesize": samplesize,
+                "horizon": horizon,
+            },
+            "summary": summary,
+            "results": [get_result_dict(result) for result in results]
+        }, indent=2))
+        print("Saved Headless Results to", save_to)
+
+
+if __name__ == "__main__":
+    main()
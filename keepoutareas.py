@@ -1,10 +1,18 @@
-from typing import TypeVar
+from typing import TypeVar, Optional, Literal
 from abc import ABC, abstractmethod
+from math import ceil, hypot
+from numpy import ndarray, subtract, square, add, sqrt
+from numpy import asarray, concatenate, maximum, minimum, clip, where, errstate, full, zeros_like, arange, meshgrid, rint, floor, intp
+from numpy import dtype, float64, newaxis
+from vehiclemodel import ConstantCommandArc
 
 T = TypeVar("T")
 
 
 class KeepoutArea(ABC):
+    # 時間とともに動く領域ではTrueにする．その場合，`check_at_steps`などで予測ステップごとに判定される
+    is_time_varying = False
+
     @abstractmethod
     def check(self, x: T, y: T) -> T:
         """
@@ -13,13 +21,442 @@ class KeepoutArea(ABC):
         """
         pass
 
+    def check_into(self, x: ndarray, y: ndarray, out: ndarray, work: ndarray) -> ndarray:
+        """
+        `check`と同じ値をoutへ書き込んで返す．
+        workはx,yと同じ形の作業用配列で，中身は壊してよい．
+        配列を確保したくない派生クラスはこれを上書きすること．
+        """
+        out[...] = self.check(x, y)
+        return out
+
+    def prepare_for_filtering(self, horizon: int, frame_time: float):
+        """
+        MPPI介入制御器の計算の前に1回だけ呼ばれる．`is_time_varying`がTrueの領域だけが呼ばれる．
+        動く領域は，ここで予測ホライズン分の自身の動きを予測しておくこと．
+        """
+        pass
+
+    def check_at_steps(self, x: T, y: T, steps: ndarray | int) -> T:
+        """
+        予測ステップstepsにおけるこの領域に対して`check`と同じ値を返す．
+        stepsは予測ステップ番号の整数配列で，x,yにブロードキャストできる形をしている．
+        既定では動かない領域と見なし，stepsを無視して`check`の値を返す．
+        """
+        return self.check(x, y)
+
+    def check_at_steps_into(self, x: ndarray, y: ndarray, steps: ndarray, out: ndarray, work: ndarray) -> ndarray:
+        """
+        `check_at_steps`と同じ値をoutへ書き込んで返す．既定ではstepsを無視して`check_into`を呼ぶ．
+        """
+        return self.check_into(x, y, out=out, work=work)
+
+    def get_clearance(self, x: T, y: T) -> T:
+        """
+        x,yから立ち入り禁止領域までの余裕を返す．立ち入り禁止領域に入っていたら負になる．
+        距離として意味のある値を返せる派生クラスは，これを上書きすること．既定では`check`の値をそのまま返す．
+        """
+        return self.check(x, y)
+
+    def get_clearance_at_steps(self, x: T, y: T, steps: ndarray | int) -> T:
+        """
+        予測ステップstepsにおけるこの領域に対して`get_clearance`と同じ値を返す．既定ではstepsを無視する．
+        """
+        return self.get_clearance(x, y)
+
+    def get_arc_clearance(self, arc: ConstantCommandArc) -> Optional[float]:
+        """
+        速度とステアリング入力が一定の時の予測軌道（円弧）から，立ち入り禁止領域までの最小の余裕を閉じた式で返す．
+        円弧が立ち入り禁止領域に触れていれば0以下になるように．
+        閉じた式で求められない派生クラスはNoneを返す．その場合，予測軌道を予測ステップごとに求めて`check`で判定する．
+        """
+        return None
+
+    def get_bounding_circle(self) -> Optional[tuple[float, float, float]]:
+        """
+        この立ち入り禁止領域を包む円を(中心x，中心y，半径)で返す．
+        `KeepoutAreaIndex`による枝刈りに使われる．
+        包む円が定義できない領域ではNoneを返すように．その場合，枝刈りの対象外になる．
+        """
+        return None
+
 
 class CircleKeepoutArea(KeepoutArea):
     def __init__(self, x: float, y: float, radius: float):
         self.x = x
         self.y = y
+        self.radius = radius
         self.radius_2 = radius ** 2
 
     def check(self, x: T, y: T) -> T:
         to_margin_2 = (self.x - x) ** 2 + (self.y - y) ** 2 - self.radius_2
         return to_margin_2
+
+    def check_into(self, x: ndarray, y: ndarray, out: ndarray, work: ndarray) -> ndarray:
+        subtract(self.x, x, out=out)
+        square(out, out=out)
+        subtract(self.y, y, out=work)
+        square(work, out=work)
+        add(out, work, out=out)
+        subtract(out, self.radius_2, out=out)
+        return out
+
+    def get_clearance(self, x: T, y: T) -> T:
+        """円の縁までの距離を返す．"""
+        return sqrt((self.x - x) ** 2 + (self.y - y) ** 2) - self.radius
+
+    def get_arc_clearance(self, arc: ConstantCommandArc) -> Optional[float]:
+        return arc.get_min_distance(self.x, self.y) - self.radius
+
+    def get_bounding_circle(self) -> Optional[tuple[float, float, float]]:
+        return self.x, self.y, self.radius
+
+
+class SignedDistanceShape(ABC):
+    """`GridKeepoutArea`へ書き込む図形．"""
+
+    @abstractmethod
+    def get_signed_distance(self, x: ndarray, y: ndarray) -> ndarray:
+        """図形の縁までの距離を，図形の内側では負，外側では正にして返す．"""
+        pass
+
+    @abstractmethod
+    def get_bounds(self) -> tuple[float, float, float, float]:
+        """図形を包む矩形を(最小x，最小y，最大x，最大y)で返す．"""
+        pass
+
+
+class CircleShape(SignedDistanceShape):
+    def __init__(self, x: float, y: float, radius: float):
+        self.x = x
+        self.y = y
+        self.radius = radius
+
+    def get_signed_distance(self, x: ndarray, y: ndarray) -> ndarray:
+        return sqrt((self.x - x) ** 2 + (self.y - y) ** 2) - self.radius
+
+    def get_bounds(self) -> tuple[float, float, float, float]:
+        return self.x - self.radius, self.y - self.radius, self.x + self.radius, self.y + self.radius
+
+
+def get_distance_to_segments(x: ndarray, y: ndarray, vertices: ndarray) -> ndarray:
+    """点(x,y)から，verticesを順に結んだ折れ線までの最短距離を返す．x,yはベクトル，verticesは（頂点の数，2）．"""
+    start = vertices[:-1]
+    end = vertices[1:]
+    direction = end - start
+    length_2 = maximum((direction ** 2).sum(axis=1), 1e-12)
+    # （点の数，線分の数）
+    to_x = x[:, None] - start[None, :, 0]
+    to_y = y[:, None] - start[None, :, 1]
+    along = clip((to_x * direction[None, :, 0] + to_y * direction[None, :, 1]) / length_2[None, :], 0., 1.)
+    distance_x = to_x - along * direction[None, :, 0]
+    distance_y = to_y - along * direction[None, :, 1]
+    return sqrt(distance_x ** 2 + distance_y ** 2).min(axis=1)
+
+
+class PolygonShape(SignedDistanceShape):
+    def __init__(self, vertices: ndarray):
+        """verticesは（頂点の数，2）．最後の頂点と最初の頂点は自動で結ばれる．"""
+        vertices = asarray(vertices, dtype=float)
+        self.vertices = vertices
+        self.closed_vertices = concatenate([vertices, vertices[:1]])
+
+    def get_signed_distance(self, x: ndarray, y: ndarray) -> ndarray:
+        distance = get_distance_to_segments(x, y, self.closed_vertices)
+        # 点から右へ伸ばした半直線が辺と交わる回数が奇数なら内側
+        start = self.closed_vertices[:-1]
+        end = self.closed_vertices[1:]
+        straddles = (start[None, :, 1] > y[:, None]) != (end[None, :, 1] > y[:, None])
+        with errstate(divide="ignore", invalid="ignore"):
+            crossing_x = start[None, :, 0] + (y[:, None] - start[None, :, 1]) \
+                         * (end[None, :, 0] - start[None, :, 0]) / (end[None, :, 1] - start[None, :, 1])
+        crossings = (straddles & (x[:, None] < crossing_x)).sum(axis=1)
+        return where(crossings % 2 == 1, -distance, distance)
+
+    def get_bounds(self) -> tuple[float, float, float, float]:
+        min_x, min_y = self.vertices.min(axis=0)
+        max_x, max_y = self.vertices.max(axis=0)
+        return min_x, min_y, max_x, max_y
+
+
+class PolylineShape(SignedDistanceShape):
+    def __init__(self, vertices: ndarray, half_width: float):
+        """verticesを順に結んだ折れ線を，half_widthだけ太らせた図形．地図上の線などを表す．"""
+        self.vertices = asarray(vertices, dtype=float)
+        self.half_width = half_width
+
+    def get_signed_distance(self, x: ndarray, y: ndarray) -> ndarray:
+        return get_distance_to_segments(x, y, self.vertices) - self.half_width
+
+    def get_bounds(self) -> tuple[float, float, float, float]:
+        min_x, min_y = self.vertices.min(axis=0) - self.half_width
+        max_x, max_y = self.vertices.max(axis=0) + self.half_width
+        return min_x, min_y, max_x, max_y
+
+
+class GridKeepoutArea(KeepoutArea):
+    def __init__(
+            self,
+            min_x: float,
+            min_y: float,
+            max_x: float,
+            max_y: float,
+            resolution: float = 0.5,
+            truncation: float = 10.,
+            interpolation: Literal["bilinear", "nearest"] = "bilinear",
+            dtype: dtype = float64
+    ):
+        """
+        格子状に前もって計算した符号付き距離場で表す立ち入り禁止領域．
+        円，多角形，折れ線などの図形をいくつ書き込んでも，`check`の1点あたりの計算量は変わらない．
+
+        距離場は各図形の符号付き距離の最小値で，絶対値がtruncationを超える所はtruncationで打ち切る．
+        そのため，図形を書き込んだり消したりした時は，その図形の周りtruncationの範囲の格子点だけを計算し直せばよい．
+        格子の外側は立ち入り禁止ではない（truncationを返す）．
+
+        Parameters
+        ----------
+        min_x:float
+        min_y:float
+        max_x:float
+        max_y:float
+            格子の範囲．
+        resolution:float
+            格子点の間隔．
+        truncation:float
+            距離場を打ち切る距離．
+        interpolation:Literal["bilinear","nearest"]
+            格子点の間の値の求め方．
+        dtype:dtype
+            距離場と`check`の返り値の浮動小数点の型．MPPI介入制御器の型に合わせる．
+        """
+        self.min_x = min_x
+        self.min_y = min_y
+        self.resolution = resolution
+        self.inv_resolution = 1. / resolution
+        self.truncation = truncation
+        self.interpolation = interpolation
+        self.n_x = int(ceil((max_x - min_x) * self.inv_resolution)) + 1
+        self.n_y = int(ceil((max_y - min_y) * self.inv_resolution)) + 1
+        self.max_x = min_x + (self.n_x - 1) * resolution
+        self.max_y = min_y + (self.n_y - 1) * resolution
+        # distance_field[i, j]は格子点(min_x + i * resolution, min_y + j * resolution)における値
+        self.distance_field = full((self.n_x, self.n_y), truncation, dtype=dtype)
+        self.dtype = self.distance_field.dtype
+        self.shapes: dict[int, SignedDistanceShape] = {}
+        self.next_handle = 0
+
+    def add_shape(self, shape: SignedDistanceShape) -> int:
+        """図形を書き込み，後で消す時に使うハンドルを返す．"""
+        handle = self.next_handle
+        self.next_handle += 1
+        self.shapes[handle] = shape
+        window = self.get_window(shape)
+        if window is not None:
+            self.distance_field[window] = minimum(self.distance_field[window], self.rasterize(shape, window))
+        return handle
+
+    def add_circle(self, x: float, y: float, radius: float) -> int:
+        return self.add_shape(CircleShape(x, y, radius))
+
+    def add_polygon(self, vertices: ndarray) -> int:
+        return self.add_shape(PolygonShape(vertices))
+
+    def add_polyline(self, vertices: ndarray, half_width: float) -> int:
+        return self.add_shape(PolylineShape(vertices, half_width))
+
+    def remove_shape(self, handle: int):
+        """図形を消し，その周りの格子点だけを残りの図形から計算し直す．"""
+        shape = self.shapes.pop(handle)
+        window = self.get_window(shape)
+        if window is None:
+            return
+        self.distance_field[window] = self.truncation
+        window_bounds = self.get_window_bounds(window)
+        for other in self.shapes.values():
+            if self.overlaps(self.get_expanded_bounds(other), window_bounds):
+                self.distance_field[window] = minimum(self.distance_field[window], self.rasterize(other, window))
+
+    def get_expanded_bounds(self, shape: SignedDistanceShape) -> tuple[float, float, float, float]:
+        """図形の距離場が打ち切られずに残る範囲を返す．"""
+        min_x, min_y, max_x, max_y = shape.get_bounds()
+        return min_x - self.truncation, min_y - self.truncation, max_x + self.truncation, max_y + self.truncation
+
+    @staticmethod
+    def overlaps(a: tuple[float, float, float, float], b: tuple[float, float, float, float]) -> bool:
+        return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+    def get_window(self, shape: SignedDistanceShape) -> Optional[tuple[slice, slice]]:
+        """図形の影響が及ぶ格子点の範囲を返す．格子と重ならなければNoneを返す．"""
+        min_x, min_y, max_x, max_y = self.get_expanded_bounds(shape)
+        i_start = max(int(floor((min_x - self.min_x) * self.inv_resolution)), 0)
+        j_start = max(int(floor((min_y - self.min_y) * self.inv_resolution)), 0)
+        i_stop = min(int(ceil((max_x - self.min_x) * self.inv_resolution)) + 1, self.n_x)
+        j_stop = min(int(ceil((max_y - self.min_y) * self.inv_resolution)) + 1, self.n_y)
+        if i_start >= i_stop or j_start >= j_stop:
+            return None
+        return slice(i_start, i_stop), slice(j_start, j_stop)
+
+    def get_window_bounds(self, window: tuple[slice, slice]) -> tuple[float, float, float, float]:
+        return (
+            self.min_x + window[0].start * self.resolution,
+            self.min_y + window[1].start * self.resolution,
+            self.min_x + (window[0].stop - 1) * self.resolution,
+            self.min_y + (window[1].stop - 1) * self.resolution,
+        )
+
+    def rasterize(self, shape: SignedDistanceShape, window: tuple[slice, slice]) -> ndarray:
+        """範囲内の格子点における図形の符号付き距離を，truncationで打ち切って返す．"""
+        grid_x = self.min_x + arange(window[0].start, window[0].stop) * self.resolution
+        grid_y = self.min_y + arange(window[1].start, window[1].stop) * self.resolution
+        x, y = meshgrid(grid_x, grid_y, indexing="ij")
+        signed_distance = shape.get_signed_distance(x.ravel(), y.ravel()).reshape(x.shape)
+        return clip(signed_distance, -self.truncation, self.truncation)
+
+    def check(self, x: T, y: T) -> T:
+        """格子から距離場の値を読み出す．値は立ち入り禁止領域の縁までの距離[m]で，内側では負になる．"""
+        x = asarray(x)
+        y = asarray(y)
+        grid_x = (x - self.min_x) * self.inv_resolution
+        grid_y = (y - self.min_y) * self.inv_resolution
+        is_inside_grid = (grid_x >= 0) & (grid_x <= self.n_x - 1) & (grid_y >= 0) & (grid_y <= self.n_y - 1)
+        field = self.distance_field.ravel()
+        if self.interpolation == "nearest":
+            i = clip(rint(grid_x), 0, self.n_x - 1).astype(intp)
+            j = clip(rint(grid_y), 0, self.n_y - 1).astype(intp)
+            value = field.take(i * self.n_y + j)
+        else:
+            # 整数に変換する前の格子点から端数を求め，xの型のまま計算する
+            i = clip(floor(grid_x), 0, self.n_x - 2)
+            j = clip(floor(grid_y), 0, self.n_y - 2)
+            tx = grid_x - i
+            ty = grid_y - j
+            i = i.astype(intp)
+            j = j.astype(intp)
+            index = i * self.n_y + j
+            value = (field.take(index) * (1 - tx) + field.take(index + self.n_y) * tx) * (1 - ty) \
+                    + (field.take(index + 1) * (1 - tx) + field.take(index + self.n_y + 1) * tx) * ty
+        return where(is_inside_grid, value, self.truncation).astype(self.dtype, copy=False)
+
+    def get_bounding_circle(self) -> Optional[tuple[float, float, float]]:
+        return (
+            (self.min_x + self.max_x) / 2,
+            (self.min_y + self.max_y) / 2,
+            hypot(self.max_x - self.min_x, self.max_y - self.min_y) / 2
+        )
+
+
+class MovingCircleKeepoutAreas(KeepoutArea):
+    is_time_varying = True
+
+    def __init__(
+            self,
+            x: ndarray,
+            y: ndarray,
+            radius: ndarray,
+            velocity_x: Optional[ndarray] = None,
+            velocity_y: Optional[ndarray] = None,
+            dtype: dtype = float64
+    ):
+        """
+        動く円形の立ち入り禁止領域をまとめて表す．他の車や人など，動く障害物を表す．
+        各円は等速直線運動をすると見なし，`prepare_for_filtering`で予測ホライズン分の中心の位置を
+        （ホライズン+1，円の数）の配列にまとめて予測しておく．
+        判定では，予測軌道の各点をその予測ステップにおける全ての円と1回のブロードキャストで比べる．
+
+        位置と速度は`set_states`で毎フレーム更新する．
+        別スレッドのMPPI介入制御器から読まれても位置と速度の組が食い違わないよう，組にまとめて差し替える．
+
+        Parameters
+        ----------
+        x:ndarray
+        y:ndarray
+            円の中心の現在位置．（円の数，）の形式．
+        radius:ndarray
+            円の半径．（円の数，）の形式．
+        velocity_x:Optional[ndarray]=None
+        velocity_y:Optional[ndarray]=None
+            円の中心の速度[m/s]．省略すると止まっていると見なす．
+        dtype:dtype
+            `check`と`check_at_steps`の返り値の浮動小数点の型．MPPI介入制御器の型に合わせる．
+            位置の予測と距離の計算はfloat64で行う．
+        """
+        self.dtype = dtype
+        self.radius = asarray(radius, dtype=float)
+        self.radius_2 = self.radius ** 2
+        self.set_states(x, y, velocity_x, velocity_y)
+        self.predicted_x: Optional[ndarray] = None
+        self.predicted_y: Optional[ndarray] = None
+        # 予測した時の状態と設定．同じなら予測し直さない
+        self.predicted_for: Optional[tuple] = None
+
+    def set_states(
+            self,
+            x: ndarray,
+            y: ndarray,
+            velocity_x: Optional[ndarray] = None,
+            velocity_y: Optional[ndarray] = None
+    ):
+        x = asarray(x, dtype=float)
+        y = asarray(y, dtype=float)
+        velocity_x = zeros_like(x) if velocity_x is None else asarray(velocity_x, dtype=float)
+        velocity_y = zeros_like(y) if velocity_y is None else asarray(velocity_y, dtype=float)
+        self.states = (x, y, velocity_x, velocity_y)
+
+    @property
+    def x(self) -> ndarray:
+        return self.states[0]
+
+    @property
+    def y(self) -> ndarray:
+        return self.states[1]
+
+    @property
+    def velocity_x(self) -> ndarray:
+        return self.states[2]
+
+    @property
+    def velocity_y(self) -> ndarray:
+        return self.states[3]
+
+    def prepare_for_filtering(self, horizon: int, frame_time: float):
+        states = self.states
+        predicted_for = (states, horizon, frame_time)
+        if self.predicted_for is not None and all(a is b for a, b in zip(self.predicted_for, predicted_for)):
+            return
+        x, y, velocity_x, velocity_y = states
+        times = arange(horizon + 1)[:, newaxis] * frame_time  # （ホライズン+1，1）
+        self.predicted_x = x[newaxis, :] + velocity_x[newaxis, :] * times  # （ホライズン+1，円の数）
+        self.predicted_y = y[newaxis, :] + velocity_y[newaxis, :] * times
+        self.predicted_for = predicted_for
+
+    def get_squared_distances(self, x: T, y: T, steps: ndarray | int) -> ndarray:
+        """x,yと予測ステップstepsにおける各円の中心との距離の2乗を，最後の軸に円を並べて返す．"""
+        center_x = self.predicted_x[steps]  # （stepsの形，円の数）
+        center_y = self.predicted_y[steps]
+        x = asarray(x)[..., newaxis]
+        y = asarray(y)[..., newaxis]
+        return square(x - center_x) + square(y - center_y)
+
+    def check(self, x: T, y: T) -> T:
+        """現在の位置の円に対して判定する．"""
+        center_x, center_y, _, _ = self.states
+        x = asarray(x)[..., newaxis]
+        y = asarray(y)[..., newaxis]
+        return (square(x - center_x) + square(y - center_y) - self.radius_2).min(axis=-1).astype(self.dtype, copy=False)
+
+    def check_at_steps(self, x: T, y: T, steps: ndarray | int) -> T:
+        return (self.get_squared_distances(x, y, steps) - self.radius_2).min(axis=-1).astype(self.dtype, copy=False)
+
+    def check_at_steps_into(self, x: ndarray, y: ndarray, steps: ndarray, out: ndarray, work: ndarray) -> ndarray:
+        out[...] = self.check_at_steps(x, y, steps)
+        return out
+
+    def get_clearance(self, x: T, y: T) -> T:
+        center_x, center_y, _, _ = self.states
+        x = asarray(x)[..., newaxis]
+        y = asarray(y)[..., newaxis]
+        return (sqrt(square(x - center_x) + square(y - center_y)) - self.radius).min(axis=-1)
+
+    def get_clearance_at_steps(self, x: T, y: T, steps: ndarray | int) -> T:
+        return (sqrt(self.get_squared_distances(x, y, steps)) - self.radius).min(axis=-1)
@@ -0,0 +1,172 @@
+from typing import Optional
+from numpy import ndarray, sqrt, empty, flatnonzero
+from numpy import array as npa
+from scipy.spatial import cKDTree
+from keepoutareas import KeepoutArea
+
+
+class KeepoutAreaIndex:
+    def __init__(self, keepoutareas: list[KeepoutArea] = (), rebuild_threshold: int = 16):
+        """
+        立ち入り禁止領域の空間インデックス．
+        包む円を持つ立ち入り禁止領域はその中心をKD木に登録しておき，
+        車が予測ホライズン内に到達し得る円の外側にある領域を詳細な判定の前に取り除く．
+
+        立ち入り禁止領域は`add`，`update`，`remove`で1つずつ出し入れできる．
+        `add`が返すハンドルは，その領域を取り除くまで変わらない．
+        包む円の中心と半径は（スロットの数，2），（スロットの数，）の配列に詰めて持ち，変わったスロットだけを書き換える．
+        KD木は変わったスロットがrebuild_thresholdを超えるまで作り直さず，それまでは変わったスロットだけを総当たりで調べる．
+
+        Parameters
+        ----------
+        keepoutareas:list[KeepoutArea]
+            最初に登録する立ち入り禁止領域．
+        rebuild_threshold:int
+            KD木を作り直すまでに溜めておける，変わったスロットの数．
+        """
+        self.rebuild_threshold = rebuild_threshold
+        # 変更されるたびに増える
+        self.version = 0
+        self.next_handle = 0
+        self.keepoutareas_by_handle: dict[int, KeepoutArea] = {}
+
+        # 包む円を持たないもの（常に詳細な判定に回す）
+        self.unindexed_keepoutareas_by_handle: dict[int, KeepoutArea] = {}
+        # 包む円を持つもの（枝刈りの対象）．スロットごとに詰めて持つ
+        self.centers: ndarray = empty((0, 2))
+        self.radiuses: ndarray = empty(0)
+        self.slot_keepoutareas: list[Optional[KeepoutArea]] = []
+        self.slot_by_handle: dict[int, int] = {}
+        self.free_slots: list[int] = []
+
+        # KD木と，KD木を作った後に変わったスロット
+        self.tree: Optional[cKDTree] = None
+        self.tree_slots: ndarray = empty(0, dtype=int)
+        self.tree_max_radius = 0.
+        self.pending_slots: set[int] = set()
+
+        # `keepoutareas`の結果をversionごとに保持する
+        self.cached_version = -1
+        self.cached_keepoutareas: list[KeepoutArea] = []
+        self.cached_time_varying_keepoutareas: list[KeepoutArea] = []
+
+        for koa in keepoutareas:
+            self.add(koa)
+
+    @property
+    def keepoutareas(self) -> list[KeepoutArea]:
+        """登録されている全ての立ち入り禁止領域を，登録した順に返す．"""
+        self.refresh_cache()
+        return self.cached_keepoutareas
+
+    @property
+    def time_varying_keepoutareas(self) -> list[KeepoutArea]:
+        """登録されている立ち入り禁止領域のうち，時間とともに動くものを返す．"""
+        self.refresh_cache()
+        return self.cached_time_varying_keepoutareas
+
+    def refresh_cache(self):
+        if self.cached_version == self.version:
+            return
+        self.cached_keepoutareas = list(self.keepoutareas_by_handle.values())
+        self.cached_time_varying_keepoutareas = [koa for koa in self.cached_keepoutareas if koa.is_time_varying]
+        self.cached_version = self.version
+
+    def add(self, keepoutarea: KeepoutArea) -> int:
+        """立ち入り禁止領域を登録し，そのハンドルを返す．"""
+        handle = self.next_handle
+        self.next_handle += 1
+        self.assign(handle, keepoutarea)
+        self.version += 1
+        return handle
+
+    def update(self, handle: int, keepoutarea: KeepoutArea):
+        """ハンドルが指す立ち入り禁止領域を差し替える．同じオブジェクトの中身を変えた場合も呼ぶこと．"""
+        if handle not in self.keepoutareas_by_handle:
+            raise KeyError(f"Unknown Keepout Area Handle: {handle}")
+        self.release(handle)
+        self.assign(handle, keepoutarea)
+        self.version += 1
+
+    def remove(self, handle: int):
+        """ハンドルが指す立ち入り禁止領域を取り除く．"""
+        if handle not in self.keepoutareas_by_handle:
+            raise KeyError(f"Unknown Keepout Area Handle: {handle}")
+        self.release(handle)
+        del self.keepoutareas_by_handle[handle]
+        self.version += 1
+
+    def assign(self, handle: int, keepoutarea: KeepoutArea):
+        """立ち入り禁止領域をスロットに書き込む．"""
+        self.keepoutareas_by_handle[handle] = keepoutarea
+        bounding_circle = keepoutarea.get_bounding_circle()
+        if bounding_circle is None:
+            self.unindexed_keepoutareas_by_handle[handle] = keepoutarea
+            return
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            slot = len(self.slot_keepoutareas)
+            self.slot_keepoutareas.append(None)
+            if slot >= self.radiuses.shape[0]:
+                # 配列が足りなければ倍に広げる
+                capacity = max(2 * self.radiuses.shape[0], 8)
+                centers = empty((capacity, 2))
+                centers[:slot] = self.centers[:slot]
+                radiuses = empty(capacity)
+                radiuses[:slot] = self.radiuses[:slot]
+                self.centers = centers
+                self.radiuses = radiuses
+        center_x, center_y, radius = bounding_circle
+        self.centers[slot, 0] = center_x
+        self.centers[slot, 1] = center_y
+        self.radiuses[slot] = radius
+        self.slot_keepoutareas[slot] = keepoutarea
+        self.slot_by_handle[handle] = slot
+        self.pending_slots.add(slot)
+
+    def release(self, handle: int):
+        """立ち入り禁止領域をスロットから取り除く．ハンドルは残す．"""
+        if self.unindexed_keepoutareas_by_handle.pop(handle, None) is not None:
+            return
+        slot = self.slot_by_handle.pop(handle)
+        self.slot_keepoutareas[slot] = None
+        self.free_slots.append(slot)
+        self.pending_slots.add(slot)
+
+    def rebuild_tree(self):
+        """使われているスロットでKD木を作り直す．"""
+        used = npa([koa is not None for koa in self.slot_keepoutareas], dtype=bool)
+        self.tree_slots = flatnonzero(used)
+        if self.tree_slots.shape[0] == 0:
+            self.tree = None
+            self.tree_max_radius = 0.
+        else:
+            self.tree = cKDTree(self.centers[self.tree_slots])
+            self.tree_max_radius = float(self.radiuses[self.tree_slots].max())
+        self.pending_slots.clear()
+
+    def query(self, x: float, y: float, reach: float) -> list[KeepoutArea]:
+        """
+        点(x,y)から距離reach以内の点に入り込み得る立ち入り禁止領域を返す．
+        それ以外の領域は，距離reach以内のどの点を調べても立ち入り禁止と判定されないので，詳細な判定を省いてよい．
+        浮動小数点の丸めで判定が変わらないよう，境界にはわずかな余裕を持たせてある．
+        返す順番は`keepoutareas`の順番とは限らない．
+        """
+        if len(self.pending_slots) > self.rebuild_threshold:
+            self.rebuild_tree()
+        survivors = list(self.unindexed_keepoutareas_by_handle.values())
+        reach = reach * (1. + 1e-9) + 1e-6
+        candidates = set(self.pending_slots)
+        if self.tree is not None:
+            for i in self.tree.query_ball_point((x, y), r=reach + self.tree_max_radius):
+                candidates.add(int(self.tree_slots[i]))
+        for slot in sorted(candidates):
+            koa = self.slot_keepoutareas[slot]
+            if koa is None:
+                continue
+            dx = self.centers[slot, 0] - x
+            dy = self.centers[slot, 1] - y
+            if sqrt(dx * dx + dy * dy) <= reach + self.radiuses[slot]:
+                survivors.append(koa)
+        return survivors
@@ -1,11 +1,17 @@
-from vehiclemodel import VehicleModel
-from numpy import ndarray, exp, sum, zeros_like, bool_, square, exp, any
+from vehiclemodel import VehicleModel, RolloutWorkspace
+from numpy import ndarray, exp, sum, zeros_like, bool_, square, exp, any, zeros, broadcast_to, flatnonzero
+from numpy import log, inf, arange, full, float64, minimum
+from numpy import empty, ones, clip, subtract, divide, negative, less_equal, logical_or, copyto, matmul, dot
 from numpy import array as npa
-from numpy.random import randn
+from numpy import asarray
+from numpy.random import Generator, default_rng
 from enum import Enum
 from typing import Optional
 from dataclasses import dataclass
 from keepoutareas import KeepoutArea
+from keepoutindex import KeepoutAreaIndex
+from profiling import StageProfiler
+from samplers import CommandSampler, GaussianSampler
 
 
 class FilteringFlow(Enum):
@@ -18,6 +24,16 @@ class FilteringFlow(Enum):
     Intervention = "Intervention"
 
 
+class DiagnosticsLevel(Enum):
+    """MPPI介入制御器の出力に，どこまで付随情報を含めるかを記述する．"""
+    # フィルタされた入力とフィルタリングの種類だけを出力する．
+    Nothing = "Nothing"
+    # 加えて，最適入力列，立ち入り禁止領域までの最小余裕，有効サンプル数を制御器の内部で計算して出力する．
+    Summary = "Summary"
+    # 加えて，ステアリング入力候補，予測軌道，重みなどの大きな配列も出力する．
+    Full = "Full"
+
+
 @dataclass
 class MPPIFilterResult:
     """MPPI介入制御器の出力を記述する．"""
@@ -35,6 +51,63 @@ class MPPIFilterResult:
     y_history_list: Optional[ndarray] = None
     # 各ステアリング入力候補に対する重み
     sample_weights: Optional[ndarray] = None
+    # 重み付けされたステアリング入力列．（ホライズン，）
+    optimal_command_trajectory: Optional[ndarray] = None
+    # 最適入力列で進行した時の予測軌道における，立ち入り禁止領域までの最小余裕
+    min_clearance: Optional[float] = None
+    # 重みから求めた有効サンプル数
+    effective_sample_size: Optional[float] = None
+
+
+@dataclass
+class MPPIFilterBatchResult:
+    """複数の車に対するMPPI介入制御器の出力を記述する．"""
+    # 車ごとのフィルタされた後のステアリング入力．（車の数，）
+    filtered_commands: ndarray
+    # 車ごとにどのようなフィルタリングが行われたか．
+    flows: list[FilteringFlow]
+    # 介入が行われた車のインデックス．（介入した車の数，）
+    intervening_indices: Optional[ndarray] = None
+    # 介入した車ごとのステアリング入力候補．（介入した車の数，サンプルサイズ，ホライズン）
+    commands_list: Optional[ndarray] = None
+    # 介入した車ごとの各ステアリング入力候補に対する重み．（介入した車の数，サンプルサイズ）
+    sample_weights: Optional[ndarray] = None
+    # 介入した車ごとの重み付けされたステアリング入力列．（介入した車の数，ホライズン）
+    optimal_command_trajectories: Optional[ndarray] = None
+    # 介入した車ごとの，最適入力列で進行した時の立ち入り禁止領域までの最小余裕．（介入した車の数，）
+    min_clearances: Optional[ndarray] = None
+    # 介入した車ごとの有効サンプル数．（介入した車の数，）
+    effective_sample_sizes: Optional[ndarray] = None
+
+
+class MPPIFilterWorkspace:
+    def __init__(self, vehiclemodel: VehicleModel, samplesize: int, horizon: int):
+        """
+        `MPPIFilter`が介入計算のたびに使い回す作業領域．
+        配列はいずれも[内部時間，サンプルインデックス]の順番で，`VehicleModel`の軌道予測の結果と揃えてある．
+        浮動小数点の型は`VehicleModel`のdtypeに合わせる．
+        """
+        dtype = vehiclemodel.dtype
+        # ステアリング入力候補とその作業用配列．（サンプルサイズ，ホライズン）
+        # 軌道予測とコスト計算は時間方向に進むので，実体は（ホライズン，サンプルサイズ）で持ち，転置して見せる
+        self.commands_list_T = empty(shape=(horizon, samplesize), dtype=dtype)
+        self.commands_list = self.commands_list_T.T
+        self.commands_work_T = empty(shape=(horizon, samplesize), dtype=dtype)
+        self.ones_horizon = ones(shape=horizon, dtype=dtype)
+        # 軌道予測の書き込み先
+        self.rollout: RolloutWorkspace = vehiclemodel.create_rollout_workspace((samplesize,), horizon)
+        # 立ち入り禁止領域の判定．（ホライズン+1，サンプルサイズ）
+        self.check_value = empty(shape=(horizon + 1, samplesize), dtype=dtype)
+        self.check_work = empty(shape=(horizon + 1, samplesize), dtype=dtype)
+        self.violates_koa = empty(shape=(horizon + 1, samplesize), dtype=bool_)
+        self.violates = empty(shape=(horizon + 1, samplesize), dtype=bool_)
+        self.violates_float = empty(shape=(horizon + 1, samplesize), dtype=dtype)
+        # コストと重み．（サンプルサイズ，）
+        self.violation_cost_list = empty(shape=samplesize, dtype=dtype)
+        self.commands_cost_list = empty(shape=samplesize, dtype=dtype)
+        self.sample_weights = empty(shape=samplesize, dtype=dtype)
+        # ノミナル入力の予測軌道．（ホライズン+1，3）
+        self.nominal_state_history = empty(shape=(horizon + 1, 3), dtype=dtype)
 
 
 class MPPIFilter():
@@ -48,7 +121,16 @@ class MPPIFilter():
             command_std: float = 0.5,
             violation_weight: float = 1000.,
             violation_weight_decay: float = 0.90,
-            temperature: float = 1.0
+            temperature: float = 1.0,
+            preallocate: bool = False,
+            rng: Optional[Generator] = None,
+            fused_chunk_size: Optional[int] = None,
+            fused_time_block: int = 10,
+            negligible_weight: float = 1e-12,
+            diagnostics: DiagnosticsLevel = DiagnosticsLevel.Full,
+            use_arc_check: bool = False,
+            profiler: Optional[StageProfiler] = None,
+            sampler: Optional[CommandSampler] = None
     ):
         """
         MPPI介入制御器．
@@ -73,6 +155,42 @@ class MPPIFilter():
             立ち入り禁止領域への冒進時のコストを，予測ステップが進むごとに減衰させていく係数．
         temperature:float
             ステアリング入力を決定する際の温度パラメータ．
+        preallocate:bool
+            Trueにすると，`get_filtered_command`で使う配列を前もって確保し，毎回使い回す．
+            立ち上がり後は1回の計算で大きな配列を確保しないので，GCやメモリ確保による処理時間のばらつきが減る．
+            ただし，`MPPIFilterResult`に入る配列は次の呼び出しで上書きされる．
+            vehiclemodelが`RolloutBackend.Cumsum`を使う時に最も効果がある．
+        rng:Optional[Generator]
+            ステアリング入力候補の生成に使う乱数生成器．省略すると新しく作る．
+        fused_chunk_size:Optional[int]
+            与えると，介入計算をこの数のサンプルごとに区切り，軌道予測・立ち入り禁止領域の判定・コストの積算を
+            まとめて行う（`weigh_samples_fused`）．（サンプルサイズ，ホライズン+1）の中間配列を作らないので，
+            サンプルサイズを大きくした時のメモリ使用量とキャッシュミスが減る．preallocateより優先される．
+            この場合，`MPPIFilterResult`の予測軌道はNoneになる．
+        fused_time_block:int
+            fused_chunk_sizeを与えた時に，一度に予測するステップ数．
+        negligible_weight:float
+            fused_chunk_sizeを与えた時に，重みがこれ（最良のサンプルに対する比）を下回ることが確定したサンプルは，
+            それ以上軌道を予測しない．
+        diagnostics:DiagnosticsLevel
+            出力に含める付随情報の量．`DiagnosticsLevel.Full`の場合，作業領域の配列は複製してから出力する．
+        use_arc_check:bool
+            Trueにすると，ノミナル入力が立ち入り禁止領域を冒進するかを，予測軌道を円弧と見なして閉じた式で判定する
+            （`KeepoutArea.get_arc_clearance`）．予測ステップごとの軌道予測は，閉じた式で判定できない領域がある場合か，
+            `DiagnosticsLevel.Full`で予測軌道を出力する場合にだけ行う．
+            円弧は各予測ステップの位置を結ぶ連続した軌道なので，予測ステップの間で立ち入り禁止領域をかすめる場合も
+            冒進と判定する．つまり判定はやや安全側になる．
+        profiler:Optional[StageProfiler]
+            与えると，介入計算の処理段階ごとの処理時間を記録する．段階は次の通り．
+            "prepare"（計算準備と到達し得る立ち入り禁止領域の絞り込み），"nominal"（ノミナル入力の判定），
+            "sampling"（ステアリング入力候補の生成），"weigh"（重みの計算全体），
+            "rollout"，"keepout"，"cost"，"weights"（重みの計算のうちサンプルの軌道予測，立ち入り禁止領域の判定，
+            入力コスト，分配率．fused_chunk_sizeを与えた場合は，区切った分を足し合わせて1回の計算につき1回だけ
+            "rollout"と"keepout"を記録する），"summary"（付随情報の計算），"total"（全体）．
+            いずれも1回の計算につき高々1回記録するので，回数は呼び出しの回数と揃う．
+        sampler:Optional[CommandSampler]
+            ステアリング入力候補の元になるノイズの作り方．省略すると`GaussianSampler`（独立な正規乱数）を使う．
+            `QMCSampler`にすると，少ないサンプルサイズで同じ精度を得やすい．
         """
         self.vehiclemodel = vehiclemodel
         self.samplesize = samplesize
@@ -84,39 +202,480 @@ class MPPIFilter():
         self.violation_weight = violation_weight
         self.violation_weight_decay = violation_weight_decay
         self.temperature = temperature
+        self.rng = rng if rng is not None else default_rng()
+        self.sampler = sampler if sampler is not None else GaussianSampler()
+        # 浮動小数点の型は内部モデルに合わせる
+        self.dtype = vehiclemodel.dtype
+        self.workspace = MPPIFilterWorkspace(vehiclemodel, samplesize, horizon) if preallocate else None
+        self.fused_chunk_size = fused_chunk_size
+        self.fused_time_block = fused_time_block
+        self.negligible_weight = negligible_weight
+        self.diagnostics = diagnostics
+        self.use_arc_check = use_arc_check
+        self.profiler = profiler
+        self.sampler.prepare(samplesize, horizon, self.dtype)
 
-        self.keepoutareas: list[KeepoutArea] = []
+        self.keepoutindex = KeepoutAreaIndex([])
+        # 予測軌道の各点の予測ステップ番号．動く立ち入り禁止領域の判定に使う
+        self.prediction_steps = arange(horizon + 1)
+        self.prediction_steps_T = self.prediction_steps[:, None]  # 時間方向が先頭の配列用
         self.violation_weights = npa([
             violation_weight * violation_weight_decay ** step
             for step in range(horizon + 1)
-        ])
+        ], dtype=self.dtype)
+        # remaining_violation_weights[k]は，予測ステップk+1以降の冒進コストの合計
+        self.remaining_violation_weights = npa([
+            self.violation_weights[step + 1:].sum()
+            for step in range(horizon + 1)
+        ], dtype=self.dtype)
         self.previous_optimal_command = 0.
+        # `get_filtered_commands`で使う，車ごとの前回の最適入力
+        self.previous_optimal_commands = zeros(0)
+
+    @property
+    def keepoutareas(self) -> list[KeepoutArea]:
+        return self.keepoutindex.keepoutareas
+
+    @property
+    def time_varying_keepoutareas(self) -> list[KeepoutArea]:
+        return self.keepoutindex.time_varying_keepoutareas
+
+    @property
+    def keepoutareas_version(self) -> int:
+        """立ち入り禁止領域が変わるたびに増える番号．"""
+        return self.keepoutindex.version
+
+    def set_keepoutareas(self, keepoutareas: list[KeepoutArea]) -> list[int]:
+        """
+        立ち入り禁止領域を全て差し替え，それぞれのハンドルを返す．
+        一部だけを変える場合は，`add_keepoutarea`，`update_keepoutarea`，`remove_keepoutarea`を使う方が速い．
+        """
+        version = self.keepoutindex.version
+        self.keepoutindex = KeepoutAreaIndex()
+        self.keepoutindex.version = version + 1
+        return [self.keepoutindex.add(koa) for koa in keepoutareas]
+
+    def add_keepoutarea(self, keepoutarea: KeepoutArea) -> int:
+        """立ち入り禁止領域を1つ加え，そのハンドルを返す．"""
+        return self.keepoutindex.add(keepoutarea)
+
+    def update_keepoutarea(self, handle: int, keepoutarea: KeepoutArea):
+        """ハンドルが指す立ち入り禁止領域を差し替える．"""
+        self.keepoutindex.update(handle, keepoutarea)
+
+    def remove_keepoutarea(self, handle: int):
+        """ハンドルが指す立ち入り禁止領域を取り除く．"""
+        self.keepoutindex.remove(handle)
+
+    def get_reachable_keepoutareas(self, initial_location_x: float, initial_location_y: float) -> list[KeepoutArea]:
+        """
+        現在の速度で予測ホライズン内に到達し得る立ち入り禁止領域だけを返す．
+        `prepare_for_filtering`の後に呼ぶこと．
+        """
+        reach = self.horizon * abs(self.vehiclemodel.vts)
+        return self.keepoutindex.query(initial_location_x, initial_location_y, reach)
 
-    def set_keepoutareas(self, keepoutareas: list[KeepoutArea]):
-        self.keepoutareas = keepoutareas
+    def get_reachable_keepoutareas_for_vehicles(
+            self,
+            initial_location_x: ndarray,
+            initial_location_y: ndarray,
+            initial_speed: ndarray
+    ) -> list[KeepoutArea]:
+        """
+        いずれかの車が予測ホライズン内に到達し得る立ち入り禁止領域だけを返す．
+        """
+        reaches = self.horizon * abs(initial_speed * self.vehiclemodel.frame_time)
+        reachable_keepoutareas = {}
+        for x, y, reach in zip(initial_location_x, initial_location_y, reaches):
+            for koa in self.keepoutindex.query(x, y, reach):
+                reachable_keepoutareas[id(koa)] = koa
+        return list(reachable_keepoutareas.values())
 
-    def prepare_for_filtering(self, speed: float):
+    def prepare_for_filtering(self, speed: float | ndarray):
         self.vehiclemodel.set_speed(speed)
 
-    def generate_commands_samples(self, mean: float) -> ndarray:
-        commands_samples = randn(self.samplesize, self.horizon) * self.command_std + mean
+    def prepare_keepoutareas(self):
+        """動く立ち入り禁止領域に，予測ホライズン分の動きを予測させる．1回の計算につき1回だけ呼ぶ．"""
+        for koa in self.time_varying_keepoutareas:
+            koa.prepare_for_filtering(self.horizon, self.vehiclemodel.frame_time)
+
+    def generate_commands_samples(self, mean: float | ndarray, batch_shape: tuple[int, ...] = ()) -> ndarray:
+        """
+        （サンプルサイズ，ホライズン）のステアリング入力候補を生成する．
+        batch_shapeを与えると，その形を先頭に付けた分だけまとめて生成する．
+        作業領域がある場合，1台分の候補はそこへ書き込まれる．
+        """
+        if self.workspace is not None and not batch_shape:
+            commands_samples_T = self.workspace.commands_list_T
+            self.sampler.fill(self.workspace.commands_list, self.rng)
+            commands_samples_T *= self.command_std
+            commands_samples_T += mean
+            clip(commands_samples_T, self.command_lb, self.command_ub, out=commands_samples_T)
+            return self.workspace.commands_list
+        commands_samples = self.sampler.fill(
+            empty((*batch_shape, self.samplesize, self.horizon), dtype=self.dtype), self.rng
+        ) * self.command_std + mean
         commands_samples[commands_samples >= self.command_ub] = self.command_ub
         commands_samples[commands_samples <= self.command_lb] = self.command_lb
         return commands_samples
 
-    def check_all_keepoutareas(self, x: ndarray, y: ndarray) -> ndarray[bool]:
+    def check_all_keepoutareas(
+            self,
+            x: ndarray,
+            y: ndarray,
+            keepoutareas: list[KeepoutArea] | None = None,
+            steps: ndarray | int | None = None
+    ) -> ndarray[bool]:
         """
         x,yがいずれかの立ち入り禁止領域に入っていないかを要素ごとに調べる．
         立ち入り禁止領域に入っている場合，対応する要素をTrueにして返す．
         xとyはベクトルでも行列でも可．
+        keepoutareasを省略した場合は，設定されている全ての立ち入り禁止領域を調べる．
+        stepsはx,yの各要素の予測ステップ番号で，x,yにブロードキャストできる形．省略すると動く領域は現在の位置で調べる．
         """
+        if keepoutareas is None:
+            keepoutareas = self.keepoutareas
         violates = zeros_like(x, dtype=bool_)
         violates = False
-        for koa in self.keepoutareas:
-            violates_koa = koa.check(x, y) <= 0
+        for koa in keepoutareas:
+            if steps is None:
+                violates_koa = koa.check(x, y) <= 0
+            else:
+                violates_koa = koa.check_at_steps(x, y, steps) <= 0
             violates = violates + violates_koa  # 和論理を取る
         return violates
 
+    def weigh_samples(
+            self,
+            initial_location_x: float,
+            initial_location_y: float,
+            initial_direction: float,
+            nominal_command: float,
+            commands_list: ndarray,
+            keepoutareas: list[KeepoutArea]
+    ) -> tuple[ndarray, ndarray, ndarray]:
+        """
+        各ステアリング入力候補の軌道を予測し，コストから重みを計算する．
+
+        Returns
+        -------
+        x_history_list, y_history_list, sample_weights: tuple[ndarray, ndarray, ndarray]
+            予測軌道（サンプルサイズ，ホライズン+1）と重み（サンプルサイズ，）．
+        """
+        profiler = self.profiler
+        if profiler is not None:
+            lap_at = profiler.start()
+        x_history_list, y_history_list = \
+            self.vehiclemodel.predict_constant_speed_variable_command_behaviour(
+                initial_location_x=initial_location_x,
+                initial_location_y=initial_location_y,
+                initial_direction=initial_direction,
+                commands_list=commands_list
+            )
+        if profiler is not None:
+            lap_at = profiler.lap("rollout", lap_at)
+
+        # 立ち入り禁止領域冒進に対するコスト
+        violates_history_list = self.check_all_keepoutareas(
+            x_history_list, y_history_list, keepoutareas, self.prediction_steps
+        )  # （サンプルサイズ，ホライズン+1）
+        violation_cost_list = sum(violates_history_list * self.violation_weights, axis=1)  # （サンプルサイズ，）
+        if profiler is not None:
+            lap_at = profiler.lap("keepout", lap_at)
+
+        # 入力コスト
+        commands_cost_list = sum(square(commands_list - nominal_command) / self.command_var, axis=1)
+        if profiler is not None:
+            lap_at = profiler.lap("cost", lap_at)
+
+        # 分配率を計算する
+        exp_inner = - violation_cost_list / self.temperature - commands_cost_list
+        exp_inner -= exp_inner.max()
+        exp_outer = exp(exp_inner)
+        sample_weights = exp_outer / sum(exp_outer, dtype=float64)
+        if profiler is not None:
+            profiler.lap("weights", lap_at)
+        return x_history_list, y_history_list, sample_weights
+
+    def weigh_samples_in_workspace(
+            self,
+            initial_location_x: float,
+            initial_location_y: float,
+            initial_direction: float,
+            nominal_command: float,
+            commands_list: ndarray,
+            keepoutareas: list[KeepoutArea]
+    ) -> tuple[ndarray, ndarray, ndarray]:
+        """
+        `weigh_samples`と同じ計算を，作業領域の配列だけを使って行う．
+        """
+        ws = self.workspace
+        profiler = self.profiler
+        if profiler is not None:
+            lap_at = profiler.start()
+        x_history_list, y_history_list = \
+            self.vehiclemodel.predict_constant_speed_variable_command_behaviour(
+                initial_location_x=initial_location_x,
+                initial_location_y=initial_location_y,
+                initial_direction=initial_direction,
+                commands_list=commands_list,
+                workspace=ws.rollout
+            )
+        if profiler is not None:
+            lap_at = profiler.lap("rollout", lap_at)
+
+        # 立ち入り禁止領域冒進に対するコスト
+        x_history_list_T = x_history_list.T  # （ホライズン+1，サンプルサイズ）
+        y_history_list_T = y_history_list.T
+        violates = ws.violates
+        violates.fill(False)
+        for koa in keepoutareas:
+            koa.check_at_steps_into(
+                x_history_list_T, y_history_list_T, self.prediction_steps_T, out=ws.check_value, work=ws.check_work
+            )
+            less_equal(ws.check_value, 0, out=ws.violates_koa)
+            logical_or(violates, ws.violates_koa, out=violates)  # 和論理を取る
+        copyto(ws.violates_float, violates)
+        violation_cost_list = matmul(self.violation_weights, ws.violates_float, out=ws.violation_cost_list)
+        if profiler is not None:
+            lap_at = profiler.lap("keepout", lap_at)
+
+        # 入力コスト
+        commands_work_T = ws.commands_work_T
+        subtract(commands_list.T, nominal_command, out=commands_work_T)
+        square(commands_work_T, out=commands_work_T)
+        divide(commands_work_T, self.command_var, out=commands_work_T)
+        # sumで時間方向に縮約すると内部で作業用の配列が確保されるので，行列積で足し合わせる
+        commands_cost_list = matmul(ws.ones_horizon, commands_work_T, out=ws.commands_cost_list)
+        if profiler is not None:
+            lap_at = profiler.lap("cost", lap_at)
+
+        # 分配率を計算する
+        sample_weights = ws.sample_weights
+        divide(violation_cost_list, self.temperature, out=sample_weights)
+        negative(sample_weights, out=sample_weights)
+        subtract(sample_weights, commands_cost_list, out=sample_weights)
+        sample_weights -= sample_weights.max()
+        exp(sample_weights, out=sample_weights)
+        sample_weights /= sum(sample_weights, dtype=float64)
+        if profiler is not None:
+            profiler.lap("weights", lap_at)
+        return x_history_list, y_history_list, sample_weights
+
+    def weigh_samples_fused(
+            self,
+            initial_location_x: float,
+            initial_location_y: float,
+            initial_direction: float,
+            nominal_command: float,
+            commands_list: ndarray,
+            keepoutareas: list[KeepoutArea]
+    ) -> tuple[None, None, ndarray]:
+        """
+        `weigh_samples`と同じ重みを，サンプルを`fused_chunk_size`個ずつに区切って計算する．
+        区切ったサンプルごとに，`fused_time_block`ステップずつ軌道予測・立ち入り禁止領域の判定・コストの積算を行う．
+
+        冒進コストは予測が進むほど増える一方なので，途中までのコストは最終的なコストの下限になる．
+        一方，残りのステップで全て冒進したとしたコストは上限になる．
+        あるサンプルの下限が，これまでに見た全サンプルの上限の最小値よりも-log(negligible_weight)以上大きければ，
+        そのサンプルの重みは最良のサンプルのnegligible_weight倍を下回ることが確定するので，以降の予測を打ち切る．
+        打ち切ったサンプルのコストには下限を使う．
+
+        Returns
+        -------
+        x_history_list, y_history_list, sample_weights: tuple[None, None, ndarray]
+            予測軌道は保持しないのでNoneを返す．
+        """
+        n_samples, horizon = commands_list.shape
+        inv_temperature = 1. / self.temperature
+        cutoff = -log(self.negligible_weight)
+
+        commands_cost_list = empty(n_samples, dtype=self.dtype)
+        # 予測ステップ0は全サンプルで同じ位置
+        violation_cost_list = zeros(n_samples, dtype=self.dtype)
+        if any(self.check_all_keepoutareas(initial_location_x, initial_location_y, keepoutareas, 0)):
+            violation_cost_list += self.violation_weights[0]
+
+        profiler = self.profiler
+        if profiler is not None:
+            rollout_ns = keepout_ns = 0
+        best_upper_cost = inf
+        for chunk_start in range(0, n_samples, self.fused_chunk_size):
+            chunk_end = min(chunk_start + self.fused_chunk_size, n_samples)
+            active_indices = arange(chunk_start, chunk_end)
+            # 入力コストは軌道予測に依らないので先に計算しておく
+            commands_cost_list[chunk_start:chunk_end] = sum(
+                square(commands_list[chunk_start:chunk_end] - nominal_command) / self.command_var, axis=1
+            )
+            x = full(active_indices.shape, initial_location_x, dtype=self.dtype)
+            y = full(active_indices.shape, initial_location_y, dtype=self.dtype)
+            direction = full(active_indices.shape, initial_direction, dtype=self.dtype)
+            for block_start in range(0, horizon, self.fused_time_block):
+                block_end = min(block_start + self.fused_time_block, horizon)
+                if profiler is not None:
+                    block_started_at = profiler.start()
+                x_block, y_block, direction = self.vehiclemodel.predict_block(
+                    x, y, direction, commands_list[active_indices, block_start:block_end]
+                )  # 予測ステップblock_start+1からblock_endまで
+                if profiler is not None:
+                    rollout_ended_at = profiler.start()
+                    rollout_ns += rollout_ended_at - block_started_at
+                violates_block = self.check_all_keepoutareas(
+                    x_block, y_block, keepoutareas, self.prediction_steps[block_start + 1:block_end + 1]
+                )
+                if profiler is not None:
+                    keepout_ns += profiler.start() - rollout_ended_at
+                if any(violates_block):
+                    violation_cost_list[active_indices] += \
+                        violates_block @ self.violation_weights[block_start + 1:block_end + 1]
+                x = x_block[:, -1]
+                y = y_block[:, -1]
+
+                # 重みが無視できることが確定したサンプルを打ち切る
+                lower_cost = commands_cost_list[active_indices] + violation_cost_list[active_indices] * inv_temperature
+                upper_cost = lower_cost + self.remaining_violation_weights[block_end] * inv_temperature
+                best_upper_cost = min(best_upper_cost, upper_cost.min())
+                keeps = lower_cost - best_upper_cost <= cutoff
+                if not keeps.all():
+                    active_indices = active_indices[keeps]
+                    x = x[keeps]
+                    y = y[keeps]
+                    direction = direction[keeps]
+                    if active_indices.shape[0] == 0:
+                        break
+        if profiler is not None:
+            profiler.record("rollout", rollout_ns)
+            profiler.record("keepout", keepout_ns)
+
+        # 分配率を計算する
+        exp_inner = - violation_cost_list / self.temperature - commands_cost_list
+        exp_inner -= exp_inner.max()
+        exp_outer = exp(exp_inner)
+        sample_weights = exp_outer / sum(exp_outer, dtype=float64)
+        return None, None, sample_weights
+
+    def check_nominal(
+            self,
+            initial_location_x: float,
+            initial_location_y: float,
+            initial_direction: float,
+            nominal_command: float,
+            keepoutareas: list[KeepoutArea]
+    ) -> tuple[bool, Optional[float], Optional[ndarray], Optional[ndarray]]:
+        """
+        ノミナル入力のまま進行した時に，立ち入り禁止領域を冒進するかを判断する．
+        `use_arc_check`がTrueなら，閉じた式で判定できる領域はそれで済ませ，予測ステップごとの軌道予測は必要な時だけ行う．
+
+        Returns
+        -------
+        violates, min_clearance, nominal_x_history, nominal_y_history: tuple[bool, Optional[float], Optional[ndarray], Optional[ndarray]]
+            冒進するかどうか，立ち入り禁止領域までの最小余裕（diagnosticsがNothingの時はNone），
+            予測軌道（軌道予測を行わなかった時はNone）．
+        """
+        violates = False
+        min_clearance = inf
+        undecided_keepoutareas = keepoutareas
+        if self.use_arc_check:
+            arc = self.vehiclemodel.get_constant_command_arc(
+                initial_location_x=initial_location_x,
+                initial_location_y=initial_location_y,
+                initial_direction=initial_direction,
+                command=nominal_command,
+                horizon=self.horizon
+            )
+            undecided_keepoutareas = []
+            for koa in keepoutareas:
+                arc_clearance = koa.get_arc_clearance(arc)
+                if arc_clearance is None:
+                    undecided_keepoutareas.append(koa)
+                    continue
+                violates = violates or arc_clearance <= 0
+                min_clearance = min(min_clearance, arc_clearance)
+
+        nominal_x_history = None
+        nominal_y_history = None
+        needs_summary = self.diagnostics != DiagnosticsLevel.Nothing
+        if (undecided_keepoutareas and not violates) or self.diagnostics == DiagnosticsLevel.Full:
+            nominal_state_history = self.vehiclemodel.predict_constant_speed_constant_command_behaviour(
+                initial_location_x=initial_location_x,
+                initial_location_y=initial_location_y,
+                initial_direction=initial_direction,
+                command=nominal_command,
+                horizon=self.horizon,
+                dtype=self.dtype,
+                state_history=self.workspace.nominal_state_history if self.workspace is not None else None
+            )
+            nominal_x_history = nominal_state_history[:, 0]
+            nominal_y_history = nominal_state_history[:, 1]
+            if undecided_keepoutareas:
+                violates = violates or bool(any(self.check_all_keepoutareas(
+                    nominal_x_history, nominal_y_history, undecided_keepoutareas, self.prediction_steps
+                )))
+                if needs_summary:
+                    min_clearance = min(min_clearance, float(self.get_min_clearance(
+                        nominal_x_history, nominal_y_history, undecided_keepoutareas, self.prediction_steps
+                    )))
+        return violates, (min_clearance if needs_summary else None), nominal_x_history, nominal_y_history
+
+    def keep_array(self, array: Optional[ndarray]) -> Optional[ndarray]:
+        """作業領域を使っている場合，次の呼び出しで上書きされないよう配列を複製する．"""
+        if self.workspace is None or array is None:
+            return array
+        return array.copy()
+
+    def get_min_clearance(
+            self,
+            x_history: ndarray,
+            y_history: ndarray,
+            keepoutareas: list[KeepoutArea],
+            steps: ndarray | None = None
+    ) -> ndarray:
+        """
+        予測軌道上の全ての点と全ての立ち入り禁止領域の組について，最も小さい余裕を返す．
+        x_historyとy_historyは最後の軸が予測ステップ．返り値は最後の軸を縮約した形．
+        stepsは`check_all_keepoutareas`と同じ．
+        """
+        min_clearance = full(x_history.shape[:-1], inf)
+        for koa in keepoutareas:
+            if steps is None:
+                clearance = koa.get_clearance(x_history, y_history)
+            else:
+                clearance = koa.get_clearance_at_steps(x_history, y_history, steps)
+            min_clearance = minimum(min_clearance, clearance.min(axis=-1))
+        return min_clearance
+
+    def summarize_intervention(
+            self,
+            initial_location_x: float | ndarray,
+            initial_location_y: float | ndarray,
+            initial_direction: float | ndarray,
+            commands_list: ndarray,
+            sample_weights: ndarray,
+            keepoutareas: list[KeepoutArea]
+    ) -> tuple[ndarray, ndarray, ndarray]:
+        """
+        介入した時の付随情報を計算する．車の軸が先頭に付いていてもよい．
+        車ごとに速度を変える場合は，`prepare_for_filtering`で設定した速度がinitial_location_xなどに揃っていること．
+
+        Returns
+        -------
+        optimal_command_trajectory, min_clearance, effective_sample_size: tuple[ndarray, ndarray, ndarray]
+            重み付けされたステアリング入力列（…，ホライズン），その予測軌道の最小余裕（…），有効サンプル数（…）．
+        """
+        optimal_command_trajectory = matmul(sample_weights[..., None, :], commands_list)[..., 0, :]
+        optimal_x_history, optimal_y_history = \
+            self.vehiclemodel.predict_constant_speed_variable_command_behaviour(
+                initial_location_x=initial_location_x,
+                initial_location_y=initial_location_y,
+                initial_direction=initial_direction,
+                commands_list=optimal_command_trajectory
+            )
+        min_clearance = self.get_min_clearance(
+            optimal_x_history, optimal_y_history, keepoutareas, self.prediction_steps
+        )
+        effective_sample_size = 1. / sum(square(sample_weights, dtype=float64), axis=-1)
+        return optimal_command_trajectory, min_clearance, effective_sample_size
+
     def get_filtered_command(
             self,
             initial_location_x: float,
@@ -154,66 +713,253 @@ class MPPIFilter():
                 flow=FilteringFlow.NoKeepoutArea
             )
 
+        profiler = self.profiler
+        if profiler is not None:
+            started_at = lap_at = profiler.start()
+
         # モデルによる計算準備
         self.prepare_for_filtering(initial_speed)
+        self.prepare_keepoutareas()
+        # 到達し得ない立ち入り禁止領域は判定しない
+        keepoutareas = self.get_reachable_keepoutareas(initial_location_x, initial_location_y)
+        if profiler is not None:
+            lap_at = profiler.lap("prepare", lap_at)
 
         # ノミナル入力が立ち入り禁止領域に入らないかを判断する
-        nominal_state_history = self.vehiclemodel.predict_constant_speed_constant_command_behaviour(
-            initial_location_x=initial_location_x,
-            initial_location_y=initial_location_y,
-            initial_direction=initial_direction,
-            command=nominal_command,
-            horizon=self.horizon,
+        violates, nominal_min_clearance, nominal_x_history, nominal_y_history = self.check_nominal(
+            initial_location_x, initial_location_y, initial_direction, nominal_command, keepoutareas
         )
-        nominal_x_history = nominal_state_history[:, 0]
-        nominal_y_history = nominal_state_history[:, 1]
-        violates = self.check_all_keepoutareas(nominal_x_history, nominal_y_history)
-        if not any(violates):
+        if profiler is not None:
+            lap_at = profiler.lap("nominal", lap_at)
+        if not violates:
             # 立ち入り禁止エリアに入らない
             self.previous_optimal_command = nominal_command
-            return MPPIFilterResult(
+            result = MPPIFilterResult(
                 filtered_command=nominal_command,
-                flow=FilteringFlow.NoIntervention,
-                nominal_x_history=nominal_x_history,
-                nominal_y_history=nominal_y_history
+                flow=FilteringFlow.NoIntervention
             )
+            if self.diagnostics != DiagnosticsLevel.Nothing:
+                result.optimal_command_trajectory = full(self.horizon, nominal_command, dtype=self.dtype)
+                result.min_clearance = nominal_min_clearance
+            if self.diagnostics == DiagnosticsLevel.Full:
+                result.nominal_x_history = self.keep_array(nominal_x_history)
+                result.nominal_y_history = self.keep_array(nominal_y_history)
+            if profiler is not None:
+                profiler.lap("total", started_at)
+            return result
 
         # 立ち入り禁止エリアに入るため介入が必要！
         if commands_list is None:
             commands_list = self.generate_commands_samples(self.previous_optimal_command)
-        x_history_list, y_history_list = \
+        if profiler is not None:
+            lap_at = profiler.lap("sampling", lap_at)
+        if self.fused_chunk_size is not None:
+            weigh_samples = self.weigh_samples_fused
+        elif self.workspace is not None:
+            weigh_samples = self.weigh_samples_in_workspace
+        else:
+            weigh_samples = self.weigh_samples
+        x_history_list, y_history_list, sample_weights = weigh_samples(
+            initial_location_x, initial_location_y, initial_direction, nominal_command, commands_list, keepoutareas
+        )
+        if profiler is not None:
+            lap_at = profiler.lap("weigh", lap_at)
+
+        # 最適コストを決定する
+        step0_command_list = commands_list[:, 0]
+        optimal_command = float(dot(step0_command_list, sample_weights))
+
+        self.previous_optimal_command = optimal_command
+        result = MPPIFilterResult(
+            filtered_command=optimal_command,
+            flow=FilteringFlow.Intervention
+        )
+        if self.diagnostics != DiagnosticsLevel.Nothing:
+            optimal_command_trajectory, min_clearance, effective_sample_size = self.summarize_intervention(
+                initial_location_x, initial_location_y, initial_direction, commands_list, sample_weights, keepoutareas
+            )
+            result.optimal_command_trajectory = optimal_command_trajectory
+            result.min_clearance = float(min_clearance)
+            result.effective_sample_size = float(effective_sample_size)
+        if self.diagnostics == DiagnosticsLevel.Full:
+            result.nominal_x_history = self.keep_array(nominal_x_history)
+            result.nominal_y_history = self.keep_array(nominal_y_history)
+            result.commands_list = self.keep_array(commands_list)
+            result.x_history_list = self.keep_array(x_history_list)
+            result.y_history_list = self.keep_array(y_history_list)
+            result.sample_weights = self.keep_array(sample_weights)
+        if profiler is not None:
+            profiler.lap("summary", lap_at)
+            profiler.lap("total", started_at)
+        return result
+
+    def get_filtered_commands(
+            self,
+            initial_location_x: ndarray,
+            initial_location_y: ndarray,
+            initial_direction: ndarray,
+            initial_speed: ndarray,
+            nominal_command: ndarray,
+            commands_list: ndarray | None = None
+    ) -> MPPIFilterBatchResult:
+        """
+        複数の車に対してMPPI介入制御器をまとめて動かす．
+        全ての車の計算を（車の数，サンプルサイズ，ホライズン）の配列上で一度に行う．
+        車ごとの前回の最適入力は`previous_optimal_commands`に保持され，次回の呼び出しの際のサンプリングの中心になる．
+        車のインデックスは呼び出し間で同じ車を指すようにすること．車の数が変わった場合は全ての車について0から始める．
+
+        Parameters
+        ----------
+        initial_location_x:ndarray
+        initial_location_y:ndarray
+        initial_direction:ndarray
+        initial_speed:ndarray
+        nominal_command:ndarray
+            いずれも（車の数，）のベクトル形式．
+        commands_list:ndarray|None=None
+            （任意）ステアリング入力のサンプル．（車の数，サンプルサイズ，ホライズン）の形式．
+            介入が必要な車の分だけが使われる．
+
+        Returns
+        -------
+        result:MPPIFilterBatchResult
+            当制御器の出力を表すオブジェクト．
+        """
+        initial_location_x = asarray(initial_location_x, dtype=float)
+        initial_location_y = asarray(initial_location_y, dtype=float)
+        initial_direction = asarray(initial_direction, dtype=float)
+        initial_speed = asarray(initial_speed, dtype=float)
+        nominal_command = asarray(nominal_command, dtype=self.dtype)
+        n_vehicles = nominal_command.shape[0]
+        if self.previous_optimal_commands.shape[0] != n_vehicles:
+            self.previous_optimal_commands = zeros(n_vehicles, dtype=self.dtype)
+
+        # 立ち入り禁止領域が無ければ介入の必要はない
+        if not self.keepoutareas:
+            self.previous_optimal_commands[:] = nominal_command
+            return MPPIFilterBatchResult(
+                filtered_commands=nominal_command.copy(),
+                flows=[FilteringFlow.NoKeepoutArea] * n_vehicles
+            )
+
+        profiler = self.profiler
+        if profiler is not None:
+            started_at = lap_at = profiler.start()
+
+        self.prepare_keepoutareas()
+        # 到達し得ない立ち入り禁止領域は判定しない
+        keepoutareas = self.get_reachable_keepoutareas_for_vehicles(
+            initial_location_x, initial_location_y, initial_speed
+        )
+        if profiler is not None:
+            lap_at = profiler.lap("prepare", lap_at)
+
+        # ノミナル入力が立ち入り禁止領域に入らないかを，全ての車について一度に判断する
+        self.prepare_for_filtering(initial_speed)
+        nominal_x_history, nominal_y_history = \
             self.vehiclemodel.predict_constant_speed_variable_command_behaviour(
                 initial_location_x=initial_location_x,
                 initial_location_y=initial_location_y,
                 initial_direction=initial_direction,
+                commands_list=broadcast_to(nominal_command[:, None], (n_vehicles, self.horizon))
+            )  # （車の数，ホライズン+1）
+        if keepoutareas:
+            violates = self.check_all_keepoutareas(
+                nominal_x_history, nominal_y_history, keepoutareas, self.prediction_steps
+            )
+            needs_intervention = any(violates, axis=-1)
+        else:
+            needs_intervention = zeros(n_vehicles, dtype=bool_)
+        if profiler is not None:
+            lap_at = profiler.lap("nominal", lap_at)
+
+        filtered_commands = nominal_command.copy()
+        flows = [
+            FilteringFlow.Intervention if needs else FilteringFlow.NoIntervention
+            for needs in needs_intervention
+        ]
+        intervening_indices = flatnonzero(needs_intervention)
+        if intervening_indices.shape[0] == 0:
+            self.previous_optimal_commands[:] = nominal_command
+            if profiler is not None:
+                profiler.lap("total", started_at)
+            return MPPIFilterBatchResult(
+                filtered_commands=filtered_commands,
+                flows=flows,
+                intervening_indices=intervening_indices
+            )
+
+        # 介入が必要な車だけを取り出す．以降は（介入する車の数，サンプルサイズ，ホライズン）で計算する
+        intervening_nominal_command = nominal_command[intervening_indices, None, None]
+        if commands_list is None:
+            commands_list = self.generate_commands_samples(
+                self.previous_optimal_commands[intervening_indices, None, None],
+                batch_shape=(intervening_indices.shape[0],)
+            )
+        else:
+            commands_list = asarray(commands_list)[intervening_indices]
+        if profiler is not None:
+            weigh_started_at = lap_at = profiler.lap("sampling", lap_at)
+        self.prepare_for_filtering(initial_speed[intervening_indices, None])
+        x_history_list, y_history_list = \
+            self.vehiclemodel.predict_constant_speed_variable_command_behaviour(
+                initial_location_x=initial_location_x[intervening_indices, None],
+                initial_location_y=initial_location_y[intervening_indices, None],
+                initial_direction=initial_direction[intervening_indices, None],
                 commands_list=commands_list
             )
+        if profiler is not None:
+            lap_at = profiler.lap("rollout", lap_at)
 
         # 立ち入り禁止領域冒進に対するコスト
-        violates_history_list = self.check_all_keepoutareas(x_history_list, y_history_list)  # （サンプルサイズ，ホライズン+1）
-        violation_cost_list = sum(violates_history_list * self.violation_weights, axis=1)  # （サンプルサイズ，）
+        violates_history_list = self.check_all_keepoutareas(
+            x_history_list, y_history_list, keepoutareas, self.prediction_steps
+        )
+        violation_cost_list = sum(violates_history_list * self.violation_weights, axis=-1)  # （介入する車の数，サンプルサイズ）
+        if profiler is not None:
+            lap_at = profiler.lap("keepout", lap_at)
 
         # 入力コスト
-        commands_cost_list = sum(square(commands_list - nominal_command) / self.command_var, axis=1)
+        commands_cost_list = sum(square(commands_list - intervening_nominal_command) / self.command_var, axis=-1)
+        if profiler is not None:
+            lap_at = profiler.lap("cost", lap_at)
 
-        # 分配率を計算する
+        # 分配率を車ごとに計算する
         exp_inner = - violation_cost_list / self.temperature - commands_cost_list
-        exp_inner -= exp_inner.max()
+        exp_inner -= exp_inner.max(axis=-1, keepdims=True)
         exp_outer = exp(exp_inner)
-        sample_weights = exp_outer / sum(exp_outer)
+        exp_outer_sum = sum(exp_outer, axis=-1, keepdims=True, dtype=float64)
+        sample_weights = exp_outer / exp_outer_sum.astype(self.dtype)
+        if profiler is not None:
+            lap_at = profiler.lap("weights", lap_at)
+            lap_at = profiler.lap("weigh", weigh_started_at)
 
         # 最適コストを決定する
-        step0_command_list = commands_list[:, 0]
-        optimal_command = sum(step0_command_list * sample_weights)
+        optimal_commands = sum(commands_list[..., 0] * sample_weights, axis=-1)
+        filtered_commands[intervening_indices] = optimal_commands
 
-        self.previous_optimal_command = optimal_command
-        return MPPIFilterResult(
-            filtered_command=optimal_command,
-            flow=FilteringFlow.Intervention,
-            nominal_x_history=nominal_x_history,
-            nominal_y_history=nominal_y_history,
-            commands_list=commands_list,
-            x_history_list=x_history_list,
-            y_history_list=y_history_list,
-            sample_weights=sample_weights
+        self.previous_optimal_commands[:] = filtered_commands
+        result = MPPIFilterBatchResult(
+            filtered_commands=filtered_commands,
+            flows=flows,
+            intervening_indices=intervening_indices
         )
+        if self.diagnostics != DiagnosticsLevel.Nothing:
+            self.prepare_for_filtering(initial_speed[intervening_indices])
+            result.optimal_command_trajectories, result.min_clearances, result.effective_sample_sizes = \
+                self.summarize_intervention(
+                    initial_location_x[intervening_indices],
+                    initial_location_y[intervening_indices],
+                    initial_direction[intervening_indices],
+                    commands_list,
+                    sample_weights,
+                    keepoutareas
+                )
+        if self.diagnostics == DiagnosticsLevel.Full:
+            result.commands_list = commands_list
+            result.sample_weights = sample_weights
+        if profiler is not None:
+            profiler.lap("summary", lap_at)
+            profiler.lap("total", started_at)
+        return result
+
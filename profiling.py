@@ -0,0 +1,162 @@
+from itertools import accumulate
+from time import perf_counter_ns
+
+# 1オクターブ（2倍）あたりの階級の数．階級の幅は下限の1/4になる
+SUBBUCKET_BITS = 2
+SUBBUCKETS = 1 << SUBBUCKET_BITS
+# 2^64 ns（約585年）まで数えられる
+N_BUCKETS = 64 * SUBBUCKETS
+
+
+def get_bucket(duration_ns: int) -> int:
+    """処理時間[ns]が入る階級の番号を返す．"""
+    if duration_ns < SUBBUCKETS:
+        return max(duration_ns, 0)
+    exponent = duration_ns.bit_length() - 1
+    subbucket = (duration_ns >> (exponent - SUBBUCKET_BITS)) & (SUBBUCKETS - 1)
+    return (exponent - SUBBUCKET_BITS + 1) * SUBBUCKETS + subbucket
+
+
+def get_bucket_lower_bound(bucket: int) -> int:
+    """階級の番号から，その階級の下限[ns]を返す．"""
+    if bucket < SUBBUCKETS:
+        return bucket
+    exponent = bucket // SUBBUCKETS + SUBBUCKET_BITS - 1
+    subbucket = bucket % SUBBUCKETS
+    return (SUBBUCKETS + subbucket) << (exponent - SUBBUCKET_BITS)
+
+
+class StageHistogram:
+    def __init__(self):
+        """
+        1つの処理段階の処理時間の度数分布．階級は対数の幅を持ち，配列の大きさは記録した数に依らず一定．
+        パーセンタイルは階級の中央の値で近似するので，誤差は12.5%以内．
+        """
+        self.counts = [0] * N_BUCKETS
+        self.n_records = 0
+        self.last_ns = 0
+        self.total_ns = 0
+
+    def record(self, duration_ns: int):
+        self.counts[get_bucket(duration_ns)] += 1
+        self.n_records += 1
+        self.last_ns = duration_ns
+        self.total_ns += duration_ns
+
+    def get_percentile(self, q: float) -> float:
+        """q（0から100）パーセンタイルの処理時間[s]を返す．まだ何も記録していなければ0を返す．"""
+        if self.n_records == 0:
+            return 0.
+        rank = q / 100. * self.n_records
+        for bucket, cumulative_count in enumerate(accumulate(self.counts)):
+            if cumulative_count >= rank and cumulative_count > 0:
+                lower = get_bucket_lower_bound(bucket)
+                upper = get_bucket_lower_bound(bucket + 1)
+                return (lower + upper) / 2 * 1e-9
+        return 0.
+
+    def get_mean(self) -> float:
+        """平均の処理時間[s]を返す．"""
+        return self.total_ns / self.n_records * 1e-9 if self.n_records else 0.
+
+    def reset(self):
+        self.counts = [0] * N_BUCKETS
+        self.n_records = 0
+        self.last_ns = 0
+        self.total_ns = 0
+
+
+class StageProfiler:
+    def __init__(self):
+        """
+        `MPPIFilter`の処理段階ごとの処理時間を`perf_counter_ns`で測り，`StageHistogram`に溜める．
+        `MPPIFilter`にprofilerとして渡すと測定が有効になる．渡さなければ測定の手間はほぼ掛からない．
+
+            profiler = StageProfiler()
+            start = profiler.start()
+            ...
+            start = profiler.lap("rollout", start)  # ここまでを"rollout"として記録し，次の段階を測り始める
+        """
+        self.histograms: dict[str, StageHistogram] = {}
+
+    @staticmethod
+    def start() -> int:
+        return perf_counter_ns()
+
+    def lap(self, stage: str, start_ns: int) -> int:
+        """start_nsから今までの処理時間をstageとして記録し，今の時刻を返す．"""
+        now = perf_counter_ns()
+        self.record(stage, now - start_ns)
+        return now
+
+    def record(self, stage: str, duration_ns: int):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = StageHistogram()
+            self.histograms[stage] = histogram
+        histogram.record(duration_ns)
+
+    def get_percentile(self, stage: str, q: float) -> float:
+        """stageのqパーセンタイルの処理時間[s]を返す．まだ記録していない段階では0を返す．"""
+        histogram = self.histograms.get(stage)
+        return 0. if histogram is None else histogram.get_percentile(q)
+
+    def get_summary(self) -> dict[str, dict[str, float]]:
+        """全ての段階について，記録数と処理時間[s]の平均，p50，p99を返す．"""
+        return {
+            stage: {
+                "count": histogram.n_records,
+                "mean": histogram.get_mean(),
+                "p50": histogram.get_percentile(50),
+                "p99": histogram.get_percentile(99),
+            }
+            for stage, histogram in self.histograms.items()
+        }
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+
+if __name__ == "__main__":
+    # MPPI介入制御器の処理段階ごとの処理時間を表示し，測定の有無による処理時間の差を測る
+    import numpy as np
+    from vehiclemodel import VehicleModel, RolloutBackend
+    from mppi import MPPIFilter, DiagnosticsLevel
+    from keepoutareas import CircleKeepoutArea
+
+
+    def create_mppi_filter(profiler):
+        mppi_filter = MPPIFilter(
+            vehiclemodel=VehicleModel(rollout_backend=RolloutBackend.Cumsum),
+            samplesize=512,
+            horizon=50,
+            command_std=0.7,
+            preallocate=True,
+            diagnostics=DiagnosticsLevel.Summary,
+            use_arc_check=True,
+            rng=np.random.default_rng(0),
+            profiler=profiler
+        )
+        mppi_filter.set_keepoutareas([CircleKeepoutArea(20., 0., 4.)])
+        return mppi_filter
+
+
+    def measure(mppi_filter, n_calls=2000) -> float:
+        total_ns = 0
+        for _ in range(n_calls):
+            start = perf_counter_ns()
+            mppi_filter.get_filtered_command(0., 0., 0., 10., 0.)
+            total_ns += perf_counter_ns() - start
+        return total_ns / n_calls * 1e-9
+
+
+    profiler = StageProfiler()
+    measure(create_mppi_filter(None), 100)  # 立ち上がりの分を除く
+    disabled_time = measure(create_mppi_filter(None))
+    enabled_time = measure(create_mppi_filter(profiler))
+    print(f"{'stage':<10} {'count':>7} {'mean[us]':>9} {'p50[us]':>9} {'p99[us]':>9}")
+    for stage, summary in profiler.get_summary().items():
+        print(f"{stage:<10} {summary['count']:>7d} {summary['mean'] * 1e6:>9.1f} "
+              f"{summary['p50'] * 1e6:>9.1f} {summary['p99'] * 1e6:>9.1f}")
+    print(f"Mean time without profiler: {disabled_time * 1e6:.1f} us, with profiler: {enabled_time * 1e6:.1f} us")
@@ -1,2 +1,3 @@
 from .dict_viewer import DictViewer
 from .intervenable_scalar_view import IntervenableScalarView
+from .dirty_rects import blit_dirty
@@ -38,15 +38,49 @@ class DictViewer(Sprite):
                 self.font.render(key, True, key_color),
                 (0, height_per_item * i)
             )
+        self.surface.fill(background_color)
+        self.surface.blit(self.keys_surface, (padding, padding))
 
-    def set_values(self, values: list[str]):
-        self.surface.fill(self.background_color)
+        # 1文字ずつレンダリングしたものを使い回す
+        self.glyphs: dict[str, Surface] = {}
+        # 今表示しているvalues．Noneはまだ何も表示していないことを表す
+        self.values: list[str | None] = [None] * len(keys)
+
+    def get_glyph(self, character: str) -> Surface:
+        glyph = self.glyphs.get(character)
+        if glyph is None:
+            glyph = self.font.render(character, False, self.value_color, self.background_color)
+            self.glyphs[character] = glyph
+        return glyph
+
+    def get_value_rect(self, i: int) -> Rect:
+        """i番目の値を表示する領域を，`surface`上の座標で返す．"""
+        return Rect(
+            self.key_width + self.padding,
+            self.height_per_item * i + self.padding,
+            self.surface.get_width() - self.key_width - self.padding * 2,
+            self.height_per_item
+        )
+
+    def set_values(self, values: list[str]) -> list[Rect]:
+        """
+        値を表示する．前回から変わった値だけを，使い回した文字の画像を並べて描き直す．
+        描き直した領域を`surface`上の座標で返す．
+        """
+        dirty_rects = []
         for i, value in enumerate(values):
-            self.surface.blit(
-                self.font.render(value, False, self.value_color),
-                (self.key_width + self.padding, self.height_per_item * i + self.padding)
-            )
-        self.surface.blit(self.keys_surface, (self.padding, self.padding))
+            if value == self.values[i]:
+                continue
+            self.values[i] = value
+            rect = self.get_value_rect(i)
+            self.surface.fill(self.background_color, rect)
+            x = rect.x
+            for character in value:
+                glyph = self.get_glyph(character)
+                self.surface.blit(glyph, (x, rect.y))
+                x += glyph.get_width()
+            dirty_rects.append(rect)
+        return dirty_rects
 
     def update(self, *args, **kwargs):
         pass
@@ -55,25 +89,29 @@ class DictViewer(Sprite):
 if __name__ == "__main__":
     from pygame import *
     from math import sin, cos
+    from dirty_rects import blit_dirty
 
     init()
     screen = display.set_mode((500, 500))
 
     view = DictViewer(width=300, keys=["x", "sin x", "cos x", "Feeling"])
 
+    # 最初に全体を描き，以降は変わった所だけを画面に反映する
+    screen.fill("chartreuse")
+    screen.blit(view.surface, (100, 100))
+    display.flip()
+
     x = -1.0
     while x <= 1.0:
         feeling = "Happy" if sin(10 * x) >= 0 else "Bad"
-        view.set_values([
+        dirty_rects = view.set_values([
             f"{x:.03f}",
             f"{sin(x):.03f}",
             f"{cos(x):.03f}",
             feeling
         ])
 
-        screen.fill("chartreuse")
-        screen.blit(view.surface, (100, 100))
-        display.flip()
+        display.update(blit_dirty(screen, view.surface, (100, 100), dirty_rects))
 
         x += 0.01
         time.wait(10)
@@ -0,0 +1,15 @@
+from pygame.surface import Surface
+from pygame import Rect
+
+
+def blit_dirty(screen: Surface, surface: Surface, position: tuple[int, int], dirty_rects: list[Rect]) -> list[Rect]:
+    """
+    GUIコンポーネントのsurfaceのうち，dirty_rectsの部分だけをscreenのpositionの位置へ描き写す．
+    描き写した領域をscreen上の座標で返すので，そのまま`pygame.display.update`に渡せる．
+    """
+    screen_rects = []
+    for rect in dirty_rects:
+        screen_rect = rect.move(position)
+        screen.blit(surface, screen_rect, area=rect)
+        screen_rects.append(screen_rect)
+    return screen_rects
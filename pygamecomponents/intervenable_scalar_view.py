@@ -30,7 +30,11 @@ class IntervenableScalarView(Sprite):
         self.half_value_width = value_width / 2
 
         self.surface = Surface((width, height))
+        self.surface.fill(nominal_background_color)
         self.is_intervning = False
+        # 今描いている入力の領域．Noneはまだ何も描いていないことを表す
+        self.nominal_value_rect: Rect | None = None
+        self.intervening_value_rect: Rect | None = None
 
     def calc_value_rect(self, value: float) -> Rect:
         return Rect(
@@ -40,14 +44,44 @@ class IntervenableScalarView(Sprite):
             self.surface.get_height()
         )
 
-    def set_nominal(self, nominal_value: float):
-        self.surface.fill(self.nominal_background_color)
-        draw_rect(self.surface, self.nominal_value_color, self.calc_value_rect(nominal_value))
-
-    def set_intervening(self, nominal_value: float, intervening_value: float):
-        self.surface.fill(self.intervening_background_color)
-        draw_rect(self.surface, self.nominal_value_color, self.calc_value_rect(nominal_value))
-        draw_rect(self.surface, self.intervning_value_color, self.calc_value_rect(intervening_value))
+    def redraw(self, is_intervening: bool, nominal_value_rect: Rect, intervening_value_rect: Rect | None) -> list[Rect]:
+        """
+        前回から変わった所だけを描き直し，描き直した領域を`surface`上の座標で返す．
+        介入の有無が変わった時は背景ごと全体を描き直す．
+        """
+        if (
+                is_intervening == self.is_intervning
+                and nominal_value_rect == self.nominal_value_rect
+                and intervening_value_rect == self.intervening_value_rect
+        ):
+            return []
+        background_color = self.intervening_background_color if is_intervening else self.nominal_background_color
+        if is_intervening != self.is_intervning or self.nominal_value_rect is None:
+            self.surface.fill(background_color)
+            dirty_rects = [self.surface.get_rect()]
+        else:
+            # 前回描いた入力を背景で消す
+            dirty_rects = [self.nominal_value_rect]
+            if self.intervening_value_rect is not None:
+                dirty_rects.append(self.intervening_value_rect)
+            for rect in dirty_rects:
+                self.surface.fill(background_color, rect)
+            dirty_rects.append(nominal_value_rect)
+            if intervening_value_rect is not None:
+                dirty_rects.append(intervening_value_rect)
+        draw_rect(self.surface, self.nominal_value_color, nominal_value_rect)
+        if intervening_value_rect is not None:
+            draw_rect(self.surface, self.intervning_value_color, intervening_value_rect)
+        self.is_intervning = is_intervening
+        self.nominal_value_rect = nominal_value_rect
+        self.intervening_value_rect = intervening_value_rect
+        return [rect.clip(self.surface.get_rect()) for rect in dirty_rects]
+
+    def set_nominal(self, nominal_value: float) -> list[Rect]:
+        return self.redraw(False, self.calc_value_rect(nominal_value), None)
+
+    def set_intervening(self, nominal_value: float, intervening_value: float) -> list[Rect]:
+        return self.redraw(True, self.calc_value_rect(nominal_value), self.calc_value_rect(intervening_value))
 
     def update(self, *args, **kwargs):
         pass
@@ -56,22 +90,23 @@ class IntervenableScalarView(Sprite):
 if __name__ == "__main__":
     from pygame import *
     from math import sin
+    from dirty_rects import blit_dirty
 
     init()
     screen = display.set_mode((500, 500))
+    screen.fill("chartreuse")
+    display.flip()
 
     nominal_view = IntervenableScalarView(width=200, min_value=-1., max_value=1.)
     intervening_view = IntervenableScalarView(width=300, min_value=-1., max_value=1.)
 
     x = -2.0
     while x <= 2.0:
-        nominal_view.set_nominal(x)
-        intervening_view.set_intervening(x, sin(x * 3))
-
-        screen.fill("chartreuse")
-        screen.blit(nominal_view.surface, (100, 100))
-        screen.blit(intervening_view.surface, (50, 200))
-        display.flip()
+        # 変わった所だけを画面に反映する
+        display.update(
+            blit_dirty(screen, nominal_view.surface, (100, 100), nominal_view.set_nominal(x))
+            + blit_dirty(screen, intervening_view.surface, (50, 200), intervening_view.set_intervening(x, sin(x * 3)))
+        )
 
         x += 0.1
         time.wait(100)
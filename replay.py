@@ -0,0 +1,219 @@
+"""
+記録したテレメトリをMPPI介入制御器に流し直し，判断の違いと処理時間を調べる．
+
+    uv run replay.py Records/20250301.120000.csv
+    uv run replay.py Records/*.csv --workers 4 --save Records/replay.json
+
+テレメトリはgaming.pyが書き出したCSV，または`TelemetryRecorder`のチャンクのフォルダを読み込める．
+各フレームの車の状態とノミナル入力，障害物の位置と大きさから立ち入り禁止領域を作り直し，
+乱数の種を固定した`MPPIFilter.get_filtered_command`を呼び直して，記録されたフィルタ後の入力や処理時間と比べる．
+MPPI介入制御器を別スレッドで動かしていたセッションでは，記録された入力は先読みした状態に対するものなので，差が大きくなる．
+"""
+# 標準
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from time import perf_counter_ns
+from typing import Optional
+
+# サードパーティー
+import click
+import numpy as np
+import pandas as pd
+from numpy import percentile
+
+# 自プロジェクト
+from mppi import FilteringFlow
+from keepoutareas import KeepoutArea, CircleKeepoutArea, MovingCircleKeepoutAreas
+from telemetry import load_telemetry_dataframe
+from headless import create_mppi_filter
+
+# 数値として読む列．以前のCSVでは障害物が無い時に"(0.0,)"と書かれていることがあるので，読めない値は欠損にする
+NUMERIC_COLUMNS = [
+    "VehicleLocationX", "VehicleLocationY", "VehicleSpeed", "VehicleDirection",
+    "ObstacleLocationX", "ObstacleLocationY", "ObstacleRadius2", "ObstacleVelocityX", "ObstacleVelocityY",
+    "ControlNominalSteer", "ControlFilteredSteer", "MPPIFilterComputationTime",
+]
+
+
+@dataclass
+class ReplayResult:
+    """1つのセッションを流し直した結果を記述する．"""
+    session: str
+    ticks: int
+    # 介入したかどうかの判断が記録と食い違ったフレームの数
+    flow_mismatches: int
+    recorded_interventions: int
+    replayed_interventions: int
+    # フィルタ後のステアリング入力の，記録との差の絶対値
+    steer_diff_mean: float
+    steer_diff_max: float
+    # 処理時間[s]
+    replayed_latency_p50: float
+    replayed_latency_p99: float
+    recorded_latency_p50: float
+    recorded_latency_p99: float
+
+
+def load_session(path: Path) -> pd.DataFrame:
+    """CSV，または`TelemetryRecorder`のチャンクのフォルダからテレメトリを読み込む．"""
+    if path.is_dir():
+        df = load_telemetry_dataframe(path)
+    else:
+        df = pd.read_csv(path, index_col=0)
+    for column in NUMERIC_COLUMNS:
+        if column in df:
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+        else:
+            df[column] = 0.
+    return df
+
+
+def create_keepoutarea(row) -> Optional[KeepoutArea]:
+    """テレメトリの1行から障害物の立ち入り禁止領域を作る．障害物が無ければNoneを返す．"""
+    if not (row.ObstacleRadius2 > 0) or np.isnan(row.ObstacleLocationX) or np.isnan(row.ObstacleLocationY):
+        return None
+    radius = float(np.sqrt(row.ObstacleRadius2))
+    velocity_x = 0. if np.isnan(row.ObstacleVelocityX) else row.ObstacleVelocityX
+    velocity_y = 0. if np.isnan(row.ObstacleVelocityY) else row.ObstacleVelocityY
+    if velocity_x == 0. and velocity_y == 0.:
+        return CircleKeepoutArea(row.ObstacleLocationX, row.ObstacleLocationY, radius)
+    return MovingCircleKeepoutAreas(
+        [row.ObstacleLocationX], [row.ObstacleLocationY], [radius], [velocity_x], [velocity_y]
+    )
+
+
+def replay_session(
+        path: Path,
+        seed: int,
+        samplesize: int,
+        horizon: int,
+        ticks_save_to: Optional[Path] = None
+) -> ReplayResult:
+    """セッションを1つ流し直す．ticks_save_toを与えると，フレームごとの比較をCSVで保存する．"""
+    df = load_session(path)
+    mppi_filter = create_mppi_filter(samplesize, horizon, np.random.default_rng(seed))
+
+    n_ticks = len(df)
+    replayed_steers = np.empty(n_ticks)
+    replayed_interventions = np.zeros(n_ticks, dtype=bool)
+    latencies_ns = np.empty(n_ticks, dtype=np.int64)
+    handle: Optional[int] = None
+    obstacle_geometry = None
+    for i, row in enumerate(df.itertuples(index=False)):
+        # 障害物が変わった時だけ立ち入り禁止領域を差し替える
+        geometry = (row.ObstacleLocationX, row.ObstacleLocationY, row.ObstacleRadius2,
+                    row.ObstacleVelocityX, row.ObstacleVelocityY)
+        if geometry != obstacle_geometry:
+            obstacle_geometry = geometry
+            keepoutarea = create_keepoutarea(row)
+            if handle is not None:
+                mppi_filter.remove_keepoutarea(handle)
+                handle = None
+            if keepoutarea is not None:
+                handle = mppi_filter.add_keepoutarea(keepoutarea)
+
+        start = perf_counter_ns()
+        result = mppi_filter.get_filtered_command(
+            initial_location_x=row.VehicleLocationX,
+            initial_location_y=row.VehicleLocationY,
+            initial_direction=row.VehicleDirection,
+            initial_speed=row.VehicleSpeed,
+            nominal_command=row.ControlNominalSteer,
+        )
+        latencies_ns[i] = perf_counter_ns() - start
+        replayed_steers[i] = result.filtered_command
+        replayed_interventions[i] = result.flow == FilteringFlow.Intervention
+
+    recorded_steers = df["ControlFilteredSteer"].to_numpy()
+    recorded_interventions = (df["MPPIFilterFilteringFlowName"] == FilteringFlow.Intervention.name).to_numpy()
+    recorded_latencies = df["MPPIFilterComputationTime"].to_numpy()
+    steer_diffs = np.abs(replayed_steers - recorded_steers)
+    latencies = latencies_ns / 1e9
+
+    if ticks_save_to is not None:
+        ticks_save_to.parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame({
+            "GameStep": df["GameStep"] if "GameStep" in df else np.arange(n_ticks),
+            "RecordedFilteredSteer": recorded_steers,
+            "ReplayedFilteredSteer": replayed_steers,
+            "RecordedIntervention": recorded_interventions,
+            "ReplayedIntervention": replayed_interventions,
+            "RecordedComputationTime": recorded_latencies,
+            "ReplayedComputationTime": latencies,
+        }).to_csv(ticks_save_to)
+
+    empty = n_ticks == 0
+    return ReplayResult(
+        session=str(path),
+        ticks=n_ticks,
+        flow_mismatches=int((recorded_interventions != replayed_interventions).sum()),
+        recorded_interventions=int(recorded_interventions.sum()),
+        replayed_interventions=int(replayed_interventions.sum()),
+        steer_diff_mean=0. if empty else float(steer_diffs.mean()),
+        steer_diff_max=0. if empty else float(steer_diffs.max()),
+        replayed_latency_p50=0. if empty else float(percentile(latencies, 50)),
+        replayed_latency_p99=0. if empty else float(percentile(latencies, 99)),
+        recorded_latency_p50=0. if empty else float(np.nanpercentile(recorded_latencies, 50)),
+        recorded_latency_p99=0. if empty else float(np.nanpercentile(recorded_latencies, 99)),
+    )
+
+
+def replay_sessions(
+        paths: list[Path],
+        workers: int,
+        seed: int,
+        samplesize: int,
+        horizon: int,
+        ticks_directory: Optional[Path] = None
+) -> list[ReplayResult]:
+    """セッションごとに独立に，プロセスプールで並列に流し直す．"""
+    arguments = [
+        (path, seed, samplesize, horizon,
+         None if ticks_directory is None else ticks_directory / f"{path.stem}.replay.csv")
+        for path in paths
+    ]
+    if workers <= 1 or len(paths) <= 1:
+        return [replay_session(*argument) for argument in arguments]
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        return list(executor.map(replay_session, *zip(*arguments)))
+
+
+def print_results(results: list[ReplayResult]):
+    header = f"{'session':<40} {'ticks':>7} {'flow diff':>9} {'steer diff max':>14} " \
+             f"{'p50[us]':>9} {'p99[us]':>9} {'rec p50[us]':>11} {'rec p99[us]':>11}"
+    print(header)
+    for result in results:
+        print(
+            f"{Path(result.session).name:<40} {result.ticks:>7d} {result.flow_mismatches:>9d} "
+            f"{result.steer_diff_max:>14.4f} "
+            f"{result.replayed_latency_p50 * 1e6:>9.1f} {result.replayed_latency_p99 * 1e6:>9.1f} "
+            f"{result.recorded_latency_p50 * 1e6:>11.1f} {result.recorded_latency_p99 * 1e6:>11.1f}"
+        )
+
+
+@click.command()
+@click.argument("sessions", type=click.Path(exists=True, path_type=Path), nargs=-1, required=True)
+@click.option("--workers", type=int, default=1, show_default=True)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--samplesize", type=int, default=512, show_default=True)
+@click.option("--horizon", type=int, default=50, show_default=True)
+@click.option("--ticks", "ticks_directory", type=click.Path(path_type=Path), default=None,
+              help="フレームごとの比較をこのフォルダへCSVで保存する．")
+@click.option("--save", "save_to", type=click.Path(path_type=Path), default=None,
+              help="セッションごとの結果をJSONで保存する．")
+def main(sessions, workers, seed, samplesize, horizon, ticks_directory, save_to):
+    results = replay_sessions(list(sessions), workers, seed, samplesize, horizon, ticks_directory)
+    print_results(results)
+    if save_to is not None:
+        save_to.parent.mkdir(parents=True, exist_ok=True)
+        save_to.write_text(json.dumps({
+            "settings": {"seed": seed, "samplesize": samplesize, "horizon": horizon},
+            "results": [asdict(result) for result in results]
+        }, indent=2))
+        print("Saved Replay Results to", save_to)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+MPPI介入制御器のステアリング入力候補の元になるノイズの作り方．
+
+    uv run samplers.py
+    uv run samplers.py --samplesize 64 --samplesize 128 --samplesize 256 --samplesize 512 --situations 50
+
+直接実行すると，サンプラーごと・サンプルサイズごとに，フィルタされた入力の誤差（大きなサンプルサイズで求めた値との差）を測り，
+`GaussianSampler`の--baseline-samplesizeでの誤差と同じ誤差になるサンプルサイズを求める．
+介入時の重みは少数のサンプルに集中しやすく（有効サンプル数が数個），その場合はどのサンプラーでも誤差は緩やかにしか減らない．
+誤差の基準は`GaussianSampler`で求めるので，入力列の分布そのものが異なる`KnotInterpolatedSampler`の誤差には，分布の違いによる差も含まれる．
+"""
+from abc import ABC, abstractmethod
+from typing import Literal, Optional
+from numpy import ndarray, dtype, multiply, clip, ndindex, empty, eye, linspace, arange, matmul, sqrt, interp
+from numpy.random import Generator, default_rng
+
+
+class CommandSampler(ABC):
+    """
+    （…，サンプルサイズ，ホライズン）の配列を，平均0，分散1のノイズで埋める．
+    `MPPIFilter`はこれにcommand_stdを掛け，前回の最適入力を足して，上下限で切ったものをステアリング入力候補にする．
+    """
+
+    def prepare(self, samplesize: int, horizon: int, dtype: dtype):
+        """
+        `MPPIFilter`の作成時に1回だけ呼ばれる．前もって計算しておくものがあれば，ここで計算すること．
+        """
+        pass
+
+    @abstractmethod
+    def fill(self, out: ndarray, rng: Generator) -> ndarray:
+        """
+        outをノイズで埋めて返す．outは（…，サンプルサイズ，ホライズン）の形で，転置した配列の見方のこともある．
+        """
+        pass
+
+
+class GaussianSampler(CommandSampler):
+    """全ての要素を独立な標準正規分布から生成する．"""
+
+    def fill(self, out: ndarray, rng: Generator) -> ndarray:
+        # 要素は全て独立なので，メモリ上で連続している向きのまま埋める
+        rng.standard_normal(dtype=out.dtype, out=out.T if out.T.flags.c_contiguous else out)
+        return out
+
+
+class QMCSampler(CommandSampler):
+    def __init__(
+            self,
+            kind: Literal["sobol", "halton"] = "sobol",
+            pool_size: Optional[int] = None,
+            seed: Optional[int] = None
+    ):
+        """
+        スクランブルしたSobol列またはHalton列（低食い違い量列）を標準正規分布へ写したものをノイズにする．
+        同じ推定精度を，独立な正規乱数より少ないサンプルで得られることが多い．
+
+        点列は`prepare`でホライズン次元の点をpool_size個だけ計算しておく．
+        毎回の`fill`では，その中から連続したサンプルサイズ個の点を乱数で選び，予測ステップごとに乱数で符号を反転して書き込む．
+        符号の反転は標準正規分布を変えず，[0,1)の点列ではu→1-uの折り返しに当たるので，点列の偏りの少なさも保たれる．
+        毎回の処理は配列の掛け算1回で済む．
+        Sobol列では，サンプルサイズを2の冪にすると，選ぶ塊がSobol列の区切りに揃い，最も偏りが少なくなる．
+
+        Parameters
+        ----------
+        kind:Literal["sobol","halton"]
+        pool_size:Optional[int]
+            前もって計算しておく点の数．省略するとサンプルサイズの16倍（4096以上）にする．Sobol列では2の冪に切り上げる．
+        seed:Optional[int]
+            点列のスクランブルに使う乱数の種．
+        """
+        self.kind = kind
+        self.pool_size = pool_size
+        self.seed = seed
+        self.pool: Optional[ndarray] = None
+
+    def prepare(self, samplesize: int, horizon: int, dtype: dtype):
+        from scipy.stats import qmc
+        from scipy.special import ndtri
+
+        pool_size = self.pool_size if self.pool_size is not None else max(16 * samplesize, 4096)
+        if pool_size < samplesize:
+            raise ValueError(f"Pool Size {pool_size} is smaller than Sample Size {samplesize}")
+        rng = default_rng(self.seed)
+        if self.kind == "sobol":
+            m = (pool_size - 1).bit_length()
+            points = qmc.Sobol(d=horizon, scramble=True, seed=rng).random_base2(m)
+        else:
+            points = qmc.Halton(d=horizon, scramble=True, seed=rng).random(pool_size)
+        # 0と1はちょうど±無限大に写るので，わずかに内側へ寄せる
+        clip(points, 1e-12, 1. - 1e-12, out=points)
+        self.pool = ndtri(points).astype(dtype)
+        self.samplesize = samplesize
+        # 塊の先頭として選べる位置．サンプルサイズで割り切れるなら，その倍数だけにする
+        n_points = self.pool.shape[0]
+        if n_points % samplesize == 0:
+            self.n_starts, self.start_stride = n_points // samplesize, samplesize
+        else:
+            self.n_starts, self.start_stride = n_points - samplesize + 1, 1
+
+    def fill(self, out: ndarray, rng: Generator) -> ndarray:
+        *batch_shape, samplesize, horizon = out.shape
+        if self.pool is None or self.pool.shape[1] != horizon or self.samplesize != samplesize:
+            self.prepare(samplesize, horizon, out.dtype)
+        for index in ndindex(*batch_shape):
+            start = int(rng.integers(self.n_starts)) * self.start_stride
+            signs = rng.integers(0, 2, size=horizon).astype(out.dtype)
+            signs *= 2
+            signs -= 1
+            multiply(self.pool[start:start + samplesize], signs, out=out[index])
+        return out
+
+
+class KnotInterpolatedSampler(CommandSampler):
+    def __init__(
+            self,
+            n_knots: int = 6,
+            interpolation: Literal["linear", "cubic"] = "cubic",
+            knot_sampler: Optional[CommandSampler] = None
+    ):
+        """
+        1つのステアリング入力列につきn_knots個の節点だけをノイズとして作り，ホライズン全体へ補間して滑らかな列にする．
+        補間は前もって計算した（節点の数，ホライズン）の補間行列との行列積1回で済み，乱数の数はホライズン/n_knots倍に減る．
+        補間した値の分散が予測ステップによらず1になるよう，補間行列の各列（予測ステップ）をその長さで割っておく．
+
+        Parameters
+        ----------
+        n_knots:int
+            節点の数．節点は予測ステップ0からホライズン-1までに等間隔に置く．
+        interpolation:Literal["linear","cubic"]
+            節点の間の補間の方法．cubicは自然3次スプライン．
+        knot_sampler:Optional[CommandSampler]
+            節点のノイズの作り方．省略すると`GaussianSampler`を使う．次元が低いので`QMCSampler`とも相性が良い．
+        """
+        self.n_knots = n_knots
+        self.interpolation = interpolation
+        self.knot_sampler = knot_sampler if knot_sampler is not None else GaussianSampler()
+        self.interpolation_matrix: Optional[ndarray] = None
+
+    def create_interpolation_matrix(self, horizon: int) -> ndarray:
+        """（節点の数，ホライズン）の補間行列を作る．各列の長さは1．"""
+        knot_steps = linspace(0., horizon - 1, self.n_knots)
+        steps = arange(horizon)
+        if self.interpolation == "cubic":
+            from scipy.interpolate import CubicSpline
+            # 単位行列を補間すると，各節点の値が各予測ステップへ与える重みが得られる
+            matrix = CubicSpline(knot_steps, eye(self.n_knots), bc_type="natural")(steps).T
+        else:
+            matrix = empty(shape=(self.n_knots, horizon))
+            for knot, values in enumerate(eye(self.n_knots)):
+                matrix[knot] = interp(steps, knot_steps, values)
+        matrix /= sqrt((matrix * matrix).sum(axis=0))
+        return matrix
+
+    def prepare(self, samplesize: int, horizon: int, dtype: dtype):
+        self.interpolation_matrix = self.create_interpolation_matrix(horizon).astype(dtype)
+        self.interpolation_matrix_T = self.interpolation_matrix.T.copy()
+        self.knot_sampler.prepare(samplesize, self.n_knots, dtype)
+        # 1台分の節点の書き込み先．（サンプルサイズ，節点の数）
+        self.knots = empty(shape=(samplesize, self.n_knots), dtype=dtype)
+
+    def fill(self, out: ndarray, rng: Generator) -> ndarray:
+        *batch_shape, samplesize, horizon = out.shape
+        if self.interpolation_matrix is None or self.interpolation_matrix.shape[1] != horizon \
+                or self.knots.shape[0] != samplesize or self.knots.dtype != out.dtype:
+            self.prepare(samplesize, horizon, out.dtype)
+        if not batch_shape and out.T.flags.c_contiguous:
+            # 時間方向が先頭の作業領域には，配列を確保せずに書き込む
+            self.knot_sampler.fill(self.knots, rng)
+            matmul(self.interpolation_matrix_T, self.knots.T, out=out.T)
+            return out
+        knots = self.knot_sampler.fill(empty(shape=(*batch_shape, samplesize, self.n_knots), dtype=out.dtype), rng)
+        matmul(knots, self.interpolation_matrix, out=out)
+        return out
+
+
+if __name__ == "__main__":
+    # サンプラーごとに，フィルタされた入力の誤差とサンプルサイズの関係を調べる
+    import click
+    import numpy as np
+    from vehiclemodel import VehicleModel, RolloutBackend
+    from mppi import MPPIFilter, FilteringFlow, DiagnosticsLevel
+    from keepoutareas import CircleKeepoutArea
+
+    SAMPLERS = {
+        "gaussian": lambda seed: GaussianSampler(),
+        "sobol": lambda seed: QMCSampler("sobol", seed=seed),
+        "halton": lambda seed: QMCSampler("halton", seed=seed),
+        "knots": lambda seed: KnotInterpolatedSampler(),
+        "knots-sobol": lambda seed: KnotInterpolatedSampler(knot_sampler=QMCSampler("sobol", seed=seed)),
+    }
+
+
+    def create_situations(n_situations: int, rng: Generator) -> list[tuple[float, float, float, float]]:
+        """原点からx軸の正の向きに進む車が介入される状況（障害物のx, y, 半径と車の速度）を作る．"""
+        situations = []
+        while len(situations) < n_situations:
+            situation = (rng.uniform(15., 35.), rng.normal(0., 2.), rng.uniform(2., 5.), rng.uniform(8., 16.))
+            mppi_filter = create_mppi_filter(GaussianSampler(), 64, rng)
+            if get_filtered_command(mppi_filter, situation)[1] == FilteringFlow.Intervention:
+                situations.append(situation)
+        return situations
+
+
+    def create_mppi_filter(sampler: CommandSampler, samplesize: int, rng: Generator) -> MPPIFilter:
+        return MPPIFilter(
+            vehiclemodel=VehicleModel(rollout_backend=RolloutBackend.Cumsum),
+            samplesize=samplesize,
+            horizon=50,
+            command_std=0.7,
+            temperature=1.0,
+            violation_weight_decay=0.90,
+            preallocate=True,
+            diagnostics=DiagnosticsLevel.Nothing,
+            use_arc_check=True,
+            rng=rng,
+            sampler=sampler
+        )
+
+
+    def get_filtered_command(mppi_filter: MPPIFilter, situation) -> tuple[float, FilteringFlow]:
+        obstacle_x, obstacle_y, obstacle_radius, speed = situation
+        mppi_filter.set_keepoutareas([CircleKeepoutArea(obstacle_x, obstacle_y, obstacle_radius)])
+        # 毎回同じ中心からサンプリングさせる
+        mppi_filter.previous_optimal_command = 0.
+        result = mppi_filter.get_filtered_command(0., 0., 0., speed, 0.)
+        return result.filtered_command, result.flow
+
+
+    def get_rms_error(sampler_name, samplesize, situations, references, repeats, seed) -> float:
+        rng = np.random.default_rng(seed)
+        mppi_filter = create_mppi_filter(SAMPLERS[sampler_name](seed), samplesize, rng)
+        squared_errors = [
+            (get_filtered_command(mppi_filter, situation)[0] - reference) ** 2
+            for situation, reference in zip(situations, references)
+            for _ in range(repeats)
+        ]
+        return float(np.sqrt(np.mean(squared_errors)))
+
+
+    @click.command()
+    @click.option("--samplesize", "samplesizes", type=int, multiple=True, default=(64, 128, 256, 512, 1024),
+                  show_default=True)
+    @click.option("--sampler", "sampler_names", type=click.Choice(list(SAMPLERS)), multiple=True,
+                  default=tuple(SAMPLERS), show_default=True)
+    @click.option("--situations", "n_situations", type=int, default=30, show_default=True)
+    @click.option("--repeats", type=int, default=10, show_default=True, help="1つの状況で繰り返す回数．")
+    @click.option("--reference-samplesize", type=int, default=32768, show_default=True,
+                  help="誤差の基準にする，GaussianSamplerでのサンプルサイズ．")
+    @click.option("--reference-repeats", type=int, default=8, show_default=True,
+                  help="誤差の基準は，この回数だけ求めたフィルタされた入力の平均にする．")
+    @click.option("--baseline-samplesize", type=int, default=512, show_default=True)
+    @click.option("--seed", type=int, default=0, show_default=True)
+    def main(samplesizes, sampler_names, n_situations, repeats, reference_samplesize, reference_repeats,
+             baseline_samplesize, seed):
+        rng = np.random.default_rng(seed)
+        situations = create_situations(n_situations, rng)
+        reference_filter = create_mppi_filter(GaussianSampler(), reference_samplesize, rng)
+        references = [
+            np.mean([get_filtered_command(reference_filter, situation)[0] for _ in range(reference_repeats)])
+            for situation in situations
+        ]
+
+        samplesizes = sorted(samplesizes)
+        sampler_names = ["gaussian", *(name for name in sampler_names if name != "gaussian")]
+        errors = {
+            sampler_name: [
+                get_rms_error(sampler_name, samplesize, situations, references, repeats, seed + 1)
+                for samplesize in samplesizes
+            ]
+            for sampler_name in sampler_names
+        }
+        print(f"{'samplesize':>10} " + " ".join(f"{name:>10}" for name in sampler_names))
+        for i, samplesize in enumerate(samplesizes):
+            print(f"{samplesize:>10d} " + " ".join(f"{errors[name][i]:>10.5f}" for name in sampler_names))
+
+        # 誤差は両対数でサンプルサイズとほぼ直線の関係にあるので，直線を当てはめてGaussianSamplerと同じ誤差になるサンプルサイズを求める
+        log_samplesizes = np.log(samplesizes)
+        slope, intercept = np.polyfit(log_samplesizes, np.log(errors["gaussian"]), 1)
+        baseline_error = float(np.exp(intercept + slope * np.log(baseline_samplesize)))
+        print(f"RMS error of gaussian with samplesize {baseline_samplesize} (fitted): {baseline_error:.5f}")
+        for sampler_name in sampler_names:
+            slope, intercept = np.polyfit(log_samplesizes, np.log(errors[sampler_name]), 1)
+            if slope >= 0:
+                print(f"{sampler_name:<10} error does not decrease with samplesize")
+                continue
+            equivalent_samplesize = float(np.exp((np.log(baseline_error) - intercept) / slope))
+            print(f"{sampler_name:<10} needs samplesize {equivalent_samplesize:7.0f} "
+                  f"({equivalent_samplesize / baseline_samplesize:.2f}x) for the same error "
+                  f"(error ~ samplesize^{slope:.2f})")
+
+
+    main()
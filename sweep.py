@@ -0,0 +1,246 @@
+"""
+MPPI介入制御器の設定を格子状に振ってシナリオを走らせ，処理時間と介入の質のパレートフロントを求める．
+
+    uv run sweep.py --scenarios 64
+    uv run sweep.py --samplesize 128 --samplesize 256 --samplesize 512 --horizon 30 --horizon 50 --save Records/sweep.json
+    uv run sweep.py --session Records/20250301.120000.csv --session Records/20250302.090000
+
+シナリオはheadless.pyと同じく`VehicleModel`をプラントにして，閉ループで実行する．
+--sessionを与えると，記録したテレメトリから，障害物が初めて現れたフレームの車の状態と障害物を初期状態にし，
+記録されたノミナル入力をそのまま再生するシナリオを作る．
+設定ごとに，衝突率，障害物の縁までの最小距離，ノミナル入力からのずれ，処理時間（p50/p99）をまとめ，
+どの指標でも他に劣る設定を除いたもの（パレートフロント）を表示する．
+最後に，衝突せず最小距離が--min-clearance以上の設定のうち，p99の処理時間が最も短いものを推奨する．
+
+処理時間は並列に走る他のプロセスの影響を受けるので，比べる時は--workersを物理コア数以下にする．
+"""
+# 標準
+import json
+import os
+from dataclasses import dataclass, asdict, replace
+from itertools import product
+from pathlib import Path
+from typing import Optional
+
+# サードパーティー
+import click
+import numpy as np
+
+# 自プロジェクト
+from vehiclemodel import DEFAULT_FRAMETIME
+from headless import Scenario, ScenarioResult, SteerTrace, generate_scenarios, run_scenarios, summarize_results
+from replay import load_session
+
+
+@dataclass(frozen=True)
+class FilterSettings:
+    """掃引するMPPI介入制御器の設定の1組．"""
+    samplesize: int
+    horizon: int
+    command_std: float
+    temperature: float
+    violation_weight_decay: float
+
+
+@dataclass
+class SweepResult:
+    """1組の設定を全シナリオで走らせた結果を記述する．"""
+    settings: FilterSettings
+    collision_rate: float
+    # シナリオごとの最小距離[m]の最小値と1パーセンタイル
+    min_clearance_min: float
+    min_clearance_p1: float
+    intervention_ratio_mean: float
+    steer_deviation_mean: float
+    # 処理時間[s]．全シナリオの全ステップをまとめたパーセンタイル．立ち上がりの呼び出しは含まない
+    computation_time_p50: float
+    computation_time_p99: float
+    is_pareto_optimal: bool = False
+
+
+def create_session_scenario(path: Path, seed: int) -> Optional[Scenario]:
+    """
+    記録したテレメトリから，障害物が初めて現れたフレーム以降を再現するシナリオを作る．
+    車の速度はそのフレームの速度で一定とし，障害物はそのフレームの速度で等速直線運動させる．
+    障害物が一度も現れないセッションではNoneを返す．
+    """
+    df = load_session(path)
+    has_obstacle = (df["ObstacleRadius2"] > 0) & df["ObstacleLocationX"].notna() & df["ObstacleLocationY"].notna()
+    if not has_obstacle.any():
+        return None
+    start = int(np.argmax(has_obstacle.to_numpy()))
+    row = df.iloc[start]
+    steers = df["ControlNominalSteer"].iloc[start:].fillna(0.).to_list()
+    return Scenario(
+        name=path.stem,
+        seed=seed,
+        speed=float(row.VehicleSpeed),
+        steps=len(steers),
+        steer_script=SteerTrace(steers, DEFAULT_FRAMETIME),
+        obstacles=[(
+            float(row.ObstacleLocationX),
+            float(row.ObstacleLocationY),
+            float(np.sqrt(row.ObstacleRadius2)),
+            float(np.nan_to_num(row.ObstacleVelocityX)),
+            float(np.nan_to_num(row.ObstacleVelocityY)),
+        )],
+        initial_x=float(row.VehicleLocationX),
+        initial_y=float(row.VehicleLocationY),
+        initial_direction=float(row.VehicleDirection),
+    )
+
+
+def create_settings_grid(
+        samplesizes: list[int],
+        horizons: list[int],
+        command_stds: list[float],
+        temperatures: list[float],
+        violation_weight_decays: list[float]
+) -> list[FilterSettings]:
+    return [
+        FilterSettings(*values)
+        for values in product(samplesizes, horizons, command_stds, temperatures, violation_weight_decays)
+    ]
+
+
+def run_sweep(scenarios: list[Scenario], settings_grid: list[FilterSettings], workers: int) -> list[SweepResult]:
+    """全ての設定と全てのシナリオの組をまとめてプロセスプールで実行し，設定ごとに集計する．"""
+    tasks = [
+        replace(scenario, **asdict(settings))
+        for settings in settings_grid
+        for scenario in scenarios
+    ]
+    scenario_results = run_scenarios(tasks, workers)
+
+    sweep_results = []
+    n_scenarios = len(scenarios)
+    for i, settings in enumerate(settings_grid):
+        results: list[ScenarioResult] = scenario_results[i * n_scenarios:(i + 1) * n_scenarios]
+        summary = summarize_results(results)
+        sweep_results.append(SweepResult(
+            settings=settings,
+            collision_rate=summary["collision_rate"],
+            min_clearance_min=float(min(result.min_clearance for result in results)),
+            min_clearance_p1=summary["min_clearance_p1"],
+            intervention_ratio_mean=summary["intervention_ratio_mean"],
+            steer_deviation_mean=summary["steer_deviation_mean"],
+            computation_time_p50=summary["computation_time_p50"],
+            computation_time_p99=summary["computation_time_p99"],
+        ))
+    mark_pareto_front(sweep_results)
+    return sweep_results
+
+
+def get_objectives(result: SweepResult) -> tuple[float, ...]:
+    """パレートフロントを求める指標．いずれも小さいほど良い向きに揃える．"""
+    return (
+        result.computation_time_p99,
+        result.collision_rate,
+        -result.min_clearance_p1,
+        result.steer_deviation_mean,
+    )
+
+
+def mark_pareto_front(results: list[SweepResult]):
+    """他のどの結果にも支配されない（全ての指標で同等以下かつどれかで真に劣る相手がいない）結果に印を付ける．"""
+    objectives = np.array([get_objectives(result) for result in results])
+    for i, result in enumerate(results):
+        dominated_by = np.all(objectives <= objectives[i], axis=1) & np.any(objectives < objectives[i], axis=1)
+        result.is_pareto_optimal = not dominated_by.any()
+
+
+def choose_cheapest(results: list[SweepResult], min_clearance: float) -> Optional[SweepResult]:
+    """衝突せず，最小距離がmin_clearance以上の結果のうち，p99の処理時間が最も短いものを返す．"""
+    safe_results = [
+        result for result in results
+        if result.collision_rate == 0. and result.min_clearance_min >= min_clearance
+    ]
+    if not safe_results:
+        return None
+    return min(safe_results, key=lambda result: result.computation_time_p99)
+
+
+def print_results(results: list[SweepResult]):
+    print(
+        f"  {'samples':>7} {'horizon':>7} {'std':>5} {'temp':>5} {'decay':>5} "
+        f"{'collide':>7} {'clr min':>7} {'clr p1':>7} {'interv':>6} {'dev':>6} {'p50[us]':>8} {'p99[us]':>8}"
+    )
+    for result in sorted(results, key=lambda result: result.computation_time_p99):
+        settings = result.settings
+        print(
+            f"{'*' if result.is_pareto_optimal else ' '} "
+            f"{settings.samplesize:>7d} {settings.horizon:>7d} {settings.command_std:>5.2f} "
+            f"{settings.temperature:>5.2f} {settings.violation_weight_decay:>5.2f} "
+            f"{result.collision_rate:>7.3f} {result.min_clearance_min:>7.2f} {result.min_clearance_p1:>7.2f} "
+            f"{result.intervention_ratio_mean:>6.3f} {result.steer_deviation_mean:>6.3f} "
+            f"{result.computation_time_p50 * 1e6:>8.0f} {result.computation_time_p99 * 1e6:>8.0f}"
+        )
+    print("* : Pareto optimal")
+
+
+@click.command()
+@click.option("--samplesize", "samplesizes", type=int, multiple=True, default=(128, 256, 512, 1024), show_default=True)
+@click.option("--horizon", "horizons", type=int, multiple=True, default=(30, 50), show_default=True)
+@click.option("--command-std", "command_stds", type=float, multiple=True, default=(0.5, 0.7, 1.0), show_default=True)
+@click.option("--temperature", "temperatures", type=float, multiple=True, default=(1.0,), show_default=True)
+@click.option("--violation-weight-decay", "violation_weight_decays", type=float, multiple=True, default=(0.90,),
+              show_default=True)
+@click.option("--session", "sessions", type=click.Path(exists=True, path_type=Path), multiple=True,
+              help="記録したテレメトリ（CSV，またはチャンクのフォルダ）からシナリオを作る．与えなければ生成したシナリオを使う．")
+@click.option("--scenarios", "n_scenarios", type=int, default=32, show_default=True)
+@click.option("--steps", type=int, default=150, show_default=True, help="生成する1シナリオのステップ数．")
+@click.option("--mismatch", type=float, default=0., show_default=True, help="プラントのホイールベースのずれの割合．")
+@click.option("--noise-std", type=float, default=0., show_default=True, help="プラントに加えるノイズの標準偏差．")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--workers", type=int, default=os.cpu_count(), show_default=True)
+@click.option("--min-clearance", type=float, default=0., show_default=True,
+              help="推奨する設定に求める，障害物の縁までの最小距離[m]．")
+@click.option("--save", "save_to", type=click.Path(path_type=Path), default=None,
+              help="設定ごとの結果をJSONで保存する．")
+def main(samplesizes, horizons, command_stds, temperatures, violation_weight_decays, sessions, n_scenarios, steps,
+         mismatch, noise_std, seed, workers, min_clearance, save_to):
+    if sessions:
+        scenarios = []
+        for path in sessions:
+            scenario = create_session_scenario(path, seed)
+            if scenario is None:
+                print("Skipped Session without Obstacle:", path)
+                continue
+            scenarios.append(replace(scenario, mismatch=mismatch, noise_std=noise_std))
+        if not scenarios:
+            raise click.UsageError("No session has an obstacle.")
+    else:
+        scenarios = generate_scenarios(n_scenarios, seed, steps, mismatch, noise_std, 512, 50)
+    settings_grid = create_settings_grid(
+        list(samplesizes), list(horizons), list(command_stds), list(temperatures), list(violation_weight_decays)
+    )
+    print(f"Running {len(settings_grid)} settings x {len(scenarios)} scenarios")
+    results = run_sweep(scenarios, settings_grid, workers)
+    print_results(results)
+
+    cheapest = choose_cheapest(results, min_clearance)
+    if cheapest is None:
+        print("No settings kept every scenario out of the keepout areas.")
+    else:
+        print("Cheapest safe settings:", asdict(cheapest.settings))
+
+    if save_to is not None:
+        save_to.parent.mkdir(parents=True, exist_ok=True)
+        save_to.write_text(json.dumps({
+            "settings": {
+                "sessions": [str(path) for path in sessions],
+                "scenarios": len(scenarios),
+                "steps": steps,
+                "mismatch": mismatch,
+                "noise_std": noise_std,
+                "seed": seed,
+                "min_clearance": min_clearance,
+            },
+            "cheapest": None if cheapest is None else asdict(cheapest.settings),
+            "results": [asdict(result) for result in results]
+        }, indent=2))
+        print("Saved Sweep Results to", save_to)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+from dataclasses import dataclass, fields
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from time import perf_counter
+from typing import Optional
+from numpy import ndarray, empty, full, nan, isnan, float64, int64, load, savez, concatenate
+from pandas import DataFrame
+
+
+@dataclass
+class TelemetryRecord:
+    # 車
+    VehicleLocationX: float = 0.
+    VehicleLocationY: float = 0.
+    VehicleVelocityX: float = 0.
+    VehicleVelocityY: float = 0.
+    VehicleSpeed: float = 0.
+    VehicleAccelerationX: float = 0.
+    VehicleAccelerationY: float = 0.
+    VehicleDirection: float = 0.
+    # 障害物
+    ObstacleLocationX: float = 0.
+    ObstacleLocationY: float = 0.
+    ObstacleRadius2: float = 0.
+    ObstacleVelocityX: float = 0.
+    ObstacleVelocityY: float = 0.
+    # 制御
+    ControlThrottle: float = 0.
+    ControlNominalSteer: float = 0.
+    ControlFilteredSteer: float = 0.
+    ControlBrake: float = 0.
+    # MPPI
+    MPPIFilterComputationTime: float = 0.
+    MPPIFilterFilteringFlowName: str = ""
+    # 長さはMPPI介入制御器のホライズン．介入しなかったフレームではNone
+    MPPIOptimalSteerTrajectory: Optional[ndarray] = None
+    MPPIMinClearance: float = 0.
+    MPPIEffectiveSampleSize: float = 0.
+    # `StageProfiler`で測ったMPPI介入制御器の処理段階ごとの処理時間[s]．セッション開始からの分布のp50とp99
+    MPPITotalTimeP50: float = 0.
+    MPPITotalTimeP99: float = 0.
+    MPPINominalTimeP50: float = 0.
+    MPPINominalTimeP99: float = 0.
+    MPPIRolloutTimeP50: float = 0.
+    MPPIRolloutTimeP99: float = 0.
+    MPPIKeepoutTimeP50: float = 0.
+    MPPIKeepoutTimeP99: float = 0.
+    # ゲームシステム
+    GameTimestamp: float = 0.
+    GameActualFreshrate: float = 0.
+    GameStep: int = 0
+
+
+# 軌道の列の名前
+TRAJECTORY_COLUMN = "MPPIOptimalSteerTrajectory"
+# 文字列の列に保存できる最大の文字数
+STRING_COLUMN_WIDTH = 32
+
+
+class TelemetryRecorder:
+    def __init__(
+            self,
+            directory: Path,
+            trajectory_width: int,
+            chunk_size: int = 1024,
+            n_buffers: int = 4,
+            flush_interval: float = 5.
+    ):
+        """
+        `TelemetryRecord`を列ごとのNumPy配列に書き込み，別スレッドでNPZのチャンクとしてdirectoryへ書き出す．
+        メモリはchunk_size行の作業用配列n_buffers個分しか使わず，ゲームが途中で落ちても書き出し済みのチャンクは残る．
+
+        チャンクはchunk_size行が埋まった時と，最後の書き出しからflush_interval秒経った時に書き出す．
+        書き出しが追いつかず空いている作業用配列が無い場合は，空くまで待つ．
+
+        Parameters
+        ----------
+        directory:Path
+            チャンクを書き出すフォルダ．
+        trajectory_width:int
+            `MPPIOptimalSteerTrajectory`の列の幅．MPPI介入制御器のホライズンにする．これより長い軌道は切り詰め，短い軌道はNaNで埋める．
+        chunk_size:int
+            1つのチャンクの最大の行数．
+        n_buffers:int
+            作業用配列の数．
+        flush_interval:float
+            チャンクを書き出す最大の間隔[s]．
+        """
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.trajectory_width = trajectory_width
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+
+        self.scalar_columns: list[str] = []
+        self.column_dtypes: dict[str, object] = {}
+        for f in fields(TelemetryRecord):
+            if f.name == TRAJECTORY_COLUMN:
+                continue
+            self.scalar_columns.append(f.name)
+            self.column_dtypes[f.name] = {float: float64, int: int64, str: f"U{STRING_COLUMN_WIDTH}"}[f.type]
+
+        # 空いている作業用配列と，書き出しを待つ作業用配列
+        self.free_buffers: Queue[dict[str, ndarray]] = Queue()
+        for _ in range(n_buffers):
+            self.free_buffers.put(self.create_buffer())
+        self.flushing_buffers: Queue[Optional[tuple[dict[str, ndarray], int, int]]] = Queue()
+        self.buffer = self.free_buffers.get()
+        self.n_rows = 0
+        self.n_chunks = 0
+        self.n_total_rows = 0
+        self.last_flushed_at = perf_counter()
+
+        self.thread = Thread(target=self.work, name="TelemetryRecorder", daemon=True)
+        self.thread.start()
+
+    def create_buffer(self) -> dict[str, ndarray]:
+        buffer = {name: empty(self.chunk_size, dtype=dtype) for name, dtype in self.column_dtypes.items()}
+        buffer[TRAJECTORY_COLUMN] = full((self.chunk_size, self.trajectory_width), nan)
+        return buffer
+
+    def append(self, record: TelemetryRecord):
+        """1フレーム分のテレメトリを書き込む．"""
+        row = self.n_rows
+        buffer = self.buffer
+        for name in self.scalar_columns:
+            buffer[name][row] = getattr(record, name)
+        trajectory_row = buffer[TRAJECTORY_COLUMN][row]
+        trajectory = record.MPPIOptimalSteerTrajectory
+        if trajectory is None:
+            trajectory_row.fill(nan)
+        else:
+            width = min(len(trajectory), self.trajectory_width)
+            trajectory_row[:width] = trajectory[:width]
+            trajectory_row[width:] = nan
+        self.n_rows += 1
+        self.n_total_rows += 1
+        if self.n_rows == self.chunk_size or perf_counter() - self.last_flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """書き込み済みの行を書き出しスレッドへ渡し，新しい作業用配列に切り替える．"""
+        self.last_flushed_at = perf_counter()
+        if self.n_rows == 0:
+            return
+        self.flushing_buffers.put((self.buffer, self.n_rows, self.n_chunks))
+        self.n_chunks += 1
+        self.buffer = self.free_buffers.get()
+        self.n_rows = 0
+
+    def work(self):
+        """別スレッドで，渡されたチャンクを順に書き出す．"""
+        while True:
+            item = self.flushing_buffers.get()
+            if item is None:
+                return
+            buffer, n_rows, index = item
+            try:
+                savez(
+                    self.directory / f"chunk_{index:06d}.npz",
+                    **{name: column[:n_rows] for name, column in buffer.items()}
+                )
+            except Exception as e:
+                print("Error Writing Telemetry:", e)
+            self.free_buffers.put(buffer)
+
+    def close(self):
+        """残りの行を書き出し，書き出しスレッドが終わるまで待つ．"""
+        self.flush()
+        self.flushing_buffers.put(None)
+        self.thread.join()
+
+    def export_csv(self, path: Path):
+        """書き出し済みの全てのチャンクを1つのCSVにまとめる．`close`の後に呼ぶこと．"""
+        load_telemetry_dataframe(self.directory).to_csv(path)
+
+
+def load_telemetry_columns(directory: Path) -> dict[str, ndarray]:
+    """`TelemetryRecorder`が書き出したチャンクを読み込み，列ごとに繋げて返す．"""
+    chunks = []
+    for chunk_path in sorted(directory.glob("chunk_*.npz")):
+        with load(chunk_path) as chunk:
+            chunks.append({name: chunk[name] for name in chunk.files})
+    if not chunks:
+        return {}
+    return {name: concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+
+def load_telemetry_dataframe(directory: Path) -> DataFrame:
+    """
+    `TelemetryRecorder`が書き出したチャンクを1つの表にまとめる．
+    `MPPIOptimalSteerTrajectory`の列は，以前のCSVと同じく軌道をリストにしたものになる．
+    """
+    columns = load_telemetry_columns(directory)
+    if not columns:
+        return DataFrame()
+    trajectories = columns.pop(TRAJECTORY_COLUMN)
+    df = DataFrame(columns)
+    df[TRAJECTORY_COLUMN] = [trajectory[~isnan(trajectory)].tolist() for trajectory in trajectories]
+    return df[[f.name for f in fields(TelemetryRecord)]]
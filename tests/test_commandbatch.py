@@ -0,0 +1,47 @@
+"""
+CARLAの代わりに偽のクライアントと命令で，`CommandBatch`が溜めた命令を1回の`apply_batch`で送ることを確かめる．
+"""
+from types import SimpleNamespace
+
+from commandbatch import CommandBatch
+
+FAKE_COMMAND_MODULE = SimpleNamespace(
+    ApplyVehicleControl=lambda actor_id, control: ("ApplyVehicleControl", actor_id, control),
+    SetVehicleLightState=lambda actor_id, light_state: ("SetVehicleLightState", actor_id, light_state),
+)
+
+
+class FakeClient:
+    def __init__(self):
+        self.batches = []
+
+    def apply_batch(self, commands):
+        self.batches.append(commands)
+
+
+def test_flush_without_commands_sends_nothing():
+    client = FakeClient()
+    batch = CommandBatch(client, command_module=FAKE_COMMAND_MODULE)
+    batch.flush()
+    assert client.batches == []
+    assert batch.sent_batches == 0
+
+
+def test_flush_sends_commands_in_one_batch():
+    client = FakeClient()
+    batch = CommandBatch(client, command_module=FAKE_COMMAND_MODULE)
+    batch.apply_vehicle_control(1, "control")
+    batch.set_vehicle_light_state(1, "brake")
+    assert client.batches == []
+    batch.flush()
+    assert client.batches == [[("ApplyVehicleControl", 1, "control"), ("SetVehicleLightState", 1, "brake")]]
+    assert batch.sent_commands == 2
+    assert batch.sent_batches == 1
+    assert batch.commands == []
+
+    # 次のフレームの命令は別の通信で送る
+    batch.apply_vehicle_control(1, "next control")
+    batch.flush()
+    assert client.batches[1] == [("ApplyVehicleControl", 1, "next control")]
+    assert batch.sent_commands == 3
+    assert batch.sent_batches == 2
@@ -0,0 +1,133 @@
+"""
+float32で動かしたMPPI介入制御器が，float64と同じステアリング入力候補に対して十分近い入力を出すことを確かめる．
+gaming.pyが使う作業領域（preallocate）と，fused_chunk_sizeを与えた場合も，軌道予測の計算方式ごとに調べる．
+円だけでなく格子状の距離場や動く円の立ち入り禁止領域でも，計算の途中でfloat64に上がらないことを確かめる．
+"""
+import numpy as np
+import pytest
+
+from vehiclemodel import VehicleModel, RolloutBackend
+from mppi import MPPIFilter, FilteringFlow
+from keepoutareas import KeepoutArea, CircleKeepoutArea, GridKeepoutArea, MovingCircleKeepoutAreas
+
+TOLERANCE = 1e-4
+SAMPLESIZE = 512
+HORIZON = 50
+
+# MPPIFilterの計算経路ごとの追加の引数
+FILTERING_PATHS = {
+    "allocating": {},
+    "preallocate": {"preallocate": True},
+    "fused": {"fused_chunk_size": 128},
+}
+# float32でも判定の値がfloat64に上がらないことを確かめる立ち入り禁止領域の表し方
+KEEPOUTAREA_KINDS = ["circle", "grid", "moving_circle"]
+
+
+def create_mppi_filter(backend: RolloutBackend, dtype: np.dtype, path: str) -> MPPIFilter:
+    return MPPIFilter(
+        vehiclemodel=VehicleModel(rollout_backend=backend, dtype=dtype),
+        samplesize=SAMPLESIZE,
+        horizon=HORIZON,
+        command_std=0.7,
+        rng=np.random.default_rng(0),
+        **FILTERING_PATHS[path]
+    )
+
+
+@pytest.mark.parametrize("backend", list(RolloutBackend), ids=lambda backend: backend.name)
+@pytest.mark.parametrize("path", list(FILTERING_PATHS))
+def test_float32_filtered_command_matches_float64(backend: RolloutBackend, path: str):
+    rng = np.random.default_rng(0)
+    filter_float64 = create_mppi_filter(backend, np.float64, path)
+    filter_float32 = create_mppi_filter(backend, np.float32, path)
+    assert filter_float32.dtype == np.float32
+
+    n_interventions = 0
+    max_difference = 0.
+    for _ in range(50):
+        x, y = rng.uniform(-300., 300., size=2)
+        direction = rng.uniform(-np.pi, np.pi)
+        obstacle_distance = rng.uniform(10., 40.)
+        keepoutareas = [CircleKeepoutArea(
+            x + obstacle_distance * np.cos(direction) + rng.normal(0., 2.),
+            y + obstacle_distance * np.sin(direction) + rng.normal(0., 2.),
+            4.
+        )]
+        filter_float64.set_keepoutareas(keepoutareas)
+        filter_float32.set_keepoutareas(keepoutareas)
+        speed = rng.uniform(5., 20.)
+        nominal_command = rng.uniform(-0.3, 0.3)
+        commands_list = np.clip(rng.normal(nominal_command, 0.7, size=(SAMPLESIZE, HORIZON)), -1., 1.)
+        result_float64 = filter_float64.get_filtered_command(
+            x, y, direction, speed, nominal_command, commands_list=commands_list
+        )
+        result_float32 = filter_float32.get_filtered_command(
+            x, y, direction, speed, nominal_command, commands_list=commands_list.astype(np.float32)
+        )
+        assert result_float64.flow == result_float32.flow
+        n_interventions += result_float64.flow == FilteringFlow.Intervention
+        max_difference = max(max_difference, abs(result_float64.filtered_command - result_float32.filtered_command))
+
+    # 介入する場合を十分に調べていること
+    assert n_interventions >= 10
+    assert max_difference < TOLERANCE
+
+
+def create_keepoutarea(kind: str, x: float, y: float, dtype: np.dtype) -> KeepoutArea:
+    """(x, y)を中心とする半径4の円形の立ち入り禁止領域を，kindで指定した表し方で作る．"""
+    if kind == "circle":
+        return CircleKeepoutArea(x, y, 4.)
+    if kind == "grid":
+        grid = GridKeepoutArea(x - 20., y - 20., x + 20., y + 20., resolution=0.25, dtype=dtype)
+        grid.add_circle(x, y, 4.)
+        return grid
+    # 止まっている円と，その横をすれ違う円
+    return MovingCircleKeepoutAreas([x, x + 5.], [y, y + 20.], [4., 2.], [0., 0.], [0., -10.], dtype=dtype)
+
+
+@pytest.mark.parametrize("kind", KEEPOUTAREA_KINDS)
+def test_keepoutarea_checks_keep_float32(kind: str):
+    keepoutarea = create_keepoutarea(kind, 10., 0., np.float32)
+    keepoutarea.prepare_for_filtering(HORIZON, 0.04)
+    x = np.linspace(0., 20., 2 * (HORIZON + 1), dtype=np.float32).reshape(2, HORIZON + 1)
+    y = np.zeros_like(x)
+    assert keepoutarea.check(x, y).dtype == np.float32
+    assert keepoutarea.check_at_steps(x, y, np.arange(HORIZON + 1)).dtype == np.float32
+
+
+@pytest.mark.parametrize("kind", KEEPOUTAREA_KINDS)
+@pytest.mark.parametrize("path", list(FILTERING_PATHS))
+def test_float32_pipeline_does_not_upcast(kind: str, path: str):
+    rng = np.random.default_rng(1)
+    filter_float64 = create_mppi_filter(RolloutBackend.Cumsum, np.float64, path)
+    filter_float32 = create_mppi_filter(RolloutBackend.Cumsum, np.float32, path)
+    assert filter_float32.violation_weights.dtype == np.float32
+    assert filter_float32.remaining_violation_weights.dtype == np.float32
+
+    n_interventions = 0
+    max_difference = 0.
+    for _ in range(20):
+        x, y = rng.uniform(-300., 300., size=2)
+        direction = rng.uniform(-np.pi, np.pi)
+        obstacle_distance = rng.uniform(15., 30.)
+        obstacle_x = x + obstacle_distance * np.cos(direction)
+        obstacle_y = y + obstacle_distance * np.sin(direction)
+        filter_float64.set_keepoutareas([create_keepoutarea(kind, obstacle_x, obstacle_y, np.float64)])
+        filter_float32.set_keepoutareas([create_keepoutarea(kind, obstacle_x, obstacle_y, np.float32)])
+        commands_list = np.clip(rng.normal(0., 0.7, size=(SAMPLESIZE, HORIZON)), -1., 1.)
+        result_float64 = filter_float64.get_filtered_command(x, y, direction, 10., 0., commands_list=commands_list)
+        result_float32 = filter_float32.get_filtered_command(
+            x, y, direction, 10., 0., commands_list=commands_list.astype(np.float32)
+        )
+        assert result_float64.flow == result_float32.flow
+        if result_float32.flow != FilteringFlow.Intervention:
+            continue
+        n_interventions += 1
+        assert result_float32.sample_weights.dtype == np.float32
+        if result_float32.x_history_list is not None:
+            assert result_float32.x_history_list.dtype == np.float32
+        max_difference = max(max_difference, abs(result_float64.filtered_command - result_float32.filtered_command))
+
+    assert n_interventions >= 5
+    assert max_difference < TOLERANCE
@@ -0,0 +1,84 @@
+"""
+`GridKeepoutArea`の図形の追加と削除で部分的に計算し直した距離場が，残った図形から作り直した距離場と同じになることを確かめる．
+"""
+import numpy as np
+import pytest
+
+from keepoutareas import GridKeepoutArea, SignedDistanceShape, CircleShape, PolygonShape, PolylineShape
+
+GRID_BOUNDS = (-20., -15., 30., 25.)
+
+
+def create_grid(dtype: np.dtype) -> GridKeepoutArea:
+    return GridKeepoutArea(*GRID_BOUNDS, resolution=0.5, truncation=4., dtype=dtype)
+
+
+def create_shapes() -> list[SignedDistanceShape]:
+    """互いに重なる円，多角形，折れ線と，格子からはみ出す図形，格子の外の図形．"""
+    return [
+        CircleShape(0., 0., 3.),
+        PolygonShape(np.array([[-2., -2.], [6., -1.], [5., 5.], [-1., 4.]])),
+        PolylineShape(np.array([[-10., 0.], [0., 1.], [8., 8.]]), 1.),
+        CircleShape(4., 3., 2.5),
+        PolygonShape(np.array([[25., 20.], [40., 20.], [40., 30.]])),
+        PolylineShape(np.array([[-18., -10.], [-25., -20.]]), 0.5),
+        CircleShape(100., 100., 5.),
+    ]
+
+
+def build_grid(shapes: list[SignedDistanceShape], dtype: np.dtype) -> GridKeepoutArea:
+    grid = create_grid(dtype)
+    for shape in shapes:
+        grid.add_shape(shape)
+    return grid
+
+
+def get_full_distance_field(shapes: list[SignedDistanceShape], dtype: np.dtype) -> np.ndarray:
+    """全ての格子点について，全ての図形の符号付き距離の最小値を打ち切ったもの．"""
+    grid = create_grid(dtype)
+    window = slice(0, grid.n_x), slice(0, grid.n_y)
+    distance_field = np.full((grid.n_x, grid.n_y), grid.truncation, dtype=dtype)
+    for shape in shapes:
+        distance_field[...] = np.minimum(distance_field, grid.rasterize(shape, window))
+    return distance_field
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32], ids=lambda dtype: dtype.__name__)
+def test_added_shapes_match_full_rasterization(dtype: np.dtype):
+    shapes = create_shapes()
+    grid = build_grid(shapes, dtype)
+    np.testing.assert_array_equal(grid.distance_field, get_full_distance_field(shapes, dtype))
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32], ids=lambda dtype: dtype.__name__)
+def test_removed_shapes_match_rebuilt_grid(dtype: np.dtype):
+    shapes = create_shapes()
+    grid = create_grid(dtype)
+    handles = [grid.add_shape(shape) for shape in shapes]
+    remaining = dict(zip(handles, shapes))
+    # 重なっている図形から順に消していき，その都度作り直した格子と比べる
+    for handle in [handles[1], handles[3], handles[5], handles[6], handles[0]]:
+        grid.remove_shape(handle)
+        del remaining[handle]
+        rebuilt = build_grid(list(remaining.values()), dtype)
+        np.testing.assert_array_equal(grid.distance_field, rebuilt.distance_field)
+
+    # 消した後に追加しても同じ
+    handles_added = [grid.add_shape(shape) for shape in [shapes[3], shapes[1]]]
+    remaining.update(zip(handles_added, [shapes[3], shapes[1]]))
+    np.testing.assert_array_equal(
+        grid.distance_field, build_grid(list(remaining.values()), dtype).distance_field
+    )
+
+    # 全て消すと何も無い格子に戻る
+    for handle in list(remaining):
+        grid.remove_shape(handle)
+    np.testing.assert_array_equal(grid.distance_field, create_grid(dtype).distance_field)
+
+
+def test_check_inside_and_outside_shapes():
+    grid = build_grid(create_shapes(), np.float64)
+    assert grid.check(0., 0.) < 0.
+    assert grid.check(-15., 10.) == grid.truncation
+    # 格子の外は立ち入り禁止ではない
+    assert grid.check(100., 100.) == grid.truncation
@@ -0,0 +1,111 @@
+"""
+`KeepoutAreaIndex`の`query`が，出し入れを繰り返してKD木を作り直す前後でも，総当たりで調べた結果と同じになることを確かめる．
+"""
+import numpy as np
+import pytest
+
+from keepoutareas import KeepoutArea, CircleKeepoutArea, MovingCircleKeepoutAreas
+from keepoutindex import KeepoutAreaIndex
+
+REBUILD_THRESHOLD = 4
+
+
+def create_circle(rng: np.random.Generator) -> CircleKeepoutArea:
+    x, y = rng.uniform(-100., 100., size=2)
+    return CircleKeepoutArea(x, y, rng.uniform(0.5, 5.))
+
+
+def query_by_brute_force(keepoutareas: list[KeepoutArea], x: float, y: float, reach: float) -> set[int]:
+    survivors = set()
+    for koa in keepoutareas:
+        bounding_circle = koa.get_bounding_circle()
+        if bounding_circle is None or np.hypot(bounding_circle[0] - x, bounding_circle[1] - y) <= reach + bounding_circle[2]:
+            survivors.add(id(koa))
+    return survivors
+
+
+def assert_queries_match(index: KeepoutAreaIndex, rng: np.random.Generator):
+    for _ in range(5):
+        x, y = rng.uniform(-100., 100., size=2)
+        reach = rng.uniform(0., 40.)
+        result = [id(koa) for koa in index.query(x, y, reach)]
+        assert len(result) == len(set(result))
+        assert set(result) == query_by_brute_force(index.keepoutareas, x, y, reach)
+
+
+def test_query_matches_brute_force_through_add_update_remove():
+    rng = np.random.default_rng(0)
+    index = KeepoutAreaIndex(rebuild_threshold=REBUILD_THRESHOLD)
+    # 包む円を持たない領域は常に残る
+    unindexed = MovingCircleKeepoutAreas(np.zeros(1), np.zeros(1), np.ones(1))
+    unindexed_handle = index.add(unindexed)
+    keepoutareas_by_handle: dict[int, KeepoutArea] = {unindexed_handle: unindexed}
+
+    # KD木を作り直した回数を数える
+    rebuilds = []
+    rebuild_tree = index.rebuild_tree
+
+    def counting_rebuild_tree():
+        rebuilds.append(len(index.pending_slots))
+        rebuild_tree()
+
+    index.rebuild_tree = counting_rebuild_tree
+    for _ in range(300):
+        version = index.version
+        operation = rng.choice(["add", "update", "mutate", "remove"], p=[0.4, 0.2, 0.1, 0.3]) \
+            if len(keepoutareas_by_handle) > 1 else "add"
+        if operation == "add":
+            koa = create_circle(rng)
+            handle = index.add(koa)
+            assert handle not in keepoutareas_by_handle
+            keepoutareas_by_handle[handle] = koa
+        else:
+            handle = int(rng.choice([h for h in keepoutareas_by_handle if h != unindexed_handle]))
+            if operation == "update":
+                keepoutareas_by_handle[handle] = create_circle(rng)
+                index.update(handle, keepoutareas_by_handle[handle])
+            elif operation == "mutate":
+                # 同じオブジェクトの中身を変えた場合もupdateで知らせる
+                koa = keepoutareas_by_handle[handle]
+                koa.x, koa.y = rng.uniform(-100., 100., size=2)
+                index.update(handle, koa)
+            else:
+                index.remove(handle)
+                del keepoutareas_by_handle[handle]
+        assert index.version == version + 1
+        # 登録した順に並び，差し替えても順番は変わらない
+        assert index.keepoutareas == list(keepoutareas_by_handle.values())
+        assert_queries_match(index, rng)
+        assert len(index.pending_slots) <= REBUILD_THRESHOLD
+
+    # KD木を何度も作り直し，作り直していない間の変化も調べている
+    assert index.tree is not None
+    assert len(rebuilds) > 10
+    assert all(n_pending_slots > REBUILD_THRESHOLD for n_pending_slots in rebuilds)
+
+
+def test_free_slots_are_reused_and_handles_are_stable():
+    rng = np.random.default_rng(1)
+    index = KeepoutAreaIndex(rebuild_threshold=REBUILD_THRESHOLD)
+    keepoutareas = [create_circle(rng) for _ in range(10)]
+    handles = [index.add(koa) for koa in keepoutareas]
+    index.query(0., 0., 10.)
+    n_slots = len(index.slot_keepoutareas)
+    for handle in handles[:5]:
+        index.remove(handle)
+    for _ in range(5):
+        index.add(create_circle(rng))
+    assert len(index.slot_keepoutareas) == n_slots
+    # 残した領域のハンドルは同じ領域を指し続ける
+    for handle, koa in zip(handles[5:], keepoutareas[5:]):
+        assert index.keepoutareas_by_handle[handle] is koa
+    assert_queries_match(index, rng)
+
+
+def test_unknown_handle_raises():
+    index = KeepoutAreaIndex([CircleKeepoutArea(0., 0., 1.)])
+    index.remove(0)
+    with pytest.raises(KeyError):
+        index.update(0, CircleKeepoutArea(0., 0., 1.))
+    with pytest.raises(KeyError):
+        index.remove(0)
@@ -0,0 +1,138 @@
+"""
+`MPPIFilter`の計算経路どうしが，同じステアリング入力候補に対して同じ入力を出すことを確かめる．
+"""
+import numpy as np
+import pytest
+
+from vehiclemodel import VehicleModel
+from mppi import MPPIFilter, FilteringFlow
+from keepoutareas import CircleKeepoutArea
+
+SAMPLESIZE = 256
+HORIZON = 50
+
+
+def create_mppi_filter(**kwargs) -> MPPIFilter:
+    return MPPIFilter(
+        vehiclemodel=VehicleModel(),
+        samplesize=SAMPLESIZE,
+        horizon=HORIZON,
+        command_std=0.7,
+        rng=np.random.default_rng(0),
+        **kwargs
+    )
+
+
+def test_batch_matches_one_vehicle_at_a_time():
+    rng = np.random.default_rng(0)
+    n_vehicles = 8
+    initial_location_x = rng.uniform(-50., 50., size=n_vehicles)
+    initial_location_y = rng.uniform(-50., 50., size=n_vehicles)
+    initial_direction = rng.uniform(-np.pi, np.pi, size=n_vehicles)
+    initial_speed = rng.uniform(5., 15., size=n_vehicles)
+    nominal_command = rng.uniform(-0.3, 0.3, size=n_vehicles)
+    commands_list = np.clip(rng.normal(0., 0.7, size=(n_vehicles, SAMPLESIZE, HORIZON)), -1., 1.)
+    # 半分の車は正面に障害物があり，残りは障害物から遠い
+    keepoutareas = [
+        CircleKeepoutArea(x + 15. * np.cos(direction), y + 15. * np.sin(direction), 3.)
+        for x, y, direction in zip(
+            initial_location_x[::2], initial_location_y[::2], initial_direction[::2]
+        )
+    ]
+    initial_location_x[1::2] += 1000.
+
+    batch_filter = create_mppi_filter()
+    batch_filter.set_keepoutareas(keepoutareas)
+    batch_result = batch_filter.get_filtered_commands(
+        initial_location_x, initial_location_y, initial_direction, initial_speed, nominal_command,
+        commands_list=commands_list
+    )
+    assert batch_result.flows.count(FilteringFlow.Intervention) >= n_vehicles // 2
+
+    for i in range(n_vehicles):
+        single_filter = create_mppi_filter()
+        single_filter.set_keepoutareas(keepoutareas)
+        single_result = single_filter.get_filtered_command(
+            initial_location_x[i], initial_location_y[i], initial_direction[i], initial_speed[i],
+            nominal_command[i], commands_list=commands_list[i]
+        )
+        assert batch_result.flows[i] == single_result.flow
+        np.testing.assert_allclose(batch_result.filtered_commands[i], single_result.filtered_command, rtol=1e-12)
+
+
+def create_pruning_commands_list(rng: np.random.Generator) -> np.ndarray:
+    """
+    先頭の1/4は障害物を大きく避けるように曲がり，残りはほぼ直進して障害物に当たるステアリング入力候補．
+    後ろのサンプルは，先頭のサンプルを見た後では重みが無視できることが早い段階で確定する．
+    """
+    n_avoiding = SAMPLESIZE // 4
+    avoiding = rng.normal(0.9, 0.05, size=(n_avoiding, HORIZON))
+    straight = rng.normal(0., 0.05, size=(SAMPLESIZE - n_avoiding, HORIZON))
+    return np.clip(np.concatenate([avoiding, straight]), -1., 1.)
+
+
+@pytest.mark.parametrize("fused_chunk_size", [1, 16, 64, 100, SAMPLESIZE])
+@pytest.mark.parametrize("fused_time_block", [1, 10, HORIZON])
+def test_fused_weights_match_weigh_samples(fused_chunk_size: int, fused_time_block: int, monkeypatch):
+    rng = np.random.default_rng(fused_chunk_size)
+    mppi_filter = create_mppi_filter(fused_chunk_size=fused_chunk_size, fused_time_block=fused_time_block)
+    keepoutareas = [CircleKeepoutArea(12., 0., 2.)]
+    commands_list = create_pruning_commands_list(rng)
+    args = (0., 0., 0., 0., commands_list, keepoutareas)
+    mppi_filter.prepare_for_filtering(10.)
+    _, _, expected_weights = mppi_filter.weigh_samples(*args)
+
+    # 予測したサンプルとステップの数を数える
+    predict_block = mppi_filter.vehiclemodel.predict_block
+    predicted_steps = []
+
+    def counting_predict_block(x, y, direction, commands_list):
+        predicted_steps.append(commands_list.size)
+        return predict_block(x, y, direction, commands_list)
+
+    monkeypatch.setattr(mppi_filter.vehiclemodel, "predict_block", counting_predict_block)
+    _, _, fused_weights = mppi_filter.weigh_samples_fused(*args)
+
+    # 打ち切ったサンプルの重みは，最良のサンプルのnegligible_weight倍を下回る分しかずれない
+    tolerance = SAMPLESIZE * mppi_filter.negligible_weight * expected_weights.max()
+    np.testing.assert_allclose(fused_weights, expected_weights, rtol=1e-9, atol=tolerance)
+    np.testing.assert_allclose(
+        commands_list[:, 0] @ fused_weights, commands_list[:, 0] @ expected_weights, rtol=1e-9, atol=1e-12
+    )
+    # 1回のブロックで全ホライズンを予測する場合を除き，直進するサンプルは打ち切られている
+    if fused_time_block < HORIZON:
+        assert np.sum(predicted_steps) < SAMPLESIZE * HORIZON
+    else:
+        assert np.sum(predicted_steps) == SAMPLESIZE * HORIZON
+
+
+def test_fused_weights_when_every_later_sample_is_pruned(monkeypatch):
+    # 先頭の区切りのサンプルは障害物を避け，以降の区切りのサンプルは障害物に当たったブロックで全て打ち切られる
+    rng = np.random.default_rng(0)
+    fused_chunk_size = SAMPLESIZE // 4
+    fused_time_block = 10
+    mppi_filter = create_mppi_filter(fused_chunk_size=fused_chunk_size, fused_time_block=fused_time_block)
+    keepoutareas = [CircleKeepoutArea(12., 0., 2.)]
+    commands_list = create_pruning_commands_list(rng)
+    args = (0., 0., 0., 0., commands_list, keepoutareas)
+    mppi_filter.prepare_for_filtering(10.)
+    _, _, expected_weights = mppi_filter.weigh_samples(*args)
+
+    predict_block = mppi_filter.vehiclemodel.predict_block
+    predicted_samples = []
+
+    def counting_predict_block(x, y, direction, commands_list):
+        predicted_samples.append(commands_list.shape[0])
+        return predict_block(x, y, direction, commands_list)
+
+    monkeypatch.setattr(mppi_filter.vehiclemodel, "predict_block", counting_predict_block)
+    _, _, fused_weights = mppi_filter.weigh_samples_fused(*args)
+
+    n_blocks = HORIZON // fused_time_block
+    # 先頭の区切りは最後まで予測し，以降の区切りは一部だけを残すことなく途中で丸ごと打ち切られる
+    assert predicted_samples[:n_blocks] == [fused_chunk_size] * n_blocks
+    assert all(n_samples == fused_chunk_size for n_samples in predicted_samples)
+    assert len(predicted_samples) < n_blocks * (SAMPLESIZE // fused_chunk_size)
+    tolerance = SAMPLESIZE * mppi_filter.negligible_weight * expected_weights.max()
+    np.testing.assert_allclose(fused_weights, expected_weights, rtol=1e-9, atol=tolerance)
+    assert fused_weights[fused_chunk_size:].max() < mppi_filter.negligible_weight * fused_weights.max()
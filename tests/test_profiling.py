@@ -0,0 +1,62 @@
+"""
+`StageHistogram`の階級の境界とパーセンタイルの近似，`StageProfiler`の記録を確かめる．
+"""
+import pytest
+
+from profiling import get_bucket, get_bucket_lower_bound, StageHistogram, StageProfiler, N_BUCKETS
+
+
+@pytest.mark.parametrize("duration_ns", [0, 1, 3, 4, 5, 7, 8, 9, 15, 16, 100, 12345, 10 ** 9, 2 ** 40 + 1, 2 ** 64 - 1])
+def test_duration_is_within_its_bucket(duration_ns: int):
+    bucket = get_bucket(duration_ns)
+    assert 0 <= bucket < N_BUCKETS
+    assert get_bucket_lower_bound(bucket) <= duration_ns < get_bucket_lower_bound(bucket + 1)
+
+
+def test_buckets_are_contiguous():
+    # ある階級の上限は次の階級の下限で，隙間も重なりもない
+    for bucket in range(N_BUCKETS - 1):
+        lower = get_bucket_lower_bound(bucket)
+        upper = get_bucket_lower_bound(bucket + 1)
+        assert lower < upper
+        assert get_bucket(lower) == bucket
+        assert get_bucket(upper - 1) == bucket
+
+
+def test_negative_duration_goes_to_first_bucket():
+    assert get_bucket(-5) == 0
+
+
+@pytest.mark.parametrize("q", [1, 50, 99])
+def test_percentile_is_within_relative_error(q: float):
+    histogram = StageHistogram()
+    durations_ns = [1000 + 37 * i for i in range(1000)]
+    for duration_ns in durations_ns:
+        histogram.record(duration_ns)
+    exact = durations_ns[int(q / 100 * len(durations_ns)) - 1] * 1e-9
+    assert abs(histogram.get_percentile(q) - exact) <= 0.125 * exact
+
+
+def test_empty_histogram_returns_zero():
+    histogram = StageHistogram()
+    assert histogram.get_percentile(99) == 0.
+    assert histogram.get_mean() == 0.
+
+
+def test_profiler_records_stages():
+    profiler = StageProfiler()
+    profiler.record("rollout", 2000)
+    profiler.record("rollout", 4000)
+    profiler.record("keepout", 1000)
+    summary = profiler.get_summary()
+    assert summary["rollout"]["count"] == 2
+    assert summary["rollout"]["mean"] == pytest.approx(3000e-9)
+    assert summary["keepout"]["count"] == 1
+    assert profiler.get_percentile("weights", 50) == 0.
+
+    start = profiler.start()
+    profiler.lap("cost", start)
+    assert profiler.get_summary()["cost"]["count"] == 1
+
+    profiler.reset()
+    assert all(stage["count"] == 0 for stage in profiler.get_summary().values())
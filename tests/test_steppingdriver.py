@@ -0,0 +1,94 @@
+"""
+CARLAの代わりにスタブの世界と仮想の時計で，`SynchronousSteppingDriver`の進め方と待ち方を確かめる．
+"""
+from types import SimpleNamespace
+
+from steppingdriver import SynchronousSteppingDriver
+
+FIXED_DELTA_SECONDS = 0.04
+
+
+class StubWorld:
+    def __init__(self):
+        self.settings = SimpleNamespace(synchronous_mode=False, fixed_delta_seconds=None)
+        self.frame = 0
+
+    def get_settings(self):
+        return SimpleNamespace(**vars(self.settings))
+
+    def apply_settings(self, settings):
+        self.settings = settings
+
+    def tick(self) -> int:
+        self.frame += 1
+        return self.frame
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.
+        self.slept = 0.
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+        self.slept += seconds
+
+
+def create_driver(world: StubWorld, clock: VirtualClock, realtime: bool = True) -> SynchronousSteppingDriver:
+    return SynchronousSteppingDriver(
+        world, FIXED_DELTA_SECONDS, realtime=realtime, clock=clock, sleeper=clock.sleep
+    )
+
+
+def test_start_and_stop_restore_settings():
+    world = StubWorld()
+    with create_driver(world, VirtualClock()):
+        assert world.settings.synchronous_mode is True
+        assert world.settings.fixed_delta_seconds == FIXED_DELTA_SECONDS
+    assert world.settings.synchronous_mode is False
+    assert world.settings.fixed_delta_seconds is None
+
+
+def test_step_sleeps_until_next_step():
+    world = StubWorld()
+    clock = VirtualClock()
+    with create_driver(world, clock) as driver:
+        for expected_frame in range(1, 101):
+            assert driver.step() == expected_frame
+            clock.now += 0.01  # ゲームループの処理に10 msかかるとする
+        assert world.frame == 100
+        # 1ステップごとに残りの30 msを待つ．最初のステップは待たない
+        assert abs(clock.slept - 99 * 0.03) < 1e-9
+        assert abs(driver.actual_framerate - 25.) < 1e-6
+        assert driver.late_steps == 0
+
+
+def test_late_step_does_not_sleep_and_is_counted():
+    world = StubWorld()
+    clock = VirtualClock()
+    with create_driver(world, clock) as driver:
+        driver.step()
+        # 処理が1ステップより長くかかった場合は待たずに進み，遅れを数える
+        clock.now += 1.
+        slept = clock.slept
+        driver.step()
+        assert clock.slept == slept
+        assert driver.late_steps == 1
+        # 遅れを取り戻そうとせず，遅れたステップの時刻から1ステップずつ数え直す
+        driver.step()
+        driver.step()
+        assert abs(clock.slept - slept - FIXED_DELTA_SECONDS) < 1e-9
+        assert driver.late_steps == 1
+
+
+def test_not_realtime_never_sleeps():
+    world = StubWorld()
+    clock = VirtualClock()
+    with create_driver(world, clock, realtime=False) as driver:
+        for _ in range(10):
+            driver.step()
+    assert world.frame == 10
+    assert clock.slept == 0.
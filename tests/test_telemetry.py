@@ -0,0 +1,87 @@
+"""
+`TelemetryRecorder`が書き出したNPZのチャンクを，`load_telemetry_dataframe`とCSVを通して読み直せることを確かめる．
+"""
+from dataclasses import fields
+
+import numpy as np
+import pandas as pd
+
+from telemetry import TelemetryRecord, TelemetryRecorder, load_telemetry_dataframe, TRAJECTORY_COLUMN
+
+TRAJECTORY_WIDTH = 5
+N_RECORDS = 10
+CHUNK_SIZE = 4
+
+
+def create_record(step: int) -> TelemetryRecord:
+    # 介入したフレームだけ軌道を持ち，ホライズンより長い軌道は切り詰められる
+    trajectory = None
+    if step % 3 == 1:
+        trajectory = np.linspace(-1., 1., TRAJECTORY_WIDTH + step % 2)
+    return TelemetryRecord(
+        VehicleLocationX=10. * step,
+        VehicleSpeed=0.5 * step,
+        ObstacleRadius2=np.nan if step == 0 else 4.,
+        ControlFilteredSteer=-0.1 * step,
+        MPPIFilterComputationTime=1e-3 * step,
+        MPPIFilterFilteringFlowName="Intervention" if trajectory is not None else "NoIntervention",
+        MPPIOptimalSteerTrajectory=trajectory,
+        MPPITotalTimeP99=2e-3,
+        GameTimestamp=0.04 * step,
+        GameStep=step,
+    )
+
+
+def record_session(directory) -> tuple[list[TelemetryRecord], TelemetryRecorder]:
+    records = [create_record(step) for step in range(N_RECORDS)]
+    recorder = TelemetryRecorder(directory, TRAJECTORY_WIDTH, chunk_size=CHUNK_SIZE, n_buffers=2)
+    for record in records:
+        recorder.append(record)
+    recorder.close()
+    return records, recorder
+
+
+def get_expected_trajectory(record: TelemetryRecord) -> list[float]:
+    trajectory = record.MPPIOptimalSteerTrajectory
+    return [] if trajectory is None else trajectory[:TRAJECTORY_WIDTH].tolist()
+
+
+def test_chunks_round_trip_to_dataframe(tmp_path):
+    records, _ = record_session(tmp_path)
+    assert len(list(tmp_path.glob("chunk_*.npz"))) == -(-N_RECORDS // CHUNK_SIZE)
+
+    df = load_telemetry_dataframe(tmp_path)
+    assert list(df.columns) == [f.name for f in fields(TelemetryRecord)]
+    assert len(df) == N_RECORDS
+    # チャンクをまたいでも記録した順に並ぶ
+    assert df["GameStep"].tolist() == list(range(N_RECORDS))
+    assert df["GameStep"].dtype == np.int64
+    assert df["VehicleLocationX"].dtype == np.float64
+    assert df["ObstacleRadius2"].dtype == np.float64
+    assert np.isnan(df["ObstacleRadius2"].iloc[0])
+    assert df["MPPIFilterFilteringFlowName"].map(type).eq(str).all()
+    for record, (_, row) in zip(records, df.iterrows()):
+        assert row.VehicleLocationX == record.VehicleLocationX
+        assert row.ControlFilteredSteer == record.ControlFilteredSteer
+        assert row.MPPIFilterFilteringFlowName == record.MPPIFilterFilteringFlowName
+        assert row[TRAJECTORY_COLUMN] == get_expected_trajectory(record)
+
+
+def test_csv_export_round_trip(tmp_path):
+    directory = tmp_path / "session"
+    records, recorder = record_session(directory)
+    csv_path = tmp_path / "session.csv"
+    recorder.export_csv(csv_path)
+
+    df = pd.read_csv(csv_path, index_col=0)
+    expected = load_telemetry_dataframe(directory)
+    assert list(df.columns) == list(expected.columns)
+    assert df.index.tolist() == list(range(N_RECORDS))
+    assert df["GameStep"].tolist() == list(range(N_RECORDS))
+    assert df["GameStep"].dtype == np.int64
+    assert df["VehicleSpeed"].dtype == np.float64
+    pd.testing.assert_series_equal(df["VehicleLocationX"], expected["VehicleLocationX"])
+    pd.testing.assert_series_equal(df["MPPIFilterFilteringFlowName"], expected["MPPIFilterFilteringFlowName"])
+    # 軌道はリストの文字列表現として保存される
+    for record, trajectory in zip(records, df[TRAJECTORY_COLUMN]):
+        assert trajectory == str(get_expected_trajectory(record))
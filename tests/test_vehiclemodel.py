@@ -0,0 +1,70 @@
+"""
+`RolloutBackend.Loop`と`RolloutBackend.Cumsum`が，同じステアリング入力候補に対して同じ軌道を返すことを確かめる．
+"""
+import numpy as np
+import pytest
+
+from vehiclemodel import VehicleModel, RolloutBackend
+
+SAMPLESIZE = 256
+HORIZON = 50
+N_VEHICLES = 4
+
+
+def predict(backend: RolloutBackend, dtype: np.dtype, speed, x, y, direction, commands_list, use_workspace: bool):
+    vehiclemodel = VehicleModel(rollout_backend=backend, dtype=dtype)
+    vehiclemodel.set_speed(speed)
+    workspace = None
+    if use_workspace:
+        workspace = vehiclemodel.create_rollout_workspace(commands_list.shape[:-1], commands_list.shape[-1])
+    x_history_list, y_history_list = vehiclemodel.predict_constant_speed_variable_command_behaviour(
+        x, y, direction, commands_list, workspace
+    )
+    return x_history_list.copy(), y_history_list.copy()
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32], ids=lambda dtype: dtype.__name__)
+@pytest.mark.parametrize("use_workspace", [False, True], ids=["allocating", "workspace"])
+def test_backends_match_for_one_vehicle(dtype: np.dtype, use_workspace: bool):
+    rng = np.random.default_rng(0)
+    commands_list = rng.uniform(-1., 1., size=(SAMPLESIZE, HORIZON)).astype(dtype)
+    args = (12.3, -45.6, 78.9, 0.7, commands_list, use_workspace)
+    x_loop, y_loop = predict(RolloutBackend.Loop, dtype, *args)
+    x_cumsum, y_cumsum = predict(RolloutBackend.Cumsum, dtype, *args)
+    assert x_loop.shape == (SAMPLESIZE, HORIZON + 1)
+    assert x_loop.dtype == x_cumsum.dtype == dtype
+    np.testing.assert_array_equal(x_loop, x_cumsum)
+    np.testing.assert_array_equal(y_loop, y_cumsum)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32], ids=lambda dtype: dtype.__name__)
+def test_backends_match_for_batch(dtype: np.dtype):
+    rng = np.random.default_rng(1)
+    commands_list = rng.uniform(-1., 1., size=(N_VEHICLES, SAMPLESIZE, HORIZON)).astype(dtype)
+    # 車ごとの速度と初期状態は，サンプルの軸へブロードキャストできる形にする
+    speed = rng.uniform(5., 20., size=(N_VEHICLES, 1))
+    x, y = rng.uniform(-300., 300., size=(2, N_VEHICLES, 1))
+    direction = rng.uniform(-np.pi, np.pi, size=(N_VEHICLES, 1))
+    args = (speed, x, y, direction, commands_list, False)
+    x_loop, y_loop = predict(RolloutBackend.Loop, dtype, *args)
+    x_cumsum, y_cumsum = predict(RolloutBackend.Cumsum, dtype, *args)
+    assert x_loop.shape == (N_VEHICLES, SAMPLESIZE, HORIZON + 1)
+    np.testing.assert_array_equal(x_loop, x_cumsum)
+    np.testing.assert_array_equal(y_loop, y_cumsum)
+
+
+@pytest.mark.parametrize("backend", list(RolloutBackend), ids=lambda backend: backend.name)
+def test_batch_matches_one_vehicle_at_a_time(backend: RolloutBackend):
+    # float32では車ごとの速度の配列がfloat64なので丸め方が変わる．float64で確かめる
+    rng = np.random.default_rng(2)
+    commands_list = rng.uniform(-1., 1., size=(N_VEHICLES, SAMPLESIZE, HORIZON))
+    speed = rng.uniform(5., 20., size=(N_VEHICLES, 1))
+    x, y = rng.uniform(-300., 300., size=(2, N_VEHICLES, 1))
+    direction = rng.uniform(-np.pi, np.pi, size=(N_VEHICLES, 1))
+    x_batch, y_batch = predict(backend, np.float64, speed, x, y, direction, commands_list, False)
+    for i in range(N_VEHICLES):
+        x_single, y_single = predict(
+            backend, np.float64, speed[i, 0], x[i, 0], y[i, 0], direction[i, 0], commands_list[i], False
+        )
+        np.testing.assert_array_equal(x_batch[i], x_single)
+        np.testing.assert_array_equal(y_batch[i], y_single)
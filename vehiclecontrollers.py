@@ -1,7 +1,25 @@
-import carla
 from abc import ABC, abstractmethod
-import LogitechSteeringWheelPy as lsw
-from LogitechSteeringWheelPy.g29 import  G29
+from dataclasses import dataclass
+from typing import Callable
+
+# CARLAやG29のライブラリが無い環境（headless.pyなど）でも，G29Controller以外は使えるようにする
+try:
+    from carla import VehicleControl
+except ImportError:
+    @dataclass
+    class VehicleControl:
+        """CARLAが無い環境で`carla.VehicleControl`の代わりに使う．"""
+        throttle: float = 0.
+        steer: float = 0.
+        brake: float = 0.
+        hand_brake: bool = False
+        reverse: bool = False
+        manual_gear_shift: bool = False
+        gear: int = 0
+try:
+    from LogitechSteeringWheelPy.g29 import G29
+except ImportError:
+    G29 = None
 
 
 class VehicleController(ABC):
@@ -10,22 +28,41 @@ class VehicleController(ABC):
         pass
 
     @abstractmethod
-    def get_vehicle_control(self) -> carla.VehicleControl:
+    def get_vehicle_control(self) -> VehicleControl:
         pass
 
 class ConstantVehicleController(VehicleController):
-    def __init__(self, vehicle_control:carla.VehicleControl):
+    def __init__(self, vehicle_control:VehicleControl):
         self.vehicle_control = vehicle_control
 
     def tick(self):
         pass
-    def get_vehicle_control(self) -> carla.VehicleControl:
+    def get_vehicle_control(self) -> VehicleControl:
         return self.vehicle_control
 
+class ScriptedVehicleController(VehicleController):
+    def __init__(self, steer_script: Callable[[float], float], throttle: float, frame_time: float):
+        """
+        時刻[s]からステアリング入力を決める関数に従って運転する．G29の代わりに，決まった運転を繰り返し試すのに使う．
+        `tick`を呼ぶたびにframe_timeだけ時刻が進む．
+        """
+        self.steer_script = steer_script
+        self.frame_time = frame_time
+        self.time = -frame_time
+        self.control = VehicleControl()
+        self.control.throttle = throttle
+
+    def tick(self):
+        self.time += self.frame_time
+        self.control.steer = min(0.99, max(-0.99, self.steer_script(self.time)))
+
+    def get_vehicle_control(self) -> VehicleControl:
+        return self.control
+
 class G29Controller(VehicleController):
     def __init__(self, g29:G29):
         self.g29 = g29
-        self.control = carla.VehicleControl()
+        self.control = VehicleControl()
 
     def tick(self):
         """このメソッドでは`g29.update()`を呼び出さないことに注意．
@@ -41,5 +78,5 @@ class G29Controller(VehicleController):
         if self.g29.is_triggered(G29.Button.Return):
             self.control.reverse = not self.control.reverse
 
-    def get_vehicle_control(self) -> carla.VehicleControl:
+    def get_vehicle_control(self) -> VehicleControl:
         return self.control
\ No newline at end of file
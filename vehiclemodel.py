@@ -1,8 +1,13 @@
-from numpy import ndarray, sin, cos
+from numpy import ndarray, sin, cos, cumsum, moveaxis
+from math import atan2, hypot, pi, tau
+from enum import Enum
+from dataclasses import dataclass
+from typing import Optional
 import numpy as np
 
 zeros = np.zeros
 ones = np.ones
+empty = np.empty
 float64 = np.float64
 
 # 先の調査で同定したもの．
@@ -12,35 +17,183 @@ DEFAULT_WHEELBASE = 13.90
 DEFAULT_STEERING_SCALE = 1.022
 
 
+class RolloutBackend(Enum):
+    """`VehicleModel.predict_constant_speed_variable_command_behaviour`の計算方式を記述する．"""
+    # 予測ステップごとにPythonのループを回して積分する．
+    Loop = "Loop"
+    # 時間方向の累積和で一括して積分する．Pythonによるステップごとの処理は無い．
+    Cumsum = "Cumsum"
+
+
+@dataclass
+class RolloutWorkspace:
+    """`VehicleModel.predict_constant_speed_variable_command_behaviour`の計算結果の書き込み先．
+    いずれも[内部時間，サンプルインデックス]の順番．
+    """
+    # （ホライズン+1，サンプルサイズ）
+    x_history_list_T: ndarray
+    y_history_list_T: ndarray
+    # （ホライズン，サンプルサイズ）
+    direction_list_T: ndarray
+
+
+@dataclass
+class ConstantCommandArc:
+    """
+    速度とステアリング入力が一定の時の予測軌道を記述する．
+    予測ステップkにおける位置は，半径`step_length / (2 sin(step_turn / 2))`の円周上に並ぶ（step_turnが0なら直線上）．
+    `VehicleModel.get_constant_command_arc`で作る．
+    """
+    initial_location_x: float
+    initial_location_y: float
+    initial_direction: float
+    # 1予測ステップで進む距離
+    step_length: float
+    # 1予測ステップで変わる方位
+    step_turn: float
+    horizon: int
+
+    def is_straight(self) -> bool:
+        return abs(self.step_turn) < 1e-9
+
+    def get_location(self, step: int) -> tuple[float, float]:
+        """予測ステップstepにおける位置を閉じた式で求める．"""
+        if self.is_straight():
+            distance = self.step_length * step
+            return (
+                self.initial_location_x + distance * cos(self.initial_direction),
+                self.initial_location_y + distance * sin(self.initial_direction)
+            )
+        center_x, center_y, radius = self.get_circle()
+        theta = self.initial_direction + (step - 0.5) * self.step_turn
+        return center_x + radius * sin(theta), center_y - radius * cos(theta)
+
+    def get_circle(self) -> tuple[float, float, float]:
+        """
+        予測軌道が乗る円の中心と（符号付きの）半径を返す．
+        位置は，角度theta_k = initial_direction + (k - 1/2) step_turn を使って，中心 + 半径 * (sin theta_k, -cos theta_k) と書ける．
+        """
+        radius = self.step_length / (2 * sin(self.step_turn / 2))
+        theta0 = self.initial_direction - self.step_turn / 2
+        return (
+            self.initial_location_x - radius * sin(theta0),
+            self.initial_location_y + radius * cos(theta0),
+            radius
+        )
+
+    def get_min_distance(self, x: float, y: float) -> float:
+        """
+        点(x,y)から，予測ステップ0からhorizonまでの連続した軌道（円弧または線分）までの最短距離を返す．
+        各予測ステップの位置はこの軌道の上にあるので，どの予測ステップの位置までの距離もこれ以上になる．
+        """
+        end_x, end_y = self.get_location(self.horizon)
+        to_start = hypot(x - self.initial_location_x, y - self.initial_location_y)
+        to_end = hypot(x - end_x, y - end_y)
+        if self.step_length == 0.:
+            return to_start
+
+        if self.is_straight():
+            # 線分への最短距離
+            length = self.step_length * self.horizon
+            along = (x - self.initial_location_x) * cos(self.initial_direction) \
+                    + (y - self.initial_location_y) * sin(self.initial_direction)
+            if along <= 0.:
+                return to_start
+            if along >= length:
+                return to_end
+            return abs(
+                -(x - self.initial_location_x) * sin(self.initial_direction)
+                + (y - self.initial_location_y) * cos(self.initial_direction)
+            )
+
+        # 円弧への最短距離．円周上で点に最も近い角度が円弧の範囲に入っていれば円周までの距離，そうでなければ端点までの距離
+        center_x, center_y, radius = self.get_circle()
+        dx = x - center_x
+        dy = y - center_y
+        sign = 1. if radius > 0. else -1.
+        nearest_theta = atan2(sign * dx, -sign * dy)
+        theta0 = self.initial_direction - self.step_turn / 2
+        span = self.horizon * self.step_turn
+        if abs(span) >= tau:
+            is_on_arc = True
+        elif span > 0.:
+            is_on_arc = (nearest_theta - theta0) % tau <= span
+        else:
+            is_on_arc = (theta0 - nearest_theta) % tau <= -span
+        if is_on_arc:
+            return abs(hypot(dx, dy) - abs(radius))
+        return min(to_start, to_end)
+
+
 class VehicleModel():
     def __init__(
             self,
             wheelbase: float = DEFAULT_WHEELBASE,
             steering_scale: float = DEFAULT_STEERING_SCALE,
-            frame_time: float = DEFAULT_FRAMETIME
+            frame_time: float = DEFAULT_FRAMETIME,
+            rollout_backend: RolloutBackend = RolloutBackend.Loop,
+            dtype: np.dtype = float64
     ):
+        """
+        車の内部モデル．
+
+        Parameters
+        ----------
+        wheelbase:float
+        steering_scale:float
+        frame_time:float
+            1予測ステップあたりの時間．
+        rollout_backend:RolloutBackend
+            複数サンプルの軌道予測に使う計算方式．どちらも同じ結果を返す．
+        dtype:np.dtype
+            複数サンプルの軌道予測で使う浮動小数点の型．float32にするとメモリ帯域が半分で済む．
+        """
         self.wheelbase = wheelbase
         self.inv_wheelbase = 1. / wheelbase
         self.steering_scale = steering_scale
         self.frame_time = frame_time
+        self.rollout_backend = rollout_backend
+        self.dtype = np.dtype(dtype)
         self.vts = .0
         self.speed_vts_div_wheelbase = 0.0
 
-    def set_speed(self, speed: float):
+    def create_rollout_workspace(
+            self,
+            samples_shape: tuple[int, ...],
+            horizon: int
+    ) -> RolloutWorkspace:
+        """
+        軌道予測の書き込み先を前もって確保する．
+        これを`predict_constant_speed_variable_command_behaviour`へ渡すと，予測のたびに配列を確保しなくて済む．
+        """
+        dtype = self.dtype
+        return RolloutWorkspace(
+            x_history_list_T=empty(shape=(horizon + 1, *samples_shape), dtype=dtype),
+            y_history_list_T=empty(shape=(horizon + 1, *samples_shape), dtype=dtype),
+            direction_list_T=empty(shape=(horizon, *samples_shape), dtype=dtype),
+        )
+
+    def set_speed(self, speed: float | ndarray):
         """速度を設定する．
         このモデルでは，速度のダイナミクスに関する記述はない．いわば，速度はパラメータとして扱われる．
         そして，モデルのダイナミクスを記述する際，速度が含まれる項が複雑（掛け算や割り算処理が含まれていて計算効率に支障がある）ため，
         その項を前もって計算しておく．
+        複数の車を一度に予測する場合は，車ごとの速度を並べたndarrayを与える．
+        その形は，`predict_constant_speed_variable_command_behaviour`に与えるcommands_listの先頭の軸へブロードキャストできるように．
+        ndarrayはモデルの浮動小数点の型に揃える．揃えないと，float32の予測の途中でfloat64に上がり，計算方式ごとに丸め方が変わる．
         """
+        if isinstance(speed, ndarray):
+            speed = speed.astype(self.dtype, copy=False)
         self.vts = speed * self.frame_time
         self.speed_vts_div_wheelbase = self.vts * self.inv_wheelbase
 
     def predict_constant_speed_variable_command_behaviour(
             self,
-            initial_location_x: float,
-            initial_location_y: float,
-            initial_direction: float,
+            initial_location_x: float | ndarray,
+            initial_location_y: float | ndarray,
+            initial_direction: float | ndarray,
             commands_list: ndarray,
+            workspace: Optional[RolloutWorkspace] = None
     ) -> tuple[ndarray, ndarray]:
         """
         速度は一定だが，ステアリング入力が時変の時の軌道を予測する．
@@ -48,12 +201,17 @@ class VehicleModel():
 
         Parameters
         ----------
-        initial_location_x:float
-        initial_location_y:float
-        initial_direction:float
+        initial_location_x:float|ndarray
+        initial_location_y:float|ndarray
+        initial_direction:float|ndarray
+            車ごとに初期状態が異なる場合は，commands_listの先頭の軸へブロードキャストできる形のndarrayを与える．
         commands_list:ndarray
             （サンプルサイズ，ホライゾン）の行列形式．
             commands_list[i][k]には，サンプルiの予測ステップkにおけるステアリング入力の値を入れる．
+            （車の数，サンプルサイズ，ホライゾン）のように先頭に軸を追加してもよい．最後の軸が常に予測ステップを表す．
+        workspace:Optional[RolloutWorkspace]=None
+            （任意）`create_rollout_workspace`で確保した書き込み先．与えた場合，返り値はその中身を指す．
+            `RolloutBackend.Cumsum`では，これを与えると大きな配列を一切確保しない．
 
         Returns
         -------
@@ -61,27 +219,158 @@ class VehicleModel():
             どちらも（サンプルサイズ，ホライゾン+1）の行列形式．
             x_history_list[i][k]には，サンプルiの予測ステップkにおけるx座標の値が入る．
             y_history_listも同じ．
+            commands_listの先頭に軸を追加した場合は，同じ軸が先頭に付く．
         """
-        n_samples, horizon = commands_list.shape
+        if self.rollout_backend == RolloutBackend.Cumsum:
+            return self.predict_by_cumsum(
+                initial_location_x, initial_location_y, initial_direction, commands_list, workspace
+            )
+        return self.predict_by_loop(
+            initial_location_x, initial_location_y, initial_direction, commands_list, workspace
+        )
+
+    def predict_by_loop(
+            self,
+            initial_location_x: float | ndarray,
+            initial_location_y: float | ndarray,
+            initial_direction: float | ndarray,
+            commands_list: ndarray,
+            workspace: Optional[RolloutWorkspace] = None
+    ) -> tuple[ndarray, ndarray]:
+        """`RolloutBackend.Loop`による実装．"""
+        *samples_shape, horizon = commands_list.shape
 
         # メモリ参照先を密にするため[内部時間，サンプルインデックス]の順番で扱う
-        commands_list_T = commands_list.T
-        x_history_list_T = zeros(shape=(horizon + 1, n_samples), dtype=float64)
-        y_history_list_T = zeros(shape=(horizon + 1, n_samples), dtype=float64)
+        commands_list_T = moveaxis(commands_list, -1, 0)
+        if workspace is None:
+            x_history_list_T = zeros(shape=(horizon + 1, *samples_shape), dtype=self.dtype)
+            y_history_list_T = zeros(shape=(horizon + 1, *samples_shape), dtype=self.dtype)
+        else:
+            x_history_list_T = workspace.x_history_list_T
+            y_history_list_T = workspace.y_history_list_T
 
         # 初期時刻
-        x_history_list_T[0, :] = initial_location_x
-        y_history_list_T[0, :] = initial_location_y
-        direction_list = ones(shape=n_samples, dtype=float64) * initial_direction
+        x_history_list_T[0] = initial_location_x
+        y_history_list_T[0] = initial_location_y
+        direction_list = empty(shape=samples_shape, dtype=self.dtype)
+        direction_list[...] = initial_direction
 
         # 予測ステップ
         for command_list, inner_step in zip(commands_list_T, range(1, horizon + 1)):
-            x_history_list_T[inner_step, :] = x_history_list_T[inner_step - 1, :] + self.vts * cos(direction_list)
-            y_history_list_T[inner_step, :] = y_history_list_T[inner_step - 1, :] + self.vts * sin(direction_list)
+            x_history_list_T[inner_step] = x_history_list_T[inner_step - 1] + self.vts * cos(direction_list)
+            y_history_list_T[inner_step] = y_history_list_T[inner_step - 1] + self.vts * sin(direction_list)
             direction_list += self.speed_vts_div_wheelbase * command_list
         return (
-            x_history_list_T.T,
-            y_history_list_T.T
+            moveaxis(x_history_list_T, 0, -1),
+            moveaxis(y_history_list_T, 0, -1)
+        )
+
+    def predict_by_cumsum(
+            self,
+            initial_location_x: float | ndarray,
+            initial_location_y: float | ndarray,
+            initial_direction: float | ndarray,
+            commands_list: ndarray,
+            workspace: Optional[RolloutWorkspace] = None
+    ) -> tuple[ndarray, ndarray]:
+        """`RolloutBackend.Cumsum`による実装．
+        速度一定なので，方位はステアリング入力の累積和，位置は方位のcos/sinの累積和になる．
+        先頭行に初期値を置いてから累積和を取ることで，`predict_by_loop`と同じ順番で足し算が行われ，同じ結果になる．
+        """
+        *samples_shape, horizon = commands_list.shape
+
+        # メモリ参照先を密にするため[内部時間，サンプルインデックス]の順番で扱う
+        commands_list_T = moveaxis(commands_list, -1, 0)
+
+        if workspace is None:
+            workspace = self.create_rollout_workspace(samples_shape, horizon)
+        x_history_list_T = workspace.x_history_list_T
+        y_history_list_T = workspace.y_history_list_T
+        direction_list_T = workspace.direction_list_T
+
+        # 各予測ステップの開始時点における方位
+        direction_list_T[0] = initial_direction
+        np.multiply(commands_list_T[:-1], self.speed_vts_div_wheelbase, out=direction_list_T[1:])
+        cumsum(direction_list_T, axis=0, out=direction_list_T)
+
+        x_history_list_T[0] = initial_location_x
+        y_history_list_T[0] = initial_location_y
+        cos(direction_list_T, out=x_history_list_T[1:])
+        sin(direction_list_T, out=y_history_list_T[1:])
+        x_history_list_T[1:] *= self.vts
+        y_history_list_T[1:] *= self.vts
+        cumsum(x_history_list_T, axis=0, out=x_history_list_T)
+        cumsum(y_history_list_T, axis=0, out=y_history_list_T)
+        return (
+            moveaxis(x_history_list_T, 0, -1),
+            moveaxis(y_history_list_T, 0, -1)
+        )
+
+    def predict_block(
+            self,
+            initial_location_x: ndarray,
+            initial_location_y: ndarray,
+            initial_direction: ndarray,
+            commands_list: ndarray
+    ) -> tuple[ndarray, ndarray, ndarray]:
+        """
+        サンプルごとに異なる状態から，数ステップ分だけ軌道を予測する．
+        長いホライズンを小分けにして予測する際に使う．足し算の順番は`predict_by_loop`と同じ．
+
+        Parameters
+        ----------
+        initial_location_x:ndarray
+        initial_location_y:ndarray
+        initial_direction:ndarray
+            いずれも（サンプルサイズ，）のベクトル形式．
+        commands_list:ndarray
+            （サンプルサイズ，ステップ数）の行列形式．
+
+        Returns
+        -------
+        x_history_list, y_history_list, final_direction: tuple[ndarray, ndarray, ndarray]
+            x_history_list, y_history_listは（サンプルサイズ，ステップ数）の行列形式で，初期位置を含まない．
+            final_directionは最後のステップを終えた時の方位．
+        """
+        n_samples, n_steps = commands_list.shape
+        direction_increments = commands_list * self.speed_vts_div_wheelbase
+
+        # 各ステップの開始時点における方位
+        direction_list = empty(shape=(n_samples, n_steps), dtype=self.dtype)
+        direction_list[:, 0] = initial_direction
+        direction_list[:, 1:] = direction_increments[:, :-1]
+        cumsum(direction_list, axis=1, out=direction_list)
+        final_direction = direction_list[:, -1] + direction_increments[:, -1]
+
+        x_history_list = cos(direction_list)
+        y_history_list = sin(direction_list)
+        x_history_list *= self.vts
+        y_history_list *= self.vts
+        x_history_list[:, 0] += initial_location_x
+        y_history_list[:, 0] += initial_location_y
+        cumsum(x_history_list, axis=1, out=x_history_list)
+        cumsum(y_history_list, axis=1, out=y_history_list)
+        return x_history_list, y_history_list, final_direction
+
+    def get_constant_command_arc(
+            self,
+            initial_location_x: float,
+            initial_location_y: float,
+            initial_direction: float,
+            command: float,
+            horizon: int
+    ) -> ConstantCommandArc:
+        """
+        速度もステアリング入力も一定の時の予測軌道を，円弧（または線分）として返す．
+        `predict_constant_speed_constant_command_behaviour`と違い，予測ステップごとの計算をしない．
+        """
+        return ConstantCommandArc(
+            initial_location_x=initial_location_x,
+            initial_location_y=initial_location_y,
+            initial_direction=initial_direction,
+            step_length=float(self.vts),
+            step_turn=float(self.speed_vts_div_wheelbase * command),
+            horizon=horizon
         )
 
     def predict_constant_speed_constant_command_behaviour(